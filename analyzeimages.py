@@ -9,25 +9,66 @@ Example usage:
         -path_images /tmp/preprocessed
         -path_labels_map data/car_label_map.pbtxt
         -save_directory /tmp/processed
+
+To reprocess archived frames (directories, file lists or shards) without deleting them, and exit when done:
+    ./analyzeimages \
+        -backfill /data/frames /data/shards/261_368_1539558000.tar
+        -backfill_checkpoint /data/backfill.checkpoint
+        -path_labels_map data/car_label_map.pbtxt
+        -save_directory /tmp/processed
 """
-import random
+import time
+
+# Taken before the imports, which are a good part of startup
+PROCESS_STARTED_AT = time.time()
+
 import sys
+import threading
 import numpy as np
-import tensorflow as tf
 from saveimages import *
+from annotator import DEFAULT_INTERVAL_SECS, AnnotationJob, AnnotationRenderer, CameraSampler, parse_intervals
+from backfill import ArchivedFrame, BackfillSource, collect_frames
+from framequeue import FrameSource, FreshFrameQueue, POLICIES
+from inferenceworkers import InferenceWorkers
+from detectors import CPU_DEVICE, DEFAULT_MODEL, GPU_DEVICE, MODELS, TensorFlowDetector, create_detector
+from startup import StartupTimer
+from profiling import DEFAULT_PROFILE_SECS, DEFAULT_TRACE_STEPS, ProfilingControl, ignore_signals
+from metrics import CAMERA_FRAMES, OUTCOME_ERROR, OUTCOME_OK, REGISTRY, record_stage, start_http_server, watch_spool
+from framedecode import DecodePool, image_to_array
+from microbatch import BatchStats, MicroBatcher, split_detections
+from pipeline import Pipeline, Stage
+from postprocess import DetectionCounter, parse_thresholds
+from roi import RegionConfig
+from motiongate import MotionGate
+from detectionstore import DEFAULT_SCORE_FLOOR, DetectionStoreWriter
+from dynamowriter import ResultWriter
 from PIL import Image, ImageFile
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 # TODO: Find another way to include object_detection package
+# TensorFlow and the object_detection utils are imported where they are used, so a detector backend or a start that
+# does not need them does not pay for importing them
 sys.path.append('./models-master/research/')
 
-from object_detection.utils import label_map_util, visualization_utils as vis_util
-
 ACCESS_KEY = ""
 SECRET_KEY = ""
 
 DETECTION_LIMIT = .4
+IDLE_SLEEP_SECS = .5
+RESCAN_INTERVAL_SECS = 5
+REPORT_INTERVAL_SECS = 60
+GRAPH_CACHE_DIRECTORY = './graph_cache'
+PROFILE_DIRECTORY = './profiles'
+BACKFILL_BATCH_SIZE = 8
+TABLE_NAME = 'ourcamera_v2'
+# Every worker of -workers serves its metrics on the port after the previous worker's
+METRICS_PORT = 9109
+
+STAGE_DECODE = 'decode'
+STAGE_INFERENCE = 'inference'
+STAGE_POSTPROCESS = 'postprocess'
+STARTUP_SECONDS = REGISTRY.gauge('ourcamera_startup_seconds', 'Seconds each startup phase took', ('phase',))
 
 # noinspection PyArgumentList
 logging.basicConfig(
@@ -46,39 +87,73 @@ class TrafficResult:
     numberCars = 0
     numberTrucks = 0
     numberPeople = 0
+    # Class name to count for every class of the label map
+    counts = None
+    # Region name to {class name: count} of the detections standing in each region of interest of the camera
+    regions = None
+    # Set when the counts were carried forward from the frame at reusedFromTimestamp because the scene did not change
+    inferredByReuse = False
+    reusedFromTimestamp = None
 
 
 class AnalyzeImages:
-    def __init__(self):
-        self._table = None
+    def __init__(self, device=GPU_DEVICE, session_config=None, model=DEFAULT_MODEL, num_threads=0,
+                 class_thresholds=None, regions=None, motion_gate=None, detection_store=None,
+                 result_writer=None, result_wal=None, annotation_sampler=None, annotation_queue_size=16,
+                 graph_cache=None, warm_up=True, profiling=None):
+        self._device = device
+        self._session_config = session_config
+        self._model = model
+        self._num_threads = num_threads
+        self._class_thresholds = class_thresholds
+        self._counter = None
+        self._regions = regions
+        self._motion_gate = motion_gate
+        self._detection_store = detection_store
+        self._result_writer = result_writer
+        self._result_wal = result_wal
+        self._result_writer_lock = threading.Lock()
+        if result_writer is None and result_wal:
+            # Replays the results the last run left in the log now, not with the first result of this one
+            self.get_result_writer()
+        self._annotation_sampler = annotation_sampler or CameraSampler()
+        self._annotation_queue_size = annotation_queue_size
+        self._annotation_renderer = None
+        self._graph_cache = graph_cache
+        self._warm_up = warm_up
+        self._profiling = profiling
+        self._startup = StartupTimer(PROCESS_STARTED_AT)
+        self._startup.mark('imports')
 
     @staticmethod
-    def create_graph():
-        pathcpkt = './faster_rcnn_resnet50_coco_2018_01_28/frozen_inference_graph.pb'
-
-        with tf.device('/gpu:1'):
-            detection_graph = tf.Graph()
-            with detection_graph.as_default():
-                od_graph_def = tf.GraphDef()
-                with tf.gfile.GFile(pathcpkt, 'rb') as fid:
-                    serialized_graph = fid.read()
-                    od_graph_def.ParseFromString(serialized_graph)
-                    tf.import_graph_def(od_graph_def, name='')
-            return detection_graph
+    def create_graph(device=GPU_DEVICE):
+        _, pathcpkt, _ = MODELS[DEFAULT_MODEL]
+        return TensorFlowDetector.load_graph(pathcpkt, device)
+
+    def create_detector(self):
+        return create_detector(self._model, self._device, self._session_config, self._num_threads, self._graph_cache)
+
+    @staticmethod
+    def create_session_config(intra_op_threads=0, inter_op_threads=0):
+        """Session thread pools; 0 lets TensorFlow use every core, which oversubscribes a host with several workers"""
+        import tensorflow as tf
+        return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                              inter_op_parallelism_threads=inter_op_threads,
+                              allow_soft_placement=True)
 
     @staticmethod
     def create_category_index(path_labels_map):
-        num_classes = 6
+        from object_detection.utils import label_map_util
         label_map = label_map_util.load_labelmap(path_labels_map)
+        num_classes = label_map_util.get_max_label_map_index(label_map)
         categories = label_map_util.convert_label_map_to_categories(label_map, max_num_classes=num_classes,
                                                                     use_display_name=True)
         return label_map_util.create_category_index(categories)
 
     @staticmethod
     def load_image_into_numpy_array(imageconvert):
-        (im_width, im_height) = imageconvert.size
         try:
-            return np.array(imageconvert.getdata()).reshape((im_height, im_width, 3)).astype(np.uint8)
+            return image_to_array(imageconvert)
         except ValueError:
             return np.array([])
 
@@ -86,18 +161,11 @@ class AnalyzeImages:
     def save_annotated_image(file_name, file_path, s3directory):
         return SaveImages.save_file_to_s3(file_path, file_name, s3directory, False, ACCESS_KEY, SECRET_KEY)
 
-    def get_database_instance(self):
-        if self._table is not None:
-            return self._table
-
-        session = boto3.Session(
-            aws_access_key_id=ACCESS_KEY,
-            aws_secret_access_key=SECRET_KEY,
-            region_name="us-east-1"
-        )
-        dynamodb = session.resource('dynamodb')
-        self._table = dynamodb.Table('ourcamera_v2')
-        return self._table
+    def get_result_writer(self):
+        with self._result_writer_lock:
+            if self._result_writer is None:
+                self._result_writer = ResultWriter(TABLE_NAME, ACCESS_KEY, SECRET_KEY, wal_path=self._result_wal)
+            return self._result_writer
 
     def log_traffic_result(self, traffic_result):
         if not save_to_aws:
@@ -110,98 +178,305 @@ class AnalyzeImages:
             'trucks': traffic_result.numberTrucks,
             'people': traffic_result.numberPeople
         }
-        self.get_database_instance().put_item(
-            Item=item
-        )
-        log.info(f"Put item={item} to table")
-
-    def processimages(self, path_images_dir, path_labels_map, save_directory):
-        detection_graph = AnalyzeImages.create_graph()
-        category_index = AnalyzeImages.create_category_index(path_labels_map)
-
-        with detection_graph.as_default():
-            with tf.Session(graph=detection_graph) as sess:
-                image_tensor = detection_graph.get_tensor_by_name('image_tensor:0')
-                detection_boxes = detection_graph.get_tensor_by_name('detection_boxes:0')
-                detection_scores = detection_graph.get_tensor_by_name('detection_scores:0')
-                detection_classes = detection_graph.get_tensor_by_name('detection_classes:0')
-                num_detections = detection_graph.get_tensor_by_name('num_detections:0')
-
-                while True:
-                    for img_fname in os.listdir(path_images_dir):
-                        start_time = time.time()
-
-                        timestamp, location_id = SaveImages.get_timestamp_and_location_id(img_fname)
-                        img_fpath = os.path.join(path_images_dir, img_fname)
-
-                        if timestamp == 0 and os.path.exists(img_fpath):
-                            os.remove(img_fpath)
-                            continue
-
-                        num_cars = 0
-                        num_trucks = 0
-                        num_people = 0
-
-                        try:
-                            with Image.open(img_fpath) as image:
-                                image_np = AnalyzeImages.load_image_into_numpy_array(image)
-                        except IOError:
-                            log.exception(f"Issue opening file={img_fpath}")
-                            os.remove(img_fpath)
-                            continue
-
-                        if image_np.size == 0:
-                            log.info("Skipping image=" + img_fname)
-                            os.remove(img_fpath)
-                            continue
-
-                        # Expand dimensions since the model expects images to have shape: [1, None, None, 3]
-                        image_np_expanded = np.expand_dims(image_np, axis=0)
-                        # Actual detection.
-                        (boxes, scores, classes, num) = sess.run(
-                            [detection_boxes, detection_scores, detection_classes, num_detections],
-                            feed_dict={image_tensor: image_np_expanded})
-
-                        scores = np.squeeze(scores)
-                        boxes = np.squeeze(boxes)
-                        for i in range(boxes.shape[0]):
-                            if scores[i] > DETECTION_LIMIT:
-                                classes = np.squeeze(classes).astype(np.int32)
-                                if classes[i] in category_index.keys():
-                                    class_name = category_index[classes[i]]['name']
-                                    if class_name == 'car':
-                                        num_cars = num_cars + 1
-                                    elif class_name == 'truck':
-                                        num_trucks = num_trucks + 1
-                                    elif class_name == 'pedestrian':
-                                        num_people += 1
-
-                        traffic_results = TrafficResult()
-                        traffic_results.numberCars = num_cars
-                        traffic_results.numberTrucks = num_trucks
-                        traffic_results.timestamp = timestamp
-                        traffic_results.cameraLocationId = location_id
-                        traffic_results.numberPeople = num_people
-                        self.log_traffic_result(traffic_results)
-
-                        log.debug(f"Process Time={str(time.time() - start_time)}")
-                        if random.randint(0, 100) == 1:
-                            # Visualization of the results of a detection.
-                            vis_util.visualize_boxes_and_labels_on_image_array(
-                                image_np,
-                                np.squeeze(boxes),
-                                np.squeeze(classes).astype(np.int32),
-                                np.squeeze(scores),
-                                category_index,
-                                min_score_thresh=0.4,
-                                use_normalized_coordinates=True,
-                                line_thickness=2)
-
-                            save_img_fpath = os.path.join(save_directory, img_fname)
-                            Image.fromarray(image_np).save(save_img_fpath)
-                            log.info(f"Saved image to path={save_img_fpath}")
-                            AnalyzeImages.save_annotated_image(img_fname, save_img_fpath, "annotated")
-                        os.remove(img_fpath)
+        if traffic_result.counts is not None:
+            item['counts'] = traffic_result.counts
+        if traffic_result.regions is not None:
+            item['regions'] = traffic_result.regions
+        if traffic_result.inferredByReuse:
+            item['inferredByReuse'] = True
+            item['reusedFromTimestamp'] = str(traffic_result.reusedFromTimestamp)
+        self.get_result_writer().put(item)
+        log.debug(f"Queued item={item} for table")
+
+    @staticmethod
+    def is_ring_frame(frame):
+        # framering is only imported with -frame_ring, as it needs Python 3.8+; without it there are no ring frames
+        framering = sys.modules.get('framering')
+        return framering is not None and isinstance(frame, framering.RingFrame)
+
+    @staticmethod
+    def open_frame(frame):
+        """File path or file object to decode a spooled or shared-memory frame from"""
+        if AnalyzeImages.is_ring_frame(frame):
+            return frame.open()
+        if isinstance(frame, ArchivedFrame):
+            return frame.open()
+        return frame.path
+
+    @staticmethod
+    def finish_frame(frame):
+        """Remove a spooled frame, or free the slot of a shared-memory frame, once it has been handled
+
+        Archived frames are left in place.
+        """
+        if isinstance(frame, ArchivedFrame):
+            return
+        if AnalyzeImages.is_ring_frame(frame):
+            frame.release()
+        elif os.path.exists(frame.path):
+            os.remove(frame.path)
+
+    @staticmethod
+    def remove_dropped_frame(frame, reason):
+        if os.path.exists(frame.path):
+            os.remove(frame.path)
+
+    def processimages(self, path_images_dir, path_labels_map, save_directory, frame_queue=None, frame_ring=None,
+                      decode_pool=None, batcher=None, num_sink_workers=4, stop_event=None, frame_filter=None,
+                      frame_source=None):
+        if frame_queue is None:
+            frame_queue = FreshFrameQueue(on_drop=AnalyzeImages.remove_dropped_frame)
+        if decode_pool is None:
+            decode_pool = DecodePool(open_frame=AnalyzeImages.open_frame)
+        if batcher is None:
+            batcher = MicroBatcher(max_batch_size=1)
+        stop_event = stop_event or threading.Event()
+        category_index = self.create_category_index(path_labels_map)
+        if frame_source is None:
+            # Frames handed over in shared memory are the freshest, the spool only holds the overflow
+            frame_source = FrameSource(frame_queue, path_images_dir, frame_ring, RESCAN_INTERVAL_SECS,
+                                       accept=frame_filter)
+        batch_stats = BatchStats()
+        if path_images_dir:
+            watch_spool(path_images_dir)
+        self._annotation_renderer = AnnotationRenderer(
+            lambda job: self.render_annotation(job, category_index, save_directory), self._annotation_queue_size)
+
+        with self.create_detector() as detector:
+            self._startup.mark('load_model')
+            if self._profiling is not None:
+                detector.tracer = self._profiling.tracer
+            if self._warm_up:
+                # Pays for the optimization and allocations of the first run before there are frames waiting
+                detector.warm_up(batch_size=batcher.max_batch_size)
+                self._startup.mark('warm_up')
+            pipeline = self.create_pipeline(detector, frame_source, decode_pool, batcher, batch_stats, category_index,
+                                            num_sink_workers)
+            pipeline.start()
+            try:
+                while not stop_event.wait(REPORT_INTERVAL_SECS):
+                    log.info(f"Pipeline stages: {pipeline.report()} in flight={frame_source.in_flight}")
+                    log.info(f"Inference with {detector.name}: {batch_stats.summary()}")
+                    batch_stats.reset()
+                    log.info(f"Frames dropped so far: {frame_queue.drop_summary()}")
+                    if self._motion_gate is not None:
+                        log.info(f"Motion gate at threshold={self._motion_gate.threshold}: "
+                                 f"{self._motion_gate.report()}")
+                    if self._result_writer is not None:
+                        log.info(f"DynamoDB writes: {self._result_writer.report()}")
+                    log.info(f"Annotations: {self._annotation_renderer.report()}")
+            finally:
+                pipeline.stop()
+                self._annotation_renderer.close()
+                self._annotation_renderer = None
+                if self._detection_store is not None:
+                    self._detection_store.close()
+                if self._result_writer is not None:
+                    self._result_writer.close()
+                    log.info(f"DynamoDB writes: {self._result_writer.report()}")
+
+    def backfill(self, inputs, path_labels_map, save_directory, checkpoint_path=None, decode_pool=None, batcher=None,
+                 num_sink_workers=4, frame_filter=None):
+        """Analyze the archived frames of inputs in timestamp order, leaving them in place, and return the summary"""
+        frames = collect_frames(inputs, accept=frame_filter)
+        frame_source = BackfillSource(frames, checkpoint_path)
+        log.info(f"Backfilling {len(frames) - frame_source.resumed_from} of {len(frames)} frames")
+        try:
+            self.processimages(None, path_labels_map, save_directory, decode_pool=decode_pool, batcher=batcher,
+                               num_sink_workers=num_sink_workers, stop_event=frame_source.finished,
+                               frame_source=frame_source)
+        finally:
+            frame_source.close()
+        summary = frame_source.summary()
+        log.info(f"Backfill done: {summary}")
+        return summary
+
+    def create_pipeline(self, detector, frame_source, decode_pool, batcher, batch_stats, category_index,
+                        num_sink_workers=4):
+        """Reader -> decode workers -> inference -> result sink workers, connected by bounded queues"""
+
+        def release(item):
+            # The frame of an item a stage failed on is not analyzed: free its file or slot and let the source know
+            frame = item[0] if isinstance(item, tuple) else item
+            AnalyzeImages.finish_frame(frame)
+            frame_source.done(frame, failed=True)
+
+        def decode(frame):
+            started = time.monotonic()
+            try:
+                image_np = decode_pool.decode(frame)
+            except OSError:
+                # E.g. an archived frame whose shard was removed since the backfill collected it
+                log.exception(f"Could not read frame={frame}")
+                record_stage(STAGE_DECODE, time.monotonic() - started, outcome=OUTCOME_ERROR)
+                CAMERA_FRAMES.labels(STAGE_DECODE, frame.location_id, OUTCOME_ERROR).inc()
+                release(frame)
+                return None
+            image_np = self.crop_to_regions(frame, image_np)
+            if AnalyzeImages.skip_empty_image(frame, image_np):
+                record_stage(STAGE_DECODE, time.monotonic() - started, outcome='empty')
+                CAMERA_FRAMES.labels(STAGE_DECODE, frame.location_id, 'empty').inc()
+                frame_source.done(frame)
+                return None
+            record_stage(STAGE_DECODE, time.monotonic() - started)
+            reused = None
+            if self._motion_gate is not None:
+                reused = self._motion_gate.check(frame.location_id, image_np, frame.timestamp)
+            return [(frame, image_np, reused)]
+
+        def infer_or_pass(item):
+            frame, image_np, reused = item
+            if reused is not None:
+                # The frame skips the detector, its result is carried forward by the sink
+                return [(frame, image_np, None, reused)] + infer(batcher.ready())
+            return infer(batcher.add(frame, image_np))
+
+        def infer(batches):
+            detected = []
+            for batch in batches:
+                started = time.monotonic()
+                try:
+                    detections = split_detections(*detector.detect(batch.stacked()))
+                except Exception:
+                    log.exception(f"Detection failed for frames={batch.frames}")
+                    record_stage(STAGE_INFERENCE, time.monotonic() - started, len(batch.frames), OUTCOME_ERROR)
+                    for frame in batch.frames:
+                        CAMERA_FRAMES.labels(STAGE_INFERENCE, frame.location_id, OUTCOME_ERROR).inc()
+                        release(frame)
+                    continue
+                record_stage(STAGE_INFERENCE, time.monotonic() - started, len(batch.frames))
+                batch_stats.record(batch)
+                detected.extend((frame, image_np, frame_detections, None)
+                                for frame, image_np, frame_detections in zip(batch.frames, batch.images, detections))
+            return detected
+
+        def sink(item):
+            frame, image_np, detections, reused = item
+            started = time.monotonic()
+            failed = False
+            try:
+                if reused is not None:
+                    self.reuse_traffic_result(frame, reused)
+                else:
+                    result = self.handle_detections(frame, image_np, detections, category_index)
+                    if self._motion_gate is not None:
+                        self._motion_gate.record(frame.location_id, frame.timestamp, result)
+            except Exception:
+                log.exception(f"Could not handle detections of frame={frame}")
+                record_stage(STAGE_POSTPROCESS, time.monotonic() - started, outcome=OUTCOME_ERROR)
+                CAMERA_FRAMES.labels(STAGE_POSTPROCESS, frame.location_id, OUTCOME_ERROR).inc()
+                AnalyzeImages.finish_frame(frame)
+                failed = True
+            else:
+                record_stage(STAGE_POSTPROCESS, time.monotonic() - started)
+                outcome = 'reused' if reused is not None else OUTCOME_OK
+                CAMERA_FRAMES.labels(STAGE_POSTPROCESS, frame.location_id, outcome).inc()
+                if self._startup.mark('first_result'):
+                    startup = self._startup.report()
+                    log.info(f"Startup phases in seconds: {startup}")
+                    for phase, secs in startup.items():
+                        STARTUP_SECONDS.labels(phase).set(secs)
+            finally:
+                frame_source.done(frame, failed=failed)
+
+        # Frames still waiting in the batcher when the pipeline stops are left in the spool or the ring, and are
+        # picked up again on the next start
+        return Pipeline(frame_source.next, [
+            Stage('decode', decode, num_workers=decode_pool.num_workers, on_error=release),
+            Stage('inference', infer_or_pass, flush=lambda: infer(batcher.ready()),
+                  max_queue_size=2 * batcher.max_batch_size, on_error=release),
+            Stage('sink', sink, num_workers=num_sink_workers),
+        ], idle_secs=IDLE_SLEEP_SECS)
+
+    @staticmethod
+    def render_annotation(job, category_index, save_directory):
+        """Draw the detections on a copy of the frame, save it and queue its upload to annotated/"""
+        from object_detection.utils import visualization_utils as vis_util
+        # Decoded frames are read-only views of the JPEG decoder output, draw on a copy
+        image_np = np.array(job.image_np)
+        # Visualization of the results of a detection.
+        vis_util.visualize_boxes_and_labels_on_image_array(
+            image_np,
+            np.squeeze(job.boxes),
+            np.squeeze(job.classes).astype(np.int32),
+            np.squeeze(job.scores),
+            category_index,
+            min_score_thresh=0.4,
+            use_normalized_coordinates=True,
+            line_thickness=2)
+
+        save_img_fpath = os.path.join(save_directory, job.file_name)
+        Image.fromarray(image_np).save(save_img_fpath)
+        log.info(f"Saved image to path={save_img_fpath}")
+        AnalyzeImages.save_annotated_image(job.file_name, save_img_fpath, "annotated")
+
+    @staticmethod
+    def skip_empty_image(frame, image_np):
+        if image_np.size != 0:
+            return False
+        log.info("Skipping image=" + frame.file_name)
+        AnalyzeImages.finish_frame(frame)
+        return True
+
+    def camera_regions(self, frame):
+        return self._regions.get(frame.location_id) if self._regions is not None else None
+
+    def crop_to_regions(self, frame, image_np):
+        """Only the part of the frame covering the regions of interest of its camera, if it has any"""
+        camera = self.camera_regions(frame)
+        return camera.crop(image_np) if camera is not None else image_np
+
+    def get_counter(self, category_index):
+        if self._counter is None:
+            self._counter = DetectionCounter(category_index, DETECTION_LIMIT, self._class_thresholds)
+        return self._counter
+
+    def reuse_traffic_result(self, frame, previous):
+        """Log the counts of an earlier frame of the same camera for a frame that skipped the detector"""
+        traffic_results = TrafficResult()
+        traffic_results.numberCars = previous.numberCars
+        traffic_results.numberTrucks = previous.numberTrucks
+        traffic_results.numberPeople = previous.numberPeople
+        traffic_results.counts = previous.counts
+        traffic_results.regions = previous.regions
+        traffic_results.timestamp = frame.timestamp
+        traffic_results.cameraLocationId = frame.location_id
+        traffic_results.inferredByReuse = True
+        traffic_results.reusedFromTimestamp = previous.timestamp
+        self.log_traffic_result(traffic_results)
+        if self._detection_store is not None:
+            self._detection_store.add_reused(frame.location_id, frame.timestamp, previous.timestamp)
+        AnalyzeImages.finish_frame(frame)
+        return traffic_results
+
+    def handle_detections(self, frame, image_np, detections, category_index):
+        """Count the detections of one frame, log the TrafficResult and queue an annotated copy when sampled"""
+        (boxes, scores, classes, num) = detections
+        img_fname = frame.file_name
+
+        counter = self.get_counter(category_index)
+        counts = counter.as_dict(counter.count(scores, classes, num)[0])
+
+        traffic_results = TrafficResult()
+        traffic_results.numberCars = counts.get('car', 0)
+        traffic_results.numberTrucks = counts.get('truck', 0)
+        traffic_results.timestamp = frame.timestamp
+        traffic_results.cameraLocationId = frame.location_id
+        traffic_results.numberPeople = counts.get('pedestrian', 0)
+        traffic_results.counts = counts
+        camera = self.camera_regions(frame)
+        if camera is not None:
+            traffic_results.regions = camera.occupancy(boxes, scores, classes, num, image_np.shape, counter)
+        self.log_traffic_result(traffic_results)
+        if self._detection_store is not None:
+            offset = (camera.top, camera.left) if camera is not None else (0, 0)
+            self._detection_store.add(frame.location_id, frame.timestamp, boxes, scores, classes, num, image_np.shape,
+                                      offset)
+
+        if self._annotation_sampler.sample(frame.location_id, frame.timestamp):
+            self._annotation_renderer.submit(AnnotationJob(img_fname, image_np, boxes, classes, scores))
+        AnalyzeImages.finish_frame(frame)
+        return traffic_results
 
 
 if __name__ == '__main__':
@@ -217,7 +492,152 @@ if __name__ == '__main__':
     parser.add_argument('-save_directory', help='the directory you want to save the annotated images to')
     parser.add_argument('-access_key', help='aws access key')
     parser.add_argument('-secret_key', help='aws secret key')
+    parser.add_argument('-frame_policy', default='latest', choices=POLICIES,
+                        help='how to shed frames of a camera that falls behind')
+    parser.add_argument('-max_frames_per_camera', type=int, default=2,
+                        help='pending frames kept per camera before the frame policy drops some')
+    parser.add_argument('-max_frame_age_secs', type=int, default=300,
+                        help='frames older than this are dropped without analysis, 0 to keep all')
+    parser.add_argument('-frame_ring', help='shared memory ring name to read frames from, as FRAME_RING of '
+                                            'saveimages; needs Python 3.8+')
+    parser.add_argument('-decode_workers', type=int, default=4, help='threads decoding frames ahead of inference')
+    parser.add_argument('-sink_workers', type=int, default=4,
+                        help='threads writing results to DynamoDB and uploading annotated frames')
+    parser.add_argument('-decode_max_size', help='WIDTHxHEIGHT to decode JPEGs at reduced resolution, when the '
+                                                 'model input is smaller than the frames')
+    parser.add_argument('-batch_size', type=int,
+                        help=f'frames of the same resolution run through the model in one call, 1 to disable '
+                             f'batching;\ndefaults to 1, or {BACKFILL_BATCH_SIZE} with -backfill')
+    parser.add_argument('-batch_max_wait_secs', type=float, default=0.5,
+                        help='longest a frame waits for its batch to fill before the batch runs anyway')
+    parser.add_argument('-model', default=DEFAULT_MODEL,
+                        help=f'detector model, one of {", ".join(sorted(MODELS))}\n'
+                             f'or <backend>:<model path>[:<config path>] with backend tf, onnx or opencv')
+    parser.add_argument('-class_thresholds',
+                        help=f'per-class score thresholds as "car=0.5,Blocking Bike Lane=0.3", '
+                             f'other classes use {DETECTION_LIMIT}')
+    parser.add_argument('-regions', help='JSON file of the regions of interest per cameraLocationId; cameras with '
+                                         'regions are analyzed on the crop covering them')
+    parser.add_argument('-motion_threshold', type=float, default=0,
+                        help='share of changed thumbnail pixels below which a frame reuses the counts of the last\n'
+                             'analyzed frame of its camera instead of running the detector, 0 to analyze every frame')
+    parser.add_argument('-motion_max_reuse_secs', type=int, default=300,
+                        help='longest the counts of an analyzed frame are reused for')
+    parser.add_argument('-detection_store',
+                        help='directory to keep the raw detections of every frame in, for recountdetections.py')
+    parser.add_argument('-detection_floor', type=float, default=DEFAULT_SCORE_FLOOR,
+                        help='lowest score of the detections kept in -detection_store')
+    parser.add_argument('-result_wal',
+                        help='write-ahead log of the results not yet written to DynamoDB, replayed on startup')
+    parser.add_argument('-annotate_every_secs', type=float, default=DEFAULT_INTERVAL_SECS,
+                        help='save an annotated copy of the first frame of each camera in every window of this\n'
+                             'many seconds, 0 to save none')
+    parser.add_argument('-annotate_cameras',
+                        help='per-camera annotation windows as "368=60,932=0", overriding -annotate_every_secs')
+    parser.add_argument('-annotate_queue_size', type=int, default=16,
+                        help='annotated frames waiting to be rendered before the oldest is dropped')
+    parser.add_argument('-backfill', nargs='+', metavar='PATH',
+                        help='analyze the frames of these directories, file lists or shards in timestamp order\n'
+                             'without deleting them, then exit')
+    parser.add_argument('-backfill_checkpoint',
+                        help='file to checkpoint -backfill progress in, to resume after a crash')
+    parser.add_argument('-graph_cache', default=GRAPH_CACHE_DIRECTORY,
+                        help='directory of optimized model graphs, built on the first start of each model;\n'
+                             'empty to load the model as is')
+    parser.add_argument('-skip_warmup', action='store_true',
+                        help='take frames without running a blank batch through the model first')
+    parser.add_argument('-profile_dir', default=PROFILE_DIRECTORY,
+                        help='directory for the step traces and profiles taken on SIGUSR1 (trace the next '
+                             '-trace_steps session runs, tf backend only) and SIGUSR2 (profile for -profile_secs)')
+    parser.add_argument('-profile_control',
+                        help='control file to request them by writing "trace [steps]" or "profile [secs]" to it, '
+                             'suffixed by the worker number with -workers')
+    parser.add_argument('-trace_steps', type=int, default=DEFAULT_TRACE_STEPS,
+                        help='session runs to trace per request')
+    parser.add_argument('-profile_secs', type=float, default=DEFAULT_PROFILE_SECS,
+                        help='seconds to sample the Python stacks for per request')
+    parser.add_argument('-metrics_port', type=int, default=METRICS_PORT,
+                        help='port to serve Prometheus metrics on at /metrics, the next ports for the next -workers, '
+                             '0 to not serve them')
+    parser.add_argument('-metrics_host', default='127.0.0.1', help='address to serve the metrics on')
+    parser.add_argument('-device', default=GPU_DEVICE, help=f'device to place the model on, {CPU_DEVICE} on CPU hosts')
+    parser.add_argument('-workers', type=int, default=1,
+                        help='inference processes, each analyzing the frames of its share of the cameras')
+    parser.add_argument('-intra_op_threads', type=int,
+                        help='threads per operation in each worker, defaults to the cores divided by the workers')
+    parser.add_argument('-inter_op_threads', type=int,
+                        help='operations run in parallel in each worker, defaults to 1 with -workers')
+    parser.add_argument('-pin_cores', action='store_true', help='pin each worker to its own intra_op_threads cores')
     args = parser.parse_args()
+    if args.workers > 1 and args.frame_ring:
+        parser.error('-frame_ring has a single consumer and cannot be combined with -workers')
+    if args.backfill and args.frame_ring:
+        parser.error('-backfill reads archived frames and cannot be combined with -frame_ring')
+    if args.regions and args.decode_max_size:
+        parser.error('-regions are in full resolution frame pixels and cannot be combined with -decode_max_size')
     ACCESS_KEY = args.access_key
     SECRET_KEY = args.secret_key
-    AnalyzeImages().processimages(args.path_images, args.path_labels_map, args.save_directory)
+    max_size = tuple(int(v) for v in args.decode_max_size.split('x')) if args.decode_max_size else None
+    regions = RegionConfig.load(args.regions) if args.regions else None
+
+    def run_worker(shard=None, intra_op_threads=0):
+        if args.metrics_port:
+            port = args.metrics_port + (shard.index if shard is not None else 0)
+            try:
+                start_http_server(port, args.metrics_host)
+            except OSError:
+                # Metrics are not worth a worker that cannot start
+                log.exception(f"Could not serve metrics on port={port}")
+        queue = FreshFrameQueue(policy=args.frame_policy,
+                                max_frames_per_camera=args.max_frames_per_camera,
+                                max_age_secs=args.max_frame_age_secs,
+                                on_drop=AnalyzeImages.remove_dropped_frame)
+        ring = None
+        if args.frame_ring:
+            from framering import FrameRing
+            ring = FrameRing.open(args.frame_ring)
+        decoder = DecodePool(num_workers=args.decode_workers, max_size=max_size, open_frame=AnalyzeImages.open_frame)
+        # Backfill frames are not waited for, bigger batches only add throughput
+        batch_size = args.batch_size or (BACKFILL_BATCH_SIZE if args.backfill else 1)
+        batcher = MicroBatcher(batch_size, args.batch_max_wait_secs)
+        inter_op_threads = args.inter_op_threads if args.inter_op_threads is not None else int(args.workers > 1)
+        config = AnalyzeImages.create_session_config(intra_op_threads, inter_op_threads)
+        gate = MotionGate(args.motion_threshold, max_reuse_secs=args.motion_max_reuse_secs) \
+            if args.motion_threshold else None
+        store = DetectionStoreWriter(args.detection_store, args.detection_floor) if args.detection_store else None
+        # Every worker needs a log of its own
+        wal = f"{args.result_wal}.{shard.index}" if args.result_wal and shard is not None else args.result_wal
+        sampler = CameraSampler(args.annotate_every_secs, parse_intervals(args.annotate_cameras))
+        control = f"{args.profile_control}.{shard.index}" \
+            if args.profile_control and shard is not None else args.profile_control
+        profiling = ProfilingControl(args.profile_dir, control, args.trace_steps, args.profile_secs)
+        profiling.install_signal_handlers()
+        profiling.start()
+        analyzer = AnalyzeImages(args.device, config, args.model, intra_op_threads,
+                                 parse_thresholds(args.class_thresholds), regions, gate, store, result_wal=wal,
+                                 annotation_sampler=sampler, annotation_queue_size=args.annotate_queue_size,
+                                 graph_cache=args.graph_cache or None, warm_up=not args.skip_warmup,
+                                 profiling=profiling)
+        if args.backfill:
+            checkpoint = args.backfill_checkpoint
+            if checkpoint and shard is not None:
+                checkpoint = f"{checkpoint}.{shard.index}"
+            summary = analyzer.backfill(args.backfill, args.path_labels_map, args.save_directory, checkpoint, decoder,
+                                        batcher, args.sink_workers, frame_filter=shard)
+            print(json.dumps(summary))
+            return
+        analyzer.processimages(args.path_images, args.path_labels_map, args.save_directory, queue, ring, decoder,
+                               batcher, args.sink_workers, frame_filter=shard)
+
+    if args.workers > 1:
+        # Every worker handles the profiling signals itself
+        ignore_signals()
+        workers = InferenceWorkers(args.workers, run_worker, args.intra_op_threads, args.pin_cores)
+        workers.start()
+        try:
+            # Backfill workers exit once their frames are done, daemon workers never do
+            workers.join(until_done=bool(args.backfill))
+        finally:
+            workers.stop()
+    else:
+        run_worker(intra_op_threads=args.intra_op_threads or 0)
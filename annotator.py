@@ -0,0 +1,176 @@
+r"""Background rendering of annotated frames
+
+Drawing the detection boxes on a frame, encoding it and uploading it to annotated/ took a result sink worker away
+from the pipeline for far longer than handling the frame's results did, and it happened to a random frame in a
+hundred, so some cameras went for hours without an annotated frame.
+
+CameraSampler picks the frames to annotate deterministically: the first frame of each camera in every window of
+interval_secs (by frame timestamp), so every camera gets the same, predictable coverage whatever its frame rate.
+Intervals can be set per camera, and an interval of 0 turns annotation off for a camera.
+
+AnnotationRenderer hands the sampled frames to background threads through a bounded queue. When the queue is
+full the oldest job is dropped, so a slow upload never holds up the pipeline; drops are counted.
+
+
+Example usage:
+    sampler = CameraSampler(interval_secs=600, overrides=parse_intervals("368=60,932=0"))
+    renderer = AnnotationRenderer(render=save_annotated_frame)
+    if sampler.sample(frame.location_id, frame.timestamp):
+        renderer.submit(AnnotationJob(frame.file_name, image_np, boxes, classes, scores))
+    renderer.close()
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from metrics import OUTCOME_ERROR, OUTCOME_OK, REGISTRY, record_stage
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+DEFAULT_INTERVAL_SECS = 600
+STAGE_ANNOTATION = 'annotation'
+QUEUE_DEPTH = REGISTRY.gauge('ourcamera_annotation_queue_depth', 'Annotation jobs waiting to be rendered')
+
+
+def parse_intervals(spec):
+    """cameraLocationId to sampling interval in seconds from "locationId=secs,locationId=secs" """
+    intervals = {}
+    for part in filter(None, (p.strip() for p in (spec or '').split(','))):
+        location_id, _, secs = part.partition('=')
+        if not secs:
+            raise ValueError(f"Expected <cameraLocationId>=<seconds>, got {part}")
+        intervals[int(location_id)] = float(secs)
+    return intervals
+
+
+class CameraSampler:
+
+    def __init__(self, interval_secs=DEFAULT_INTERVAL_SECS, overrides=None) -> None:
+        super().__init__()
+
+        self.interval_secs = interval_secs
+        self._overrides = overrides or {}
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def sample(self, location_id, timestamp):
+        """Whether this frame is the first of its camera in its sampling window"""
+        interval = self._overrides.get(int(location_id), self.interval_secs)
+        if interval <= 0:
+            return False
+        window = int(timestamp // interval)
+        with self._lock:
+            if window <= self._windows.get(location_id, -1):
+                return False
+            self._windows[location_id] = window
+            return True
+
+
+class AnnotationJob:
+
+    def __init__(self, file_name, image_np, boxes, classes, scores) -> None:
+        super().__init__()
+
+        self.file_name = file_name
+        self.image_np = image_np
+        self.boxes = boxes
+        self.classes = classes
+        self.scores = scores
+
+    def __repr__(self):
+        return f"AnnotationJob({self.file_name})"
+
+
+class AnnotationRenderer:
+    """Runs render(job) in background threads over a bounded queue that drops its oldest job when full"""
+
+    def __init__(self, render, max_queue_size=16, num_workers=1) -> None:
+        super().__init__()
+
+        self._render = render
+        self._jobs = collections.deque()
+        self._max_queue_size = max_queue_size
+        self._condition = threading.Condition()
+        self._closed = False
+        self._busy = 0
+        self.submitted = 0
+        self.rendered = 0
+        self.dropped = 0
+        self.failed = 0
+        QUEUE_DEPTH.set_function(self.__len__)
+        self._workers = [threading.Thread(target=self._work, name=f'annotator-{i}', daemon=True)
+                         for i in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._jobs)
+
+    def submit(self, job):
+        """Queue a job without blocking; returns the job that was dropped to make room, if any"""
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("AnnotationRenderer is closed")
+            dropped = None
+            if len(self._jobs) >= self._max_queue_size:
+                dropped = self._jobs.popleft()
+                self.dropped += 1
+            self._jobs.append(job)
+            self.submitted += 1
+            self._condition.notify()
+        if dropped is not None:
+            log.debug(f"Annotation queue full, dropped job={dropped}")
+        return dropped
+
+    def join(self):
+        """Block until every queued job has been rendered"""
+        with self._condition:
+            self._condition.wait_for(lambda: not self._jobs and not self._busy)
+
+    def close(self):
+        """Render the queued jobs, then stop the workers"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def report(self):
+        with self._condition:
+            return {
+                'submitted': self.submitted,
+                'rendered': self.rendered,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'queue_depth': len(self._jobs),
+            }
+
+    def _work(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._jobs or self._closed)
+                if not self._jobs:
+                    return
+                job = self._jobs.popleft()
+                self._busy += 1
+            started = time.monotonic()
+            try:
+                self._render(job)
+                rendered = True
+            except Exception:
+                log.exception(f"Could not render annotation job={job}")
+                rendered = False
+            outcome = OUTCOME_OK if rendered else OUTCOME_ERROR
+            record_stage(STAGE_ANNOTATION, time.monotonic() - started, outcome=outcome)
+            with self._condition:
+                self._busy -= 1
+                if rendered:
+                    self.rendered += 1
+                else:
+                    self.failed += 1
+                self._condition.notify_all()
+
@@ -0,0 +1,90 @@
+import threading
+import unittest
+from annotator import *
+
+
+class TestCameraSampler(unittest.TestCase):
+
+    def test_samples_the_first_frame_of_each_camera_per_window(self):
+        sampler = CameraSampler(interval_secs=60)
+        timestamps = [0, 10, 59, 60, 61, 130, 135]
+        assert [sampler.sample(368, t) for t in timestamps] == [True, False, False, True, False, True, False]
+        # Every camera gets its own windows
+        assert sampler.sample(932, 10)
+        assert not sampler.sample(932, 20)
+
+    def test_sampling_is_reproducible(self):
+        timestamps = [(368, t) for t in range(0, 3600, 7)] + [(932, t) for t in range(0, 3600, 13)]
+        first = CameraSampler(interval_secs=300)
+        second = CameraSampler(interval_secs=300)
+        assert [first.sample(*f) for f in timestamps] == [second.sample(*f) for f in timestamps]
+        third = CameraSampler(interval_secs=300)
+        assert sum(third.sample(*f) for f in timestamps) == 24
+
+    def test_per_camera_intervals(self):
+        sampler = CameraSampler(interval_secs=600, overrides=parse_intervals("368=60, 932=0"))
+        assert sum(sampler.sample(368, t) for t in range(0, 600, 10)) == 10
+        assert sum(sampler.sample(932, t) for t in range(0, 600, 10)) == 0
+        assert sum(sampler.sample(529, t) for t in range(0, 600, 10)) == 1
+
+    def test_parse_intervals(self):
+        assert parse_intervals(None) == {}
+        assert parse_intervals("368=60,932=0.5") == {368: 60.0, 932: 0.5}
+        with self.assertRaises(ValueError):
+            parse_intervals("368")
+
+
+class TestAnnotationRenderer(unittest.TestCase):
+
+    def test_renders_jobs_in_the_background(self):
+        rendered = []
+        renderer = AnnotationRenderer(rendered.append, max_queue_size=4)
+        for job in range(3):
+            renderer.submit(job)
+        renderer.join()
+        assert rendered == [0, 1, 2]
+        renderer.close()
+        assert renderer.report() == {'submitted': 3, 'rendered': 3, 'dropped': 0, 'failed': 0, 'queue_depth': 0}
+
+    def test_drops_the_oldest_job_instead_of_blocking(self):
+        release = threading.Event()
+        started = threading.Event()
+        rendered = []
+
+        def render(job):
+            started.set()
+            release.wait(5)
+            rendered.append(job)
+
+        renderer = AnnotationRenderer(render, max_queue_size=2)
+        renderer.submit('busy')
+        started.wait(5)
+        assert renderer.submit('a') is None
+        assert renderer.submit('b') is None
+        assert renderer.submit('c') == 'a'
+        assert len(renderer) == 2
+        release.set()
+        renderer.close()
+        assert rendered == ['busy', 'b', 'c']
+        assert renderer.dropped == 1
+
+    def test_counts_failed_jobs_and_keeps_going(self):
+        def render(job):
+            if job == 'bad':
+                raise IOError("disk full")
+
+        renderer = AnnotationRenderer(render)
+        renderer.submit('bad')
+        renderer.submit('good')
+        renderer.close()
+        assert renderer.failed == 1
+        assert renderer.rendered == 1
+        with self.assertRaises(RuntimeError):
+            renderer.submit('late')
+
+    def test_job_repr_leaves_out_the_image(self):
+        assert repr(AnnotationJob("261_368_1.jpg", [[0]], None, None, None)) == "AnnotationJob(261_368_1.jpg)"
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+r"""Per-camera archive shards of raw frames
+
+Uploading every frame as its own object under raw/ costs one PUT per frame to archive and one GET per frame to read
+back. Instead, frames are appended to one shard per camera per time window (an hour by default), and each finished
+shard is uploaded once to
+    shards/<year>/<month>/<day>/<hour>/<cameraId>_<locationId>_<windowStart>-<part>.tar
+
+The part is the time the shard was opened, kept unique within the process. A frame that arrives after the shard of
+its window was flushed opens a new part of the window, so it never overwrites the shard already uploaded.
+
+A shard is a plain tar file, so standard tools can unpack it. Its last member, index.json, maps each frame name
+to its [offset, size] inside the shard. The offset and size of the index itself are stored as S3 object metadata.
+A reader can therefore fetch a single frame with two small ranged GETs after one HEAD, or stream a whole shard with
+one GET.
+
+Frames are appended to the local shard file as they arrive, so a shard costs no open file handle and no memory
+beyond its index. Unfinished shards left behind by a crash are recovered on startup by rescanning their tar headers.
+
+
+Example usage:
+    archiver = ShardArchiver(SaveImages.get_uploader(), "/tmp/shards")
+    archiver.add_frame(jpeg_bytes, "261_368_1539560991.jpg")
+    ...
+    reader = ShardReader(boto3.client('s3'), BUCKET)
+    jpeg_bytes = reader.get_frame(shard_key, "261_368_1539560991.jpg")
+"""
+import datetime
+import json
+import logging
+import os
+import tarfile
+import threading
+import time
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+INDEX_NAME = 'index.json'
+INDEX_VERSION = 1
+PARTIAL_SUFFIX = '.part'
+CORRUPT_SUFFIX = '.corrupt'
+META_INDEX_OFFSET = 'index-offset'
+META_INDEX_SIZE = 'index-size'
+
+
+def shard_name(camera_id, location_id, window_start, part=None):
+    """File name of a shard; shards written before parts were introduced have none"""
+    suffix = '' if part is None else f"-{part}"
+    return f"{camera_id}_{location_id}_{window_start}{suffix}.tar"
+
+
+def parse_shard_name(file_name):
+    """(camera_id, location_id, window_start, part) from a shard file name, part being None for unnumbered shards"""
+    stem = file_name[:-len(PARTIAL_SUFFIX)] if file_name.endswith(PARTIAL_SUFFIX) else file_name
+    stem, _, part = stem[:-len('.tar')].partition('-')
+    camera_id, location_id, window_start = stem.split('_')
+    return camera_id, location_id, int(window_start), int(part) if part else None
+
+
+def padded_size(size):
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+class ShardWriter:
+    """Appends frames to a tar file on disk and keeps the offset index in memory"""
+
+    def __init__(self, path) -> None:
+        super().__init__()
+
+        self.path = path
+        self.index = {}
+        self.size = 0
+
+    def add(self, name, data, mtime):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime
+        header = info.tobuf(format=tarfile.USTAR_FORMAT)
+        with open(self.path, 'ab') as f:
+            f.write(header)
+            f.write(data)
+            f.write(tarfile.NUL * (padded_size(len(data)) - len(data)))
+        self.index[name] = [self.size + len(header), len(data)]
+        self.size += len(header) + padded_size(len(data))
+
+    def finish(self):
+        """Append the index and the end-of-archive marker, return the (offset, size) of the index"""
+        index = json.dumps({'version': INDEX_VERSION, 'frames': self.index}).encode()
+        self.add(INDEX_NAME, index, int(time.time()))
+        with open(self.path, 'ab') as f:
+            f.write(tarfile.NUL * (2 * tarfile.BLOCKSIZE))
+        return self.index.pop(INDEX_NAME)
+
+    @staticmethod
+    def recover(path):
+        """Rebuild the writer of a shard that was being written when the process stopped"""
+        writer = ShardWriter(path)
+        file_size = os.path.getsize(path)
+        try:
+            with tarfile.open(path, 'r:') as tar:
+                for member in tar:
+                    if member.offset_data + member.size > file_size:
+                        break
+                    writer.index[member.name] = [member.offset_data, member.size]
+                    writer.size = member.offset_data + padded_size(member.size)
+        except tarfile.ReadError:
+            log.exception(f"Shard={path} is damaged, keeping the {len(writer.index)} readable frames")
+        # Drop a half-written trailing frame so new frames are appended right after the last complete one
+        with open(path, 'r+b') as f:
+            f.truncate(writer.size)
+        return writer
+
+
+class ShardArchiver:
+    """Routes frames to the shard of their camera and time window and uploads shards once their window closes"""
+
+    def __init__(self, uploader, local_directory, window_secs=3600, s3_prefix='shards', flush_interval_secs=60):
+        self._uploader = uploader
+        self._local_directory = local_directory
+        self._window_secs = window_secs
+        self._s3_prefix = s3_prefix
+        self._writers = {}
+        self._last_part = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        os.makedirs(local_directory, exist_ok=True)
+        self._recover()
+        self._flusher = threading.Thread(target=self._flush_periodically, args=(flush_interval_secs,),
+                                         name='shard-flusher', daemon=True)
+        self._flusher.start()
+
+    @staticmethod
+    def parse_file_name(file_name):
+        """(camera_id, location_id, timestamp) from a "<cameraId>_<locationId>_<epoch>.jpg" frame name"""
+        camera_id, location_id, epoch = file_name[:-len('.jpg')].split('_')
+        return camera_id, location_id, int(epoch)
+
+    def s3_key(self, camera_id, location_id, window_start, part=None):
+        when = datetime.datetime.fromtimestamp(window_start)
+        return '/'.join([self._s3_prefix] + [str(v) for v in [when.year, when.month, when.day, when.hour]] +
+                        [shard_name(camera_id, location_id, window_start, part)])
+
+    def _next_part(self):
+        # Seconds since the epoch stay unique across restarts, the increment within a second
+        self._last_part = max(int(time.time()), self._last_part + 1)
+        return self._last_part
+
+    def add_frame(self, data, file_name):
+        camera_id, location_id, timestamp = ShardArchiver.parse_file_name(file_name)
+        window_start = timestamp - timestamp % self._window_secs
+        key = (camera_id, location_id, window_start)
+        with self._lock:
+            writer = self._writers.get(key)
+            if writer is None:
+                name = shard_name(camera_id, location_id, window_start, self._next_part())
+                writer = self._writers[key] = ShardWriter(os.path.join(self._local_directory, name + PARTIAL_SUFFIX))
+            writer.add(file_name, data, timestamp)
+
+    def flush(self, now=None, force=False):
+        """Finish and upload every shard whose window has closed, or every shard when force is set"""
+        now = time.time() if now is None else now
+        with self._lock:
+            done = [key for key in self._writers if force or key[2] + self._window_secs <= now]
+            writers = [self._writers.pop(key) for key in done]
+        for writer in writers:
+            self._upload(writer)
+        return len(writers)
+
+    def close(self):
+        self._closed.set()
+        self._flusher.join()
+        self.flush(force=True)
+
+    def _flush_periodically(self, interval_secs):
+        while not self._closed.wait(interval_secs):
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Could not flush archive shards")
+
+    def _upload(self, writer):
+        index_offset, index_size = writer.finish()
+        path = writer.path[:-len(PARTIAL_SUFFIX)]
+        os.replace(writer.path, path)
+        log.info(f"Uploading shard with {len(writer.index)} frames to {self.shard_key(path)}")
+        self._submit(path, index_offset, index_size)
+
+    def shard_key(self, path):
+        """S3 key of a local shard"""
+        return self.s3_key(*parse_shard_name(os.path.basename(path)))
+
+    def _submit(self, path, index_offset, index_size):
+        def remove():
+            os.remove(path)
+
+        self._uploader.submit_file(path, self.shard_key(path), on_success=remove, extra_args={
+            'ContentType': 'application/x-tar',
+            'Metadata': {META_INDEX_OFFSET: str(index_offset), META_INDEX_SIZE: str(index_size)}
+        })
+
+    def _recover(self):
+        """Resume shards that were still being written and re-submit finished shards that were never uploaded"""
+        for file_name in os.listdir(self._local_directory):
+            path = os.path.join(self._local_directory, file_name)
+            if file_name.endswith(PARTIAL_SUFFIX):
+                camera_id, location_id, window_start, part = parse_shard_name(file_name)
+                self._writers[(camera_id, location_id, window_start)] = ShardWriter.recover(path)
+                self._last_part = max(self._last_part, part or 0)
+                log.info(f"Recovered unfinished shard={path}")
+            elif file_name.endswith('.tar'):
+                try:
+                    with tarfile.open(path, 'r:') as tar:
+                        index = tar.getmember(INDEX_NAME)
+                except (tarfile.TarError, KeyError):
+                    # Left out of the archive, but kept for a look by hand instead of stopping the fetcher
+                    log.exception(f"Finished shard={path} is unreadable, moving it aside")
+                    os.replace(path, path + CORRUPT_SUFFIX)
+                    continue
+                self._submit(path, index.offset_data, index.size)
+                log.info(f"Re-submitted finished shard={path}")
+
+
+class ShardReader:
+    """Reads frames from shards in S3 by byte range, or streams whole shards"""
+
+    def __init__(self, client, bucket):
+        self._client = client
+        self._bucket = bucket
+
+    def _get_range(self, key, offset, size):
+        resp = self._client.get_object(Bucket=self._bucket, Key=key, Range=f"bytes={offset}-{offset + size - 1}")
+        return resp['Body'].read()
+
+    def read_index(self, key):
+        """Frame name to [offset, size] for a shard"""
+        metadata = self._client.head_object(Bucket=self._bucket, Key=key)['Metadata']
+        index = self._get_range(key, int(metadata[META_INDEX_OFFSET]), int(metadata[META_INDEX_SIZE]))
+        return json.loads(index)['frames']
+
+    def get_frame(self, key, name, index=None):
+        """Bytes of one frame; pass the index when reading several frames of the same shard"""
+        offset, size = (index or self.read_index(key))[name]
+        return self._get_range(key, offset, size)
+
+    def iter_frames(self, key):
+        """Yield (name, bytes) for every frame of a shard from a single streaming GET"""
+        body = self._client.get_object(Bucket=self._bucket, Key=key)['Body']
+        with tarfile.open(fileobj=body, mode='r|') as tar:
+            for member in tar:
+                if member.name != INDEX_NAME:
+                    yield member.name, tar.extractfile(member).read()
+
+    @staticmethod
+    def iter_local_frames(path):
+        """Yield (name, bytes) for every frame of a shard on disk"""
+        with tarfile.open(path, 'r:') as tar:
+            for member in tar:
+                if member.name != INDEX_NAME:
+                    yield member.name, tar.extractfile(member).read()
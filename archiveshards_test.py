@@ -0,0 +1,131 @@
+import shutil
+import tempfile
+import unittest
+import boto3
+from mock import MagicMock
+from archiveshards import *
+from s3uploader import S3Uploader
+
+try:
+    from moto import mock_aws
+except ImportError:
+    from moto import mock_s3 as mock_aws
+
+BUCKET = "test-bucket"
+
+
+class TestArchiveShards(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_shard_is_a_tar_with_an_offset_index(self):
+        path = os.path.join(self.directory, 'shard.tar')
+        writer = ShardWriter(path)
+        writer.add('1_2_100.jpg', b'a' * 700, 100)
+        writer.add('1_2_115.jpg', b'b' * 10, 115)
+        index_offset, index_size = writer.finish()
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        offset, size = writer.index['1_2_115.jpg']
+        assert content[offset:offset + size] == b'b' * 10
+        index = json.loads(content[index_offset:index_offset + index_size])
+        assert index['frames'] == writer.index
+        assert list(ShardReader.iter_local_frames(path)) == [('1_2_100.jpg', b'a' * 700), ('1_2_115.jpg', b'b' * 10)]
+
+    def test_recover_drops_half_written_frame(self):
+        path = os.path.join(self.directory, 'shard.tar.part')
+        writer = ShardWriter(path)
+        writer.add('1_2_100.jpg', b'a' * 700, 100)
+        writer.add('1_2_115.jpg', b'b' * 700, 115)
+        with open(path, 'r+b') as f:
+            f.truncate(writer.size - 600)
+
+        recovered = ShardWriter.recover(path)
+        assert list(recovered.index) == ['1_2_100.jpg']
+        recovered.add('1_2_130.jpg', b'c', 130)
+        recovered.finish()
+        assert [name for name, _ in ShardReader.iter_local_frames(path)] == ['1_2_100.jpg', '1_2_130.jpg']
+
+    def test_archiver_uploads_closed_windows_only(self):
+        uploader = MagicMock()
+        archiver = ShardArchiver(uploader, self.directory, window_secs=3600, flush_interval_secs=3600)
+        try:
+            archiver.add_frame(b'a', '1_2_3600.jpg')
+            archiver.add_frame(b'b', '1_2_3700.jpg')
+            archiver.add_frame(b'c', '1_2_7200.jpg')
+            assert archiver.flush(now=7300) == 1
+            path, s3_key = uploader.submit_file.call_args[0]
+            assert s3_key == archiver.shard_key(path)
+            assert parse_shard_name(os.path.basename(s3_key))[:3] == ('1', '2', 3600)
+            assert [name for name, _ in ShardReader.iter_local_frames(path)] == ['1_2_3600.jpg', '1_2_3700.jpg']
+        finally:
+            archiver.close()
+        assert uploader.submit_file.call_count == 2
+
+    def test_late_frame_goes_to_a_new_part_of_its_window(self):
+        uploader = MagicMock()
+        archiver = ShardArchiver(uploader, self.directory, window_secs=3600, flush_interval_secs=3600)
+        try:
+            archiver.add_frame(b'a', '1_2_3500.jpg')
+            archiver.add_frame(b'b', '1_2_3590.jpg')
+            assert archiver.flush(now=3601) == 1
+            archiver.add_frame(b'c', '1_2_3599.jpg')
+            assert archiver.flush(now=3700) == 1
+        finally:
+            archiver.close()
+        (first, first_key), (late, late_key) = [call[0] for call in uploader.submit_file.call_args_list]
+        assert first != late and first_key != late_key
+        assert parse_shard_name(os.path.basename(late))[:3] == ('1', '2', 0)
+        assert [name for name, _ in ShardReader.iter_local_frames(first)] == ['1_2_3500.jpg', '1_2_3590.jpg']
+        assert [name for name, _ in ShardReader.iter_local_frames(late)] == ['1_2_3599.jpg']
+
+    def test_parse_shard_name(self):
+        assert parse_shard_name(shard_name('1', '2', 3600, 1700000000) + PARTIAL_SUFFIX) == ('1', '2', 3600, 1700000000)
+        assert parse_shard_name('1_2_3600.tar') == ('1', '2', 3600, None)
+
+    def test_archiver_resumes_unfinished_shards_after_restart(self):
+        uploader = MagicMock()
+        ShardArchiver(uploader, self.directory, flush_interval_secs=3600).add_frame(b'a', '1_2_3600.jpg')
+        archiver = ShardArchiver(uploader, self.directory, flush_interval_secs=3600)
+        archiver.add_frame(b'b', '1_2_3700.jpg')
+        archiver.close()
+        path = uploader.submit_file.call_args[0][0]
+        assert [name for name, _ in ShardReader.iter_local_frames(path)] == ['1_2_3600.jpg', '1_2_3700.jpg']
+
+    def test_archiver_moves_a_corrupt_finished_shard_aside(self):
+        with open(os.path.join(self.directory, '1_2_0.tar'), 'wb') as f:
+            f.write(b'not a tar')
+        shard = ShardWriter(os.path.join(self.directory, '1_2_3600.tar'))
+        shard.add('1_2_3600.jpg', b'a', 0)
+        shard.finish()
+        uploader = MagicMock()
+        archiver = ShardArchiver(uploader, self.directory, flush_interval_secs=3600)
+        archiver.close()
+        assert uploader.submit_file.call_count == 1
+        assert uploader.submit_file.call_args[0][0] == shard.path
+        assert sorted(os.listdir(self.directory)) == ['1_2_0.tar' + CORRUPT_SUFFIX, '1_2_3600.tar']
+
+    def test_reader_fetches_single_frames_by_range_and_streams_shards(self):
+        with mock_aws():
+            client = boto3.client('s3', region_name='us-east-1')
+            client.create_bucket(Bucket=BUCKET)
+            uploader = S3Uploader(BUCKET, client=client, num_workers=1)
+            archiver = ShardArchiver(uploader, self.directory, flush_interval_secs=3600)
+            archiver.add_frame(b'a' * 1000, '1_2_3600.jpg')
+            archiver.add_frame(b'b' * 2000, '1_2_3615.jpg')
+            archiver.close()
+            uploader.close()
+
+            reader = ShardReader(client, BUCKET)
+            key, = [o['Key'] for o in client.list_objects_v2(Bucket=BUCKET)['Contents']]
+            assert parse_shard_name(os.path.basename(key))[:3] == ('1', '2', 3600)
+            index = reader.read_index(key)
+            assert sorted(index) == ['1_2_3600.jpg', '1_2_3615.jpg']
+            assert reader.get_frame(key, '1_2_3615.jpg', index) == b'b' * 2000
+            assert [name for name, _ in reader.iter_frames(key)] == ['1_2_3600.jpg', '1_2_3615.jpg']
+            assert os.listdir(self.directory) == []
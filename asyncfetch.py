@@ -0,0 +1,315 @@
+r"""Asynchronous DOT camera fetcher
+
+This module fetches one image per camera from a single process with asyncio. All requests share one pooled
+aiohttp session, so connections to the DOT image host are reused across cameras and across cycles. Each request
+has its own deadline, so a hung camera only costs its own timeout and never stalls the rest of the cycle.
+Response bodies are streamed to disk in chunks rather than buffered in memory. Unchanged frames are dropped by a
+framededup.FrameDeduplicator before they reach the spool, and remembered only once handed off. With a
+framering.FrameRing, frames are handed to the analyzer through shared memory and only written to the spool when the
+ring is full.
+
+It is a drop-in replacement for the multiprocessing Pool handed to SaveImages.download_dot_files.
+
+
+Example usage:
+    fetcher = AsyncCameraFetcher()
+    try:
+        stats = SaveImages.download_dot_files(fetcher, camera_objects)
+    finally:
+        fetcher.close()
+        fetcher.join()
+"""
+import asyncio
+import io
+import logging
+import os
+import time
+
+import aiohttp
+
+from saveimages import (SaveImages, SaveImagesConfig, CameraObject, STAGE_WRITE, VALID_IMG_CONTENT_SIZE,
+                        record_fetch)
+import saveimages
+from framededup import FrameDeduplicator, new_digest
+from metrics import OUTCOME_ERROR, OUTCOME_OK, record_stage
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an unsorted list, 0 when the list is empty"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+class FetchCycleStats:
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.attempted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.too_small = 0
+        self.not_modified = 0
+        self.duplicates = 0
+        self.via_ring = 0
+        self.bytes = 0
+        self.latencies = []
+        self.started_at = time.monotonic()
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self.started_at
+        return self
+
+    @property
+    def frames_per_sec(self):
+        return self.succeeded / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __repr__(self):
+        return (f"attempted={self.attempted} ok={self.succeeded} failed={self.failed} timed_out={self.timed_out} "
+                f"too_small={self.too_small} not_modified={self.not_modified} duplicates={self.duplicates} "
+                f"via_ring={self.via_ring} "
+                f"elapsed={self.elapsed:.2f}s "
+                f"throughput={self.frames_per_sec:.1f} frames/s {self.bytes_per_sec / 1024:.1f} KiB/s "
+                f"latency p50={percentile(self.latencies, 50):.3f}s p95={percentile(self.latencies, 95):.3f}s "
+                f"max={max(self.latencies, default=0.0):.3f}s")
+
+
+class AsyncCameraFetcher:
+    """Fetches camera images concurrently on a private event loop that lives as long as the fetcher"""
+
+    def __init__(self,
+                 max_connections=SaveImagesConfig.ASYNC_MAX_CONNECTIONS,
+                 max_connections_per_host=SaveImagesConfig.ASYNC_MAX_CONNECTIONS_PER_HOST,
+                 request_timeout_secs=SaveImagesConfig.ASYNC_REQUEST_TIMEOUT_SECS,
+                 save_directory=None,
+                 on_file_saved=None,
+                 dedup=True,
+                 frame_ring=None):
+        self._max_connections = max_connections
+        self._max_connections_per_host = max_connections_per_host
+        self._timeout = aiohttp.ClientTimeout(total=request_timeout_secs)
+        self._save_directory = save_directory
+        # Called on the event loop, so it must not block; the default only queues an upload
+        self._on_file_saved = on_file_saved or SaveImages.upload_raw_file
+        self.dedup = FrameDeduplicator() if dedup else None
+        self._frame_ring = frame_ring
+        self._loop = asyncio.new_event_loop()
+        self._session = None
+        self.last_stats = None
+        self._window_stats = FetchCycleStats()
+
+    @property
+    def save_directory(self):
+        return self._save_directory or saveimages.saveDirectory
+
+    def fetch_all(self, camera_objects):
+        """Fetch every camera once and return the FetchCycleStats of the cycle"""
+        stats = self._loop.run_until_complete(self._fetch_all(camera_objects))
+        log.info(f"Fetch cycle: {stats}")
+        if self.dedup is not None:
+            log.info(f"Frames avoided so far: {self.dedup.totals()}")
+        self.last_stats = stats
+        return stats
+
+    def run_scheduled(self, scheduler, should_fetch=None, stop_event=None,
+                      report_interval_secs=SaveImagesConfig.SCHEDULER_REPORT_INTERVAL_SECS):
+        """Fetch cameras whenever a camerascheduler.CameraScheduler says they are due, until stop_event is set"""
+        self._window_stats = FetchCycleStats()
+
+        async def report():
+            while True:
+                await asyncio.sleep(report_interval_secs)
+                stats, self._window_stats = self._window_stats.finish(), FetchCycleStats()
+                log.info(f"Fetched over the last {report_interval_secs}s: {stats}; "
+                         f"{scheduler.offline_count()} of {len(scheduler)} queued cameras backing off")
+                self.last_stats = stats
+
+        async def run():
+            reporter = asyncio.ensure_future(report())
+            try:
+                await scheduler.run(self.fetch_camera, should_fetch=should_fetch, stop_event=stop_event)
+            finally:
+                reporter.cancel()
+
+        self._loop.run_until_complete(run())
+
+    async def fetch_camera(self, camera_object):
+        """Fetch one camera outside of a cycle, recording it in the current reporting window"""
+        session = await self._get_session()
+        return await self._fetch_one(session, camera_object, self._window_stats)
+
+    def close(self):
+        if self._session is not None:
+            self._loop.run_until_complete(self._session.close())
+            self._session = None
+        self._loop.close()
+
+    def join(self):
+        """Wait for the uploads queued by this process to finish"""
+        if saveimages.save_to_aws and self._on_file_saved is SaveImages.upload_raw_file:
+            SaveImages.get_uploader().join()
+
+    async def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._max_connections,
+                                             limit_per_host=self._max_connections_per_host,
+                                             ssl=None if saveimages.VERIFY_SSL_CERT else False)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self._session
+
+    async def _fetch_all(self, camera_objects):
+        stats = FetchCycleStats()
+        session = await self._get_session()
+        await asyncio.gather(*[self._fetch_one(session, camera_object, stats) for camera_object in camera_objects])
+        return stats.finish()
+
+    async def _fetch_one(self, session, camera_object, stats):
+        assert isinstance(camera_object, CameraObject)
+        file_name = SaveImages.get_string_format(camera_object)
+        url = SaveImages.get_camera_image_url(camera_object)
+        stats.attempted += 1
+        start_time = time.monotonic()
+        try:
+            if self._frame_ring is not None:
+                size = await self._fetch_to_ring(session, camera_object, url, file_name, stats)
+            else:
+                size = await self._stream_to_file(session, camera_object, url, file_name, stats)
+        except asyncio.TimeoutError:
+            stats.timed_out += 1
+            log.warning(f"Timed out downloading url={url}")
+            record_fetch(camera_object, start_time, 'timeout')
+            return False
+        except (aiohttp.ClientError, IOError):
+            stats.failed += 1
+            log.exception(f"Could not download image with url={url}")
+            record_fetch(camera_object, start_time, OUTCOME_ERROR)
+            return False
+        stats.latencies.append(time.monotonic() - start_time)
+
+        if size is None:
+            record_fetch(camera_object, start_time, 'unchanged')
+            return True
+        if size <= VALID_IMG_CONTENT_SIZE:
+            stats.too_small += 1
+            record_fetch(camera_object, start_time, 'too_small')
+            return False
+
+        stats.succeeded += 1
+        stats.bytes += size
+        record_fetch(camera_object, start_time, OUTCOME_OK)
+        return True
+
+    async def _download(self, session, camera_object, url, sink, stats):
+        """Write the response body to sink, returning (size, digest, headers), or None on 304 Not Modified"""
+        headers = self.dedup.request_headers(camera_object) if self.dedup is not None else None
+        digest = new_digest()
+        size = 0
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 304:
+                self.dedup.record_not_modified(camera_object)
+                stats.not_modified += 1
+                return None
+            resp.raise_for_status()
+            async for chunk in resp.content.iter_chunked(SaveImagesConfig.ASYNC_CHUNK_SIZE):
+                sink.write(chunk)
+                digest.update(chunk)
+                size += len(chunk)
+            return size, digest.digest(), resp.headers
+
+    def _is_new_frame(self, camera_object, size, digest, headers, stats):
+        if size <= VALID_IMG_CONTENT_SIZE:
+            return False
+        if self.dedup is not None and self.dedup.is_duplicate(camera_object, digest, size, headers):
+            stats.duplicates += 1
+            return False
+        return True
+
+    def _commit_frame(self, camera_object, size, digest, headers):
+        if self.dedup is not None:
+            self.dedup.commit(camera_object, digest, size, headers)
+
+    async def _stream_to_file(self, session, camera_object, url, file_name, stats):
+        """Stream the response body to a temporary file, moving it into place only when it is a valid new image
+
+        Returns the body size, or None when the frame is unchanged since the last fetch and was dropped.
+        """
+        file_path = os.path.join(self.save_directory, file_name)
+        partial_path = file_path + '.part'
+        try:
+            with open(partial_path, 'wb') as f:
+                result = await self._download(session, camera_object, url, f, stats)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        if result is None:
+            os.remove(partial_path)
+            return None
+
+        size, digest, headers = result
+        if not self._is_new_frame(camera_object, size, digest, headers, stats):
+            os.remove(partial_path)
+            return size if size <= VALID_IMG_CONTENT_SIZE else None
+
+        write_started = time.monotonic()
+        try:
+            os.replace(partial_path, file_path)
+        except BaseException:
+            os.remove(partial_path)
+            raise
+        self._commit_frame(camera_object, size, digest, headers)
+        log.debug(f'Wrote {size} bytes to {file_path}')
+        self._handle_saved_file(file_path, file_name)
+        record_stage(STAGE_WRITE, time.monotonic() - write_started)
+        return size
+
+    async def _fetch_to_ring(self, session, camera_object, url, file_name, stats):
+        """Download the frame into memory and pass it to the analyzer through the shared-memory ring
+
+        The frame only goes to the disk spool when the ring is full. Returns the same as _stream_to_file.
+        """
+        buffer = io.BytesIO()
+        result = await self._download(session, camera_object, url, buffer, stats)
+        if result is None:
+            return None
+
+        size, digest, headers = result
+        if not self._is_new_frame(camera_object, size, digest, headers, stats):
+            return size if size <= VALID_IMG_CONTENT_SIZE else None
+
+        write_started = time.monotonic()
+        data = buffer.getvalue()
+        timestamp, location_id = SaveImages.get_timestamp_and_location_id(file_name)
+        if self._frame_ring.put(data, camera_object.cameraId, location_id, timestamp):
+            self._commit_frame(camera_object, size, digest, headers)
+            stats.via_ring += 1
+            if saveimages.save_to_aws:
+                SaveImages.upload_raw_bytes(data, file_name)
+            record_stage(STAGE_WRITE, time.monotonic() - write_started)
+            return size
+
+        file_path = os.path.join(self.save_directory, file_name)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        self._commit_frame(camera_object, size, digest, headers)
+        self._handle_saved_file(file_path, file_name)
+        record_stage(STAGE_WRITE, time.monotonic() - write_started)
+        return size
+
+    def _handle_saved_file(self, file_path, file_name):
+        try:
+            self._on_file_saved(file_path, file_name)
+        except Exception:
+            log.exception(f"Could not hand off file={file_path}")
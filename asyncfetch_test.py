@@ -0,0 +1,180 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mock import patch, MagicMock
+from asyncfetch import *
+
+
+class FakeCameraHandler(BaseHTTPRequestHandler):
+    """Serves /cctv<id>.jpg; camera 1 is valid, camera 2 is too small, camera 3 hangs, camera 4 is missing and
+    camera 5 supports conditional GETs"""
+
+    def do_GET(self):
+        camera_id = self.path.split('cctv')[1].split('.jpg')[0]
+        if camera_id == '5' and self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        if camera_id == '3':
+            time.sleep(2)
+        if camera_id == '4':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = b'x' * (20000 if camera_id != '2' else 100)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if camera_id == '5':
+            self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAsyncCameraFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCameraHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.save_directory = tempfile.mkdtemp()
+        self.url_patch = patch('saveimages.DOT_CAMERA_IMAGE_URL', f'http://127.0.0.1:{self.server.server_port}/cctv')
+        self.url_patch.start()
+
+    def tearDown(self):
+        self.url_patch.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.save_directory)
+
+    @staticmethod
+    def make_camera(camera_id):
+        co = CameraObject()
+        co.cameraId = camera_id
+        co.locationId = camera_id * 10
+        return co
+
+    def test_fetch_all_writes_valid_images_and_hands_them_off(self):
+        on_saved = MagicMock()
+        fetcher = AsyncCameraFetcher(save_directory=self.save_directory, on_file_saved=on_saved)
+        try:
+            stats = SaveImages.download_dot_files(fetcher, [self.make_camera(1), self.make_camera(2)])
+        finally:
+            fetcher.close()
+            fetcher.join()
+
+        assert stats.attempted == 2
+        assert stats.succeeded == 1
+        assert stats.too_small == 1
+        assert stats.bytes == 20000
+        files = os.listdir(self.save_directory)
+        assert len(files) == 1
+        assert files[0].startswith('1_10_')
+        assert on_saved.call_count == 1
+
+    def test_hung_camera_does_not_stall_cycle(self):
+        fetcher = AsyncCameraFetcher(save_directory=self.save_directory, on_file_saved=MagicMock(),
+                                     request_timeout_secs=0.5)
+        try:
+            start = time.monotonic()
+            stats = fetcher.fetch_all([self.make_camera(3), self.make_camera(4), self.make_camera(1)])
+            elapsed = time.monotonic() - start
+        finally:
+            fetcher.close()
+            fetcher.join()
+
+        assert elapsed < 1.5
+        assert stats.timed_out == 1
+        assert stats.failed == 1
+        assert stats.succeeded == 1
+        assert not [f for f in os.listdir(self.save_directory) if f.endswith('.part')]
+
+    def test_unchanged_frames_are_dropped(self):
+        on_saved = MagicMock()
+        fetcher = AsyncCameraFetcher(save_directory=self.save_directory, on_file_saved=on_saved)
+        cameras = [self.make_camera(1), self.make_camera(5)]
+        try:
+            first = fetcher.fetch_all(cameras)
+            second = fetcher.fetch_all(cameras)
+        finally:
+            fetcher.close()
+            fetcher.join()
+
+        assert first.succeeded == 2
+        assert second.succeeded == 0
+        assert second.duplicates == 1
+        assert second.not_modified == 1
+        assert on_saved.call_count == 2
+        assert fetcher.dedup.counters[1].duplicate_frames == 1
+        assert fetcher.dedup.counters[5].not_modified == 1
+        assert fetcher.dedup.totals().bytes_avoided == 40000
+        assert fetcher.dedup.totals().inference_runs_avoided == 2
+
+    def test_frame_that_could_not_be_spooled_is_not_a_duplicate(self):
+        fetcher = AsyncCameraFetcher(save_directory=self.save_directory, on_file_saved=MagicMock())
+        try:
+            with patch('asyncfetch.os.replace', side_effect=OSError("disk full")):
+                first = fetcher.fetch_all([self.make_camera(1)])
+            second = fetcher.fetch_all([self.make_camera(1)])
+        finally:
+            fetcher.close()
+            fetcher.join()
+
+        assert first.failed == 1
+        assert second.succeeded == 1
+        assert second.duplicates == 0
+        assert len(os.listdir(self.save_directory)) == 1
+
+    def test_run_scheduled_backs_off_failing_cameras(self):
+        from camerascheduler import CameraScheduler
+        fetcher = AsyncCameraFetcher(save_directory=self.save_directory, on_file_saved=MagicMock())
+        scheduler = CameraScheduler([self.make_camera(1), self.make_camera(4)], interval_secs=0.1,
+                                    max_fetches_per_sec=1000, backoff_base_secs=60)
+        stop_event = threading.Event()
+        threading.Timer(0.5, stop_event.set).start()
+        try:
+            fetcher.run_scheduled(scheduler, stop_event=stop_event)
+            stats = fetcher._window_stats
+        finally:
+            fetcher.close()
+            fetcher.join()
+
+        assert stats.failed == 1
+        assert stats.succeeded == 1
+        assert stats.duplicates >= 1
+        assert scheduler.offline_count() == 1
+
+    def test_frame_ring_hands_frames_over_and_spills_to_disk_when_full(self):
+        import uuid
+        from framering import FrameRing
+        ring = FrameRing.create('test_' + uuid.uuid4().hex[:12], slot_count=1, slot_size=32 * 1024)
+        on_saved = MagicMock()
+        fetcher = AsyncCameraFetcher(save_directory=self.save_directory, on_file_saved=on_saved, frame_ring=ring)
+        try:
+            with patch('saveimages.save_to_aws', False):
+                stats = fetcher.fetch_all([self.make_camera(1), self.make_camera(5)])
+            frame = ring.get()
+            assert len(frame.data) == 20000
+            assert frame.camera_id in (1, 5)
+            frame.release()
+        finally:
+            fetcher.close()
+            fetcher.join()
+            ring.close()
+            ring.unlink()
+
+        assert stats.succeeded == 2
+        assert stats.via_ring == 1
+        assert on_saved.call_count == 1
+        assert len(os.listdir(self.save_directory)) == 1
+
+    def test_percentile(self):
+        assert percentile([], 95) == 0.0
+        assert percentile([3, 1, 2], 50) == 2
+        assert percentile(list(range(101)), 95) == 95
@@ -0,0 +1,223 @@
+r"""Backfill over archived frames
+
+Reprocessing history after a model change means running the analyzer over frames that are not in the spool: a
+directory tree of downloaded frames (see misc/downloadawsimages.py), a text file listing frame paths, or archive
+shards (see archiveshards.py). BackfillSource feeds such frames to the analyzer pipeline in the place of a
+FrameSource:
+
+    * frames are read in timestamp order, so per-camera state such as the motion gate sees them as they were taken;
+    * nothing is deleted, archived frames are only read;
+    * progress is checkpointed to a file, and a restarted backfill skips the frames done before the crash;
+    * a frame that cannot be read or analyzed, e.g. because its shard went missing, counts as done and failed, so
+      the backfill still finishes and its summary tells how many frames were lost.
+
+Frames finish out of order because the pipeline stages run in parallel. The checkpoint records how many frames
+are done in timestamp order, so after a crash a few frames past it may be analyzed twice, which overwrites their
+results with the same values. The checkpoint also records a digest of the frame list, and a checkpoint written
+for another list is ignored.
+
+
+Example usage:
+    frames = collect_frames(["/data/frames/368", "/data/shards/261_368_1539558000.tar"])
+    source = BackfillSource(frames, "/data/backfill.checkpoint")
+    frame = source.next()
+    ...
+    source.done(frame)
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import tarfile
+import threading
+import time
+
+from archiveshards import INDEX_NAME
+from saveimages import SaveImages
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+SHARD_SUFFIX = '.tar'
+FRAME_SUFFIX = '.jpg'
+CHECKPOINT_EVERY_FRAMES = 100
+
+
+class ArchivedFrame:
+    """A frame in a file of its own, or at offset in a shard when offset is set"""
+
+    def __init__(self, file_name, path, timestamp, location_id, offset=None, size=None) -> None:
+        super().__init__()
+
+        self.file_name = file_name
+        self.path = path
+        self.timestamp = timestamp
+        self.location_id = location_id
+        self.offset = offset
+        self.size = size
+
+    @staticmethod
+    def from_file(path):
+        file_name = os.path.basename(path)
+        timestamp, location_id = SaveImages.get_timestamp_and_location_id(file_name)
+        return ArchivedFrame(file_name, path, timestamp, location_id)
+
+    def open(self):
+        """File path or file object to decode the frame from"""
+        if self.offset is None:
+            return self.path
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            return io.BytesIO(f.read(self.size))
+
+    def __repr__(self):
+        return f"ArchivedFrame({self.file_name})"
+
+
+def frames_in_shard(path):
+    """The frames of a local shard, found from its tar headers without reading the frames"""
+    frames = []
+    with tarfile.open(path, 'r:') as tar:
+        for member in tar:
+            if member.isfile() and member.name != INDEX_NAME:
+                timestamp, location_id = SaveImages.get_timestamp_and_location_id(member.name)
+                frames.append(ArchivedFrame(member.name, path, timestamp, location_id, member.offset_data,
+                                            member.size))
+    return frames
+
+
+def _frames_at(path):
+    if os.path.isdir(path):
+        frames = []
+        for directory, _, file_names in os.walk(path):
+            for file_name in file_names:
+                frames.extend(_frames_at(os.path.join(directory, file_name)))
+        return frames
+    if path.endswith(SHARD_SUFFIX):
+        return frames_in_shard(path)
+    if path.endswith(FRAME_SUFFIX):
+        return [ArchivedFrame.from_file(path)]
+    # Anything else is a list of frame and shard paths, one per line
+    with open(path) as f:
+        return [frame for line in f if line.strip() for frame in _frames_at(line.strip())]
+
+
+def collect_frames(inputs, accept=None):
+    """Frames of the given directories, file lists, frames and shards in timestamp order
+
+    With accept, only frames for which accept(frame) is true are kept. Files whose names are not frame names are
+    skipped.
+    """
+    frames = [frame for path in inputs for frame in _frames_at(path)]
+    invalid = sum(1 for frame in frames if frame.timestamp == 0)
+    if invalid:
+        log.warning(f"Skipping {invalid} files that are not named <cameraId>_<locationId>_<epoch>.jpg")
+    frames = [frame for frame in frames if frame.timestamp != 0 and (accept is None or accept(frame))]
+    frames.sort(key=lambda frame: (frame.timestamp, frame.location_id, frame.file_name))
+    return frames
+
+
+def frames_digest(frames):
+    digest = hashlib.sha1()
+    for frame in frames:
+        digest.update(f"{frame.path}:{frame.file_name}\n".encode())
+    return digest.hexdigest()
+
+
+class BackfillSource:
+    """Hands out archived frames in order and checkpoints how many of them are done"""
+
+    def __init__(self, frames, checkpoint_path=None, checkpoint_every=CHECKPOINT_EVERY_FRAMES, clock=time.time):
+        self._frames = frames
+        self._checkpoint_path = checkpoint_path
+        self._checkpoint_every = checkpoint_every
+        self._clock = clock
+        self._digest = frames_digest(frames)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._done_ahead = set()
+        self._failed = 0
+        self.finished = threading.Event()
+        self.resumed_from = self._read_checkpoint()
+        # Every frame before _done is done; _next is the next frame to hand out
+        self._done = self._next = self.resumed_from
+        self._checkpointed = self._done
+        self._started = clock()
+        if self._done >= len(frames):
+            self.finished.set()
+
+    def _read_checkpoint(self):
+        if self._checkpoint_path is None or not os.path.exists(self._checkpoint_path):
+            return 0
+        try:
+            with open(self._checkpoint_path) as f:
+                checkpoint = json.load(f)
+            if checkpoint.get('digest') != self._digest:
+                log.warning(f"Checkpoint={self._checkpoint_path} is for another list of frames, starting over")
+                return 0
+            done = min(int(checkpoint['done']), len(self._frames))
+        except (OSError, ValueError, AttributeError, KeyError, TypeError):
+            log.warning(f"Could not read checkpoint={self._checkpoint_path}, starting over", exc_info=True)
+            return 0
+        log.info(f"Resuming backfill after {done} of {len(self._frames)} frames")
+        return done
+
+    def _write_checkpoint(self):
+        path = self._checkpoint_path
+        with open(path + '.part', 'w') as f:
+            json.dump({'digest': self._digest, 'done': self._done, 'frames': len(self._frames)}, f)
+        os.replace(path + '.part', path)
+        self._checkpointed = self._done
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def next(self):
+        """The next frame to analyze, or None when every frame has been handed out"""
+        with self._lock:
+            if self._next >= len(self._frames):
+                return None
+            frame = self._frames[self._next]
+            self._in_flight[id(frame)] = self._next
+            self._next += 1
+            return frame
+
+    def done(self, frame, failed=False):
+        with self._lock:
+            index = self._in_flight.pop(id(frame), None)
+            if index is None:
+                return
+            if failed:
+                self._failed += 1
+            self._done_ahead.add(index)
+            while self._done in self._done_ahead:
+                self._done_ahead.remove(self._done)
+                self._done += 1
+            finished = self._done >= len(self._frames)
+            if self._checkpoint_path is not None and (finished or
+                                                      self._done - self._checkpointed >= self._checkpoint_every):
+                self._write_checkpoint()
+        if finished:
+            self.finished.set()
+
+    def close(self):
+        """Checkpoint the frames done so far"""
+        with self._lock:
+            if self._checkpoint_path is not None and self._done != self._checkpointed:
+                self._write_checkpoint()
+
+    def summary(self):
+        elapsed = self._clock() - self._started
+        with self._lock:
+            processed = self._done - self.resumed_from + len(self._done_ahead)
+            return {
+                'frames': len(self._frames),
+                'resumed_from': self.resumed_from,
+                'processed': processed,
+                'failed': self._failed,
+                'elapsed_secs': round(elapsed, 1),
+                'frames_per_sec': round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+            }
@@ -0,0 +1,151 @@
+import shutil
+import tempfile
+import unittest
+from backfill import *
+from archiveshards import ShardWriter
+from pipeline import Stage
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestBackfill(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_frame(self, relative_path, content=b'jpeg'):
+        path = os.path.join(self.directory, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def make_shard(self, name, frames):
+        writer = ShardWriter(os.path.join(self.directory, name))
+        for file_name, data in frames:
+            writer.add(file_name, data, 0)
+        writer.finish()
+        return writer.path
+
+    def test_collects_directories_file_lists_and_shards_in_timestamp_order(self):
+        self.make_frame("frames/368/261_368_30.jpg")
+        self.make_frame("frames/932/300_932_10.jpg")
+        self.make_frame("frames/notes.txt.jpg")
+        shard = self.make_shard("261_368_0.tar", [("261_368_20.jpg", b'second'), ("261_368_40.jpg", b'fourth')])
+        listed = self.make_frame("listed/300_932_50.jpg")
+        file_list = os.path.join(self.directory, "frames.lst")
+        with open(file_list, 'w') as f:
+            f.write(listed + "\n\n")
+
+        frames = collect_frames([os.path.join(self.directory, "frames"), shard, file_list])
+
+        assert [frame.file_name for frame in frames] == ["300_932_10.jpg", "261_368_20.jpg", "261_368_30.jpg",
+                                                         "261_368_40.jpg", "300_932_50.jpg"]
+        assert frames[1].open().read() == b'second'
+        assert frames[3].open().read() == b'fourth'
+        assert frames[0].open() == os.path.join(self.directory, "frames/932/300_932_10.jpg")
+
+    def test_collect_frames_keeps_accepted_frames(self):
+        self.make_frame("frames/261_368_30.jpg")
+        self.make_frame("frames/300_932_10.jpg")
+        frames = collect_frames([os.path.join(self.directory, "frames")], accept=lambda f: f.location_id == 368)
+        assert [frame.file_name for frame in frames] == ["261_368_30.jpg"]
+
+    def test_checkpoints_the_frames_done_in_order(self):
+        frames = [ArchivedFrame(f"1_2_{t}.jpg", None, t, 2) for t in range(5)]
+        checkpoint = os.path.join(self.directory, "checkpoint")
+        source = BackfillSource(frames, checkpoint, checkpoint_every=1)
+        handed_out = [source.next() for _ in range(3)]
+        assert source.in_flight == 3
+
+        # Frames finish out of order, the checkpoint only moves over frames with everything before them done
+        source.done(handed_out[1])
+        source.done(handed_out[1])
+        assert not os.path.exists(checkpoint)
+        source.done(handed_out[0])
+        with open(checkpoint) as f:
+            assert json.load(f)['done'] == 2
+
+        resumed = BackfillSource(frames, checkpoint)
+        assert resumed.resumed_from == 2
+        assert resumed.next() is frames[2]
+
+    def test_finishes_once_every_frame_is_done(self):
+        frames = [ArchivedFrame(f"1_2_{t}.jpg", None, t, 2) for t in range(3)]
+        checkpoint = os.path.join(self.directory, "checkpoint")
+        clock = FakeClock()
+        source = BackfillSource(frames, checkpoint, clock=clock)
+        while True:
+            frame = source.next()
+            if frame is None:
+                break
+            assert not source.finished.is_set()
+            source.done(frame)
+        clock.now += 2
+        assert source.finished.is_set()
+        assert source.summary() == {'frames': 3, 'resumed_from': 0, 'processed': 3, 'failed': 0,
+                                    'elapsed_secs': 2.0, 'frames_per_sec': 1.5}
+        assert BackfillSource(frames, checkpoint).finished.is_set()
+
+    def test_finishes_when_a_shard_is_removed_after_collecting(self):
+        self.make_frame("frames/261_368_10.jpg")
+        shard = self.make_shard("261_368_0.tar", [("261_368_20.jpg", b'second'), ("261_368_30.jpg", b'third')])
+        frames = collect_frames([os.path.join(self.directory, "frames"), shard])
+        os.remove(shard)
+        source = BackfillSource(frames, os.path.join(self.directory, "checkpoint"))
+
+        def read(frame):
+            frame.open()
+            source.done(frame)
+
+        stage = Stage('decode', read, on_error=lambda frame: source.done(frame, failed=True))
+        stage.start()
+        for frame in iter(source.next, None):
+            stage.put(frame)
+        stage.stop()
+        assert source.finished.is_set()
+        assert source.summary()['failed'] == 2
+        assert source.summary()['processed'] == 3
+
+    def test_close_checkpoints_progress(self):
+        frames = [ArchivedFrame(f"1_2_{t}.jpg", None, t, 2) for t in range(3)]
+        checkpoint = os.path.join(self.directory, "checkpoint")
+        source = BackfillSource(frames, checkpoint)
+        source.done(source.next())
+        source.close()
+        assert BackfillSource(frames, checkpoint).resumed_from == 1
+
+    def test_ignores_a_checkpoint_of_another_frame_list(self):
+        frames = [ArchivedFrame(f"1_2_{t}.jpg", None, t, 2) for t in range(3)]
+        checkpoint = os.path.join(self.directory, "checkpoint")
+        source = BackfillSource(frames, checkpoint)
+        source.done(source.next())
+        source.close()
+        assert BackfillSource(frames[1:], checkpoint).resumed_from == 0
+
+    def test_starts_over_after_an_unreadable_checkpoint(self):
+        frames = [ArchivedFrame(f"1_2_{t}.jpg", None, t, 2) for t in range(3)]
+        checkpoint = os.path.join(self.directory, "checkpoint")
+        source = BackfillSource(frames, checkpoint)
+        source.done(source.next())
+        source.close()
+        with open(checkpoint) as f:
+            written = json.load(f)
+        for content in ['{"digest": "', json.dumps({'digest': written['digest']}), '[]']:
+            with open(checkpoint, 'w') as f:
+                f.write(content)
+            assert BackfillSource(frames, checkpoint).resumed_from == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+r"""Benchmark micro-batched inference
+
+Runs the frames in data/images through the detection graph for a range of batch sizes and reports images/sec and
+the p95 latency of a frame from entering the batcher to having detections. Frames are decoded up front so only
+batching and inference are measured. Needs the detector backend and model given by -model.
+
+
+Example usage:
+    python benchmarks/batch_benchmark.py -images data/images -limit 200 -batch_sizes 1,2,4,8,16
+"""
+import argparse
+import glob
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from detectors import DEFAULT_MODEL, create_detector
+from framedecode import decode_image
+from microbatch import BatchStats, MicroBatcher
+
+
+def measure(detector, images, batch_size, max_wait_secs):
+    batcher = MicroBatcher(max_batch_size=batch_size, max_wait_secs=max_wait_secs)
+    stats = BatchStats()
+    for i, image_np in enumerate(images):
+        for batch in batcher.add(i, image_np):
+            detector.detect(batch.stacked())
+            stats.record(batch)
+    for batch in batcher.flush():
+        detector.detect(batch.stacked())
+        stats.record(batch)
+    summary = stats.summary()
+    print(f"{f'batch_size={batch_size}':<16}{summary['images_per_sec']:>10.2f} images/s"
+          f"{summary['mean_batch_size']:>8.1f} mean batch{1000 * summary['p95_latency_secs']:>10.0f} ms p95")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark micro-batched inference over camera frames')
+    parser.add_argument('-images', default='data/images', help='directory of JPEG frames')
+    parser.add_argument('-limit', type=int, default=200, help='number of frames to run through the model')
+    parser.add_argument('-batch_sizes', default='1,2,4,8,16', help='comma separated batch sizes to compare')
+    parser.add_argument('-model', default=DEFAULT_MODEL, help='detector model, as -model of analyzeimages.py')
+    parser.add_argument('-max_wait_secs', type=float, default=0.5, help='MicroBatcher max_wait_secs')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.images, '*.jpg')))[:args.limit]
+    images = [image_np for image_np in (decode_image(path) for path in paths) if image_np.size != 0]
+    print(f"Running {len(images)} frames from {args.images}")
+
+    with create_detector(args.model) as detector:
+        # The first call builds the kernels, keep it out of the measurements
+        detector.detect(images[0][None])
+        for batch_size in [int(v) for v in args.batch_sizes.split(',')]:
+            measure(detector, images, batch_size, args.max_wait_secs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+r"""Benchmark frame decoding
+
+Compares the original getdata()-based conversion of AnalyzeImages.load_image_into_numpy_array with the uint8
+decode of framedecode.decode_image, at full and reduced resolution, over the frames in data/images. Reports
+decode time per frame and peak memory, and the throughput of DecodePool for a range of thread counts.
+
+Most of the memory of a decode is in PIL's C buffers, which tracemalloc does not see. Each variant is therefore run in
+a fresh process, and its peak resident set size (ru_maxrss) is reported above the peak after the imports.
+
+
+Example usage:
+    python benchmarks/decode_benchmark.py -images data/images -limit 500 -max_size 176x120
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from framedecode import DecodePool, decode_image
+
+
+class PathFrame:
+
+    def __init__(self, path) -> None:
+        super().__init__()
+
+        self.path = path
+
+
+def getdata_decode(path, max_size=None):
+    """The decode the analyzer used before framedecode"""
+    with Image.open(path) as image:
+        (im_width, im_height) = image.size
+        return np.array(image.getdata()).reshape((im_height, im_width, 3)).astype(np.uint8)
+
+
+VARIANTS = {
+    'getdata': getdata_decode,
+    'decode_image': lambda path, max_size: decode_image(path),
+    'decode_image_draft': decode_image,
+}
+
+
+def run_variant(variant, paths, max_size, results):
+    decode = VARIANTS[variant]
+    # ru_maxrss is in KiB on Linux
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    for path in paths:
+        decode(path, max_size)
+    elapsed = time.perf_counter() - start
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline))
+
+
+def measure(name, variant, paths, max_size=None):
+    # Spawned rather than forked, so the peak RSS of one variant does not carry over to the next
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=run_variant, args=(variant, paths, max_size, results))
+    process.start()
+    elapsed, peak_rss = results.get()
+    process.join()
+    print(f"{name:<28}{1000 * elapsed / len(paths):>10.2f} ms/frame{peak_rss / 1024:>10.1f} MiB peak RSS")
+
+
+def measure_pool(num_workers, paths, max_size):
+    with DecodePool(num_workers=num_workers, prefetch=2 * num_workers, max_size=max_size) as pool:
+        start = time.perf_counter()
+        for _ in pool.map(PathFrame(path) for path in paths):
+            pass
+        elapsed = time.perf_counter() - start
+    print(f"{f'DecodePool workers={num_workers}':<28}{len(paths) / elapsed:>10.1f} frames/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JPEG decoding of camera frames')
+    parser.add_argument('-images', default='data/images', help='directory of JPEG frames')
+    parser.add_argument('-limit', type=int, default=500, help='number of frames to decode')
+    parser.add_argument('-max_size', default='176x120', help='WIDTHxHEIGHT for the reduced-resolution decode')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.images, '*.jpg')))[:args.limit]
+    max_size = tuple(int(v) for v in args.max_size.split('x'))
+    print(f"Decoding {len(paths)} frames from {args.images}")
+
+    measure('getdata (before)', 'getdata', paths)
+    measure('decode_image', 'decode_image', paths)
+    measure(f'decode_image draft {args.max_size}', 'decode_image_draft', paths, max_size)
+    for num_workers in [1, 2, 4, 8]:
+        measure_pool(num_workers, paths, None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+r"""Compare detector backends and models
+
+Runs the frames in data/images through each model and reports throughput, together with how well its counts
+agree with the reference model (the first one given, by default the current Faster R-CNN graph). Counts are the
+detections above the analyzer's score threshold per COCO class. Agreement is the share of frames whose counts
+match the reference exactly for every compared class, with the mean absolute count error per class.
+
+
+Example usage:
+    python benchmarks/detector_benchmark.py -models faster_rcnn_resnet50,ssd_mobilenet_v2,ssd_mobilenet_v2_int8
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from detectors import DEFAULT_MODEL, create_detector
+from framedecode import decode_image
+
+DETECTION_LIMIT = .4
+# COCO IDs of person, car, bus and truck
+CLASSES = '1,3,6,8'
+
+
+def count_classes(scores, classes, class_ids, min_score):
+    """[frames, len(class_ids)] counts of detections above min_score"""
+    counts = np.zeros((scores.shape[0], len(class_ids)), dtype=np.int32)
+    for j, class_id in enumerate(class_ids):
+        counts[:, j] = np.sum((scores > min_score) & (classes.astype(np.int32) == class_id), axis=1)
+    return counts
+
+
+def run_model(model, images, batch_size, num_threads, class_ids):
+    with create_detector(model, device='/cpu:0', num_threads=num_threads) as detector:
+        detector.detect(images[0][None])
+        counts = []
+        start = time.perf_counter()
+        for i in range(0, len(images), batch_size):
+            _, scores, classes, _ = detector.detect(np.stack(images[i:i + batch_size]))
+            counts.append(count_classes(scores, classes, class_ids, DETECTION_LIMIT))
+        elapsed = time.perf_counter() - start
+    return len(images) / elapsed, np.concatenate(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare detector backends and models over camera frames')
+    parser.add_argument('-images', default='data/images', help='directory of JPEG frames')
+    parser.add_argument('-limit', type=int, default=200, help='number of frames to run through each model')
+    parser.add_argument('-models', default=f'{DEFAULT_MODEL},ssd_mobilenet_v2',
+                        help='comma separated models, as -model of analyzeimages.py; the first one is the reference')
+    parser.add_argument('-classes', default=CLASSES, help='comma separated class IDs to compare counts of')
+    parser.add_argument('-batch_size', type=int, default=1, help='frames per detect call')
+    parser.add_argument('-threads', type=int, default=0, help='inference threads, 0 for the backend default')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.images, '*.jpg')))[:args.limit]
+    images = [image_np for image_np in (decode_image(path) for path in paths) if image_np.size != 0]
+    class_ids = [int(v) for v in args.classes.split(',')]
+    print(f"Running {len(images)} frames from {args.images}, comparing counts of classes {class_ids}")
+
+    reference = None
+    for model in args.models.split(','):
+        images_per_sec, counts = run_model(model, images, args.batch_size, args.threads, class_ids)
+        if reference is None:
+            reference = counts
+        agreement = np.mean(np.all(counts == reference, axis=1))
+        errors = ' '.join(f"{class_id}:{error:.2f}"
+                          for class_id, error in zip(class_ids, np.mean(np.abs(counts - reference), axis=0)))
+        print(f"{model:<28}{images_per_sec:>10.2f} images/s{100 * agreement:>8.1f}% agreement"
+              f"  mean abs error {errors}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,432 @@
+r"""End-to-end benchmark of saveimages and analyzeimages, offline
+
+Runs both daemons against local stand-ins: fakedot.FakeDotServer serves the frames in data/images as the DOT camera
+site, at the latency and failure rate given, and moto stands in for S3 and DynamoDB. Camera IDs are resolved through
+the camera registry, frames are fetched by the async or scheduled fetcher, uploaded to S3 and spooled, and the
+analyzer reads the spool, runs the detector and writes its results to DynamoDB, all in this process and with the
+same code paths as the daemons. Fetching stops after -duration_secs, the analyzer after it has emptied the spool or
+-drain_secs later.
+
+Reports frames/sec fetched and analyzed, latency percentiles of every stage (estimated from the buckets of the
+metrics.py histograms), frames per outcome, what reached S3 and DynamoDB, and the CPU time, peak RSS and peak thread
+count of the process, which includes the stand-ins. Every run is appended as one JSON line to -results, with its
+settings, the git revision and the host, and compared with the last run of the same settings.
+
+-model stub stands in for the detector: it sleeps -stub_inference_secs per batch and returns random detections, so
+everything around the model can be measured on a host without it.
+
+
+Example usage:
+    python benchmarks/e2e_benchmark.py -cameras 200 -duration_secs 120 -latency_secs 0.2 -failure_rate 0.02
+    python benchmarks/e2e_benchmark.py -model stub -stub_inference_secs 0.3 -batch_size 4 -fetch_mode scheduled
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import boto3
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import analyzeimages
+import saveimages
+from analyzeimages import AnalyzeImages, TABLE_NAME
+from annotator import CameraSampler
+from asyncfetch import AsyncCameraFetcher
+from cameraregistry import CameraRegistry
+from camerascheduler import CameraScheduler
+from detectors import CPU_DEVICE, DEFAULT_MODEL, Detector
+from fakedot import FakeDotServer, load_images
+from framedecode import DecodePool
+from metrics import CAMERA_FRAMES, STAGE_ITEMS, STAGE_SECONDS, count_files
+from microbatch import MicroBatcher
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+STUB_MODEL = 'stub'
+# COCO IDs and names of the classes the analyzer reports
+STUB_CATEGORY_INDEX = {1: {'id': 1, 'name': 'person'}, 3: {'id': 3, 'name': 'car'},
+                       6: {'id': 6, 'name': 'bus'}, 8: {'id': 8, 'name': 'truck'}}
+STUB_DETECTIONS = 100
+QUANTILES = (0.5, 0.95, 0.99)
+SAMPLE_INTERVAL_SECS = 1.0
+
+log = logging.getLogger(__name__)
+
+
+class StubDetector(Detector):
+    """Sleeps secs_per_batch and returns random detections of the classes in STUB_CATEGORY_INDEX"""
+
+    name = STUB_MODEL
+
+    def __init__(self, secs_per_batch, seed=0) -> None:
+        super().__init__()
+
+        self._secs_per_batch = secs_per_batch
+        self._rng = np.random.RandomState(seed)
+        self._lock = threading.Lock()
+
+    def detect(self, images_np):
+        time.sleep(self._secs_per_batch)
+        shape = (len(images_np), STUB_DETECTIONS)
+        with self._lock:
+            boxes = np.sort(self._rng.uniform(size=shape + (4,)).astype(np.float32), axis=-1)
+            scores = np.sort(self._rng.uniform(size=shape).astype(np.float32), axis=-1)[:, ::-1]
+            classes = self._rng.choice(sorted(STUB_CATEGORY_INDEX), size=shape).astype(np.float32)
+        return boxes, scores, classes, np.full(len(images_np), STUB_DETECTIONS, dtype=np.float32)
+
+
+class BenchmarkAnalyzer(AnalyzeImages):
+    """AnalyzeImages with the stub detector and label map when stub_inference_secs is given"""
+
+    def __init__(self, stub_inference_secs=None, **kwargs) -> None:
+        super().__init__(**kwargs)
+
+        self._stub_inference_secs = stub_inference_secs
+
+    def create_detector(self):
+        if self._stub_inference_secs is not None:
+            return StubDetector(self._stub_inference_secs)
+        return super().create_detector()
+
+    def create_category_index(self, path_labels_map):
+        if self._stub_inference_secs is not None:
+            return STUB_CATEGORY_INDEX
+        return AnalyzeImages.create_category_index(path_labels_map)
+
+
+class ResourceSampler:
+    """Peak thread and open file counts of the process, sampled from a background thread"""
+
+    def __init__(self, interval_secs=SAMPLE_INTERVAL_SECS) -> None:
+        super().__init__()
+
+        self.max_threads = 0
+        self.max_open_files = 0
+        self._interval_secs = interval_secs
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='resource-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            self.max_threads = max(self.max_threads, threading.active_count())
+            if os.path.isdir('/proc/self/fd'):
+                self.max_open_files = max(self.max_open_files, len(os.listdir('/proc/self/fd')))
+            if self._stop.wait(self._interval_secs):
+                return
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextlib.contextmanager
+def aws_stand_ins():
+    try:
+        from moto import mock_aws
+        mocks = [mock_aws()]
+    except ImportError:
+        from moto import mock_dynamodb2, mock_s3
+        mocks = [mock_s3(), mock_dynamodb2()]
+    with contextlib.ExitStack() as stack:
+        for mock in mocks:
+            stack.enter_context(mock)
+        yield
+
+
+def create_stand_ins():
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket=saveimages.BUCKET)
+    dynamodb = boto3.client('dynamodb', region_name='us-east-1')
+    dynamodb.create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'cameraLocationId', 'KeyType': 'HASH'},
+                   {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'cameraLocationId', 'AttributeType': 'S'},
+                              {'AttributeName': 'timestamp', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+    return s3, dynamodb
+
+
+def count_outputs(s3, dynamodb):
+    outputs = {'s3_raw_objects': 0, 's3_annotated_objects': 0, 'dynamodb_items': 0}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=saveimages.BUCKET):
+        for item in page.get('Contents', []):
+            if item['Key'].startswith('raw/'):
+                outputs['s3_raw_objects'] += 1
+            elif item['Key'].startswith('annotated/'):
+                outputs['s3_annotated_objects'] += 1
+    for page in dynamodb.get_paginator('scan').paginate(TableName=TABLE_NAME, Select='COUNT'):
+        outputs['dynamodb_items'] += page['Count']
+    return outputs
+
+
+def stage_report():
+    """{stage: count, mean and quantiles of its latency in seconds} and {stage: {outcome: items}}"""
+    stages = {}
+    for (stage,), histogram in sorted(STAGE_SECONDS.children().items()):
+        cumulative, total = histogram.snapshot()
+        if not cumulative[-1]:
+            continue
+        stages[stage] = {'count': cumulative[-1], 'mean_secs': round(total / cumulative[-1], 4)}
+        for q in QUANTILES:
+            stages[stage][f'p{int(q * 100)}_secs'] = round(histogram.quantile(q), 4)
+    items = {}
+    for (stage, outcome), counter in sorted(STAGE_ITEMS.children().items()):
+        items.setdefault(stage, {})[outcome] = counter.value()
+    return stages, items
+
+
+def frame_outcomes():
+    """{stage: {outcome: frames}} over all cameras, and the share of the cameras with a failed fetch"""
+    outcomes = {}
+    failing = set()
+    for (stage, location_id, outcome), counter in sorted(CAMERA_FRAMES.children().items()):
+        stage_outcomes = outcomes.setdefault(stage, {})
+        stage_outcomes[outcome] = stage_outcomes.get(outcome, 0) + counter.value()
+        if stage == 'fetch' and outcome in ('error', 'timeout'):
+            failing.add(location_id)
+    return outcomes, len(failing)
+
+
+def wait_for_drain(directories, timeout_secs):
+    """Wait until no files are left in directories, return whether they emptied in time"""
+    deadline = time.monotonic() + timeout_secs
+    while sum(count_files(d) for d in directories):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.5)
+    return True
+
+
+def run_fetcher(args, fetcher, cameras, stop_event):
+    should_fetch = lambda: saveimages.SaveImages.return_true_to_download_more_images(
+        saveimages.SaveImagesConfig.MAX_FILES_TO_DOWNLOAD)
+    if args.fetch_mode == 'scheduled':
+        scheduler = CameraScheduler(cameras, interval_secs=args.fetch_interval_secs,
+                                    max_fetches_per_sec=args.max_fetches_per_sec)
+        fetcher.run_scheduled(scheduler, should_fetch=should_fetch, stop_event=stop_event)
+        return
+    while not stop_event.is_set():
+        started = time.monotonic()
+        if should_fetch():
+            fetcher.fetch_all(cameras)
+        stop_event.wait(max(0.0, args.fetch_interval_secs - (time.monotonic() - started)))
+
+
+def run(args, dot, work_directory):
+    s3, dynamodb = create_stand_ins()
+    saveimages.saveDirectory = os.path.join(work_directory, 'rawimages')
+    saveimages.outDirectory = os.path.join(work_directory, 'preprocessed')
+    saveimages.SaveImages.make_sure_directories_exist()
+    annotated_directory = os.path.join(work_directory, 'annotated')
+    os.makedirs(annotated_directory)
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    sampler = ResourceSampler().start()
+    started = time.monotonic()
+    registry = CameraRegistry(os.path.join(work_directory, 'camera_registry.json'))
+    cameras = registry.refresh(saveimages.SaveImages.get_camera_objects_without_camera_id())
+    resolve_secs = time.monotonic() - started
+    log.info(f"Resolved {len(cameras)} cameras in {resolve_secs:.1f}s")
+
+    analyzer = BenchmarkAnalyzer(
+        args.stub_inference_secs if args.model == STUB_MODEL else None, device=CPU_DEVICE, model=args.model,
+        annotation_sampler=CameraSampler(args.annotate_every_secs), warm_up=not args.skip_warmup)
+    stop_analyzer = threading.Event()
+    analyzer_thread = threading.Thread(
+        target=analyzer.processimages, name='analyzeimages',
+        args=(saveimages.outDirectory, args.path_labels_map, annotated_directory),
+        kwargs={'decode_pool': DecodePool(num_workers=args.decode_workers, open_frame=AnalyzeImages.open_frame),
+                'batcher': MicroBatcher(args.batch_size, args.batch_max_wait_secs),
+                'num_sink_workers': args.sink_workers, 'stop_event': stop_analyzer})
+    analyzer_thread.start()
+
+    fetcher = AsyncCameraFetcher()
+    stop_fetching = threading.Event()
+    fetch_thread = threading.Thread(target=run_fetcher, args=(args, fetcher, cameras, stop_fetching),
+                                    name='saveimages')
+    fetch_started = time.monotonic()
+    fetch_thread.start()
+    stop_fetching.wait(args.duration_secs)
+    stop_fetching.set()
+    fetch_thread.join()
+    fetch_secs = time.monotonic() - fetch_started
+    fetcher.close()
+
+    saveimages.SaveImages.get_uploader().join()
+    drained = wait_for_drain([saveimages.saveDirectory, saveimages.outDirectory], args.drain_secs)
+    stop_analyzer.set()
+    analyzer_thread.join()
+    saveimages.SaveImages.get_uploader().close()
+    analyze_secs = time.monotonic() - fetch_started
+    sampler.stop()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    wall_secs = time.monotonic() - started
+
+    stages, items = stage_report()
+    outcomes, failing_cameras = frame_outcomes()
+    fetched = items.get('fetch', {}).get('ok', 0)
+    analyzed = items.get('postprocess', {}).get('ok', 0)
+    cpu_secs = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+    return {
+        'throughput': {
+            'cameras': len(cameras),
+            'cameras_with_failed_fetches': failing_cameras,
+            'resolve_secs': round(resolve_secs, 2),
+            'fetch_secs': round(fetch_secs, 2),
+            'analyze_secs': round(analyze_secs, 2),
+            'drained': drained,
+            'frames_fetched': fetched,
+            'frames_analyzed': analyzed,
+            'fetched_frames_per_sec': round(fetched / fetch_secs, 2) if fetch_secs else 0.0,
+            'analyzed_frames_per_sec': round(analyzed / analyze_secs, 2) if analyze_secs else 0.0,
+        },
+        'stages': stages,
+        'items': items,
+        'frame_outcomes': outcomes,
+        'outputs': count_outputs(s3, dynamodb),
+        'resources': {
+            'wall_secs': round(wall_secs, 2),
+            'cpu_user_secs': round(usage.ru_utime - usage_before.ru_utime, 2),
+            'cpu_system_secs': round(usage.ru_stime - usage_before.ru_stime, 2),
+            'cpu_utilisation': round(cpu_secs / wall_secs, 3) if wall_secs else 0.0,
+            # ru_maxrss is in kilobytes on Linux
+            'max_rss_mb': round(usage.ru_maxrss / 1024, 1),
+            'max_threads': sampler.max_threads,
+            'max_open_files': sampler.max_open_files,
+        },
+        'fake_dot': dot.report(),
+    }
+
+
+def previous_result(path, settings):
+    """The last result in path that was run with the same settings, or None"""
+    previous = None
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    continue
+                if result.get('settings') == settings:
+                    previous = result
+    return previous
+
+
+def save_result(path, result):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a') as f:
+        f.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+def print_result(result, previous):
+    throughput = result['throughput']
+    print(f"{throughput['cameras']} cameras: {throughput['fetched_frames_per_sec']:.2f} frames/s fetched, "
+          f"{throughput['analyzed_frames_per_sec']:.2f} frames/s analyzed"
+          + ('' if throughput['drained'] else ' (spool not drained)'))
+    for stage, stats in result['stages'].items():
+        print(f"{stage:<16}{stats['count']:>8} {1000 * stats['p50_secs']:>10.1f} ms p50"
+              f"{1000 * stats['p95_secs']:>10.1f} ms p95{1000 * stats['p99_secs']:>10.1f} ms p99")
+    print(f"Frames by outcome: {result['frame_outcomes']}")
+    print(f"Outputs: {result['outputs']}")
+    print(f"Resources: {result['resources']}")
+    if previous is not None:
+        before = previous['throughput']['analyzed_frames_per_sec']
+        change = (throughput['analyzed_frames_per_sec'] - before) / before * 100 if before else 0.0
+        print(f"Analyzed frames/s {change:+.1f}% against {before:.2f} of revision={previous['revision']} "
+              f"from {previous['started_at']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark saveimages and analyzeimages end to end, offline')
+    parser.add_argument('-images', default=os.path.join(ROOT, 'data', 'images'), help='directory of JPEG frames')
+    parser.add_argument('-limit', type=int, help='number of frames to serve, all of them by default')
+    parser.add_argument('-cameras', type=int, default=100, help='number of fake cameras')
+    parser.add_argument('-latency_secs', type=float, default=0.05, help='delay of every fake DOT response')
+    parser.add_argument('-latency_jitter_secs', type=float, default=0.05, help='extra uniform random delay')
+    parser.add_argument('-failure_rate', type=float, default=0.0, help='share of fake DOT requests failing with 503')
+    parser.add_argument('-frame_interval_secs', type=float, default=2.0, help='how long a fake camera shows a frame')
+    parser.add_argument('-fetch_mode', default='async', choices=['async', 'scheduled'], help='FETCH_MODE of saveimages')
+    parser.add_argument('-fetch_interval_secs', type=float, default=5.0,
+                        help='time between fetch cycles, or between the fetches of a camera when scheduled')
+    parser.add_argument('-max_fetches_per_sec', type=float,
+                        default=saveimages.SaveImagesConfig.SCHEDULER_MAX_FETCHES_PER_SEC,
+                        help='fetch rate cap when scheduled')
+    parser.add_argument('-duration_secs', type=float, default=60, help='how long to fetch for')
+    parser.add_argument('-drain_secs', type=float, default=60,
+                        help='how long the analyzer may take to empty the spool after fetching stopped')
+    parser.add_argument('-model', default=DEFAULT_MODEL, help=f'as -model of analyzeimages.py, or {STUB_MODEL}')
+    parser.add_argument('-stub_inference_secs', type=float, default=0.2, help=f'time per batch of -model {STUB_MODEL}')
+    parser.add_argument('-path_labels_map', default=os.path.join(ROOT, 'data', 'mscoco_label_map.pbtxt'),
+                        help='label map of the model')
+    parser.add_argument('-batch_size', type=int, default=1, help='as -batch_size of analyzeimages.py')
+    parser.add_argument('-batch_max_wait_secs', type=float, default=0.5, help='as -batch_max_wait_secs')
+    parser.add_argument('-decode_workers', type=int, default=4, help='as -decode_workers of analyzeimages.py')
+    parser.add_argument('-sink_workers', type=int, default=4, help='as -sink_workers of analyzeimages.py')
+    parser.add_argument('-annotate_every_secs', type=float, default=0,
+                        help='as -annotate_every_secs of analyzeimages.py, 0 to not annotate')
+    parser.add_argument('-skip_warmup', action='store_true', help='as -skip_warmup of analyzeimages.py')
+    parser.add_argument('-seed', type=int, default=0, help='seed of the fake DOT latency and failures')
+    parser.add_argument('-results', default=os.path.join(ROOT, 'benchmarks', 'results', 'e2e.jsonl'),
+                        help='JSON lines file the result is appended to')
+    args = parser.parse_args()
+    # The daemons log every frame, and every injected failure with its traceback
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(os.getenv('LOGLEVEL', 'CRITICAL'))
+
+    # The stand-ins accept any credentials, the daemons only need some
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        os.environ.setdefault(name, 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    saveimages.ACCESS_KEY = analyzeimages.ACCESS_KEY = os.environ['AWS_ACCESS_KEY_ID']
+    saveimages.SECRET_KEY = analyzeimages.SECRET_KEY = os.environ['AWS_SECRET_ACCESS_KEY']
+
+    settings = {k: v for k, v in vars(args).items() if k != 'results'}
+    images = load_images(args.images, args.limit)
+    result = {
+        'benchmark': 'e2e',
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'revision': git_revision(),
+        'host': {'cpus': os.cpu_count(), 'platform': platform.platform(), 'python': platform.python_version()},
+        'settings': settings,
+    }
+    print(f"Serving {len(images)} frames from {args.images} as {args.cameras} cameras for {args.duration_secs}s")
+    with tempfile.TemporaryDirectory() as work_directory, aws_stand_ins(), \
+            FakeDotServer(images, args.cameras, args.latency_secs, args.latency_jitter_secs, args.failure_rate,
+                          args.frame_interval_secs, seed=args.seed) as dot:
+        for name, url in dot.urls().items():
+            setattr(saveimages, name, url)
+        result.update(run(args, dot, work_directory))
+
+    previous = previous_result(args.results, settings)
+    save_result(args.results, result)
+    print_result(result, previous)
+    print(f"Saved to {args.results}")
+
+
+if __name__ == '__main__':
+    main()
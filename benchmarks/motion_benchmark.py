@@ -0,0 +1,73 @@
+r"""Tune the motion gate
+
+Replays the frames in data/images, which are consecutive frames of one camera, through MotionGate for a range of
+thresholds and reports the share of frames that would skip the detector. With -model, every frame also goes
+through the detector, and the report includes how far the carried-forward counts are from the real ones: the mean
+absolute error of the number of detections above the score threshold, over all frames and over the skipped ones.
+
+
+Example usage:
+    python benchmarks/motion_benchmark.py -images data/images -thresholds 0.005,0.01,0.02,0.05 -model ssd_mobilenet_v2
+"""
+import argparse
+import glob
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from framedecode import decode_image
+from motiongate import MotionGate
+
+DETECTION_LIMIT = .4
+
+
+def detection_counts(model, images):
+    from detectors import create_detector
+    with create_detector(model, device='/cpu:0') as detector:
+        return np.array([int(np.sum(detector.detect(image_np[None])[1] > DETECTION_LIMIT)) for image_np in images])
+
+
+def replay(images, threshold, interval_secs, max_reuse_secs):
+    """Per frame, the index of the frame whose counts it gets"""
+    gate = MotionGate(threshold, max_reuse_secs=max_reuse_secs)
+    sources = []
+    for i, image_np in enumerate(images):
+        reused = gate.check(0, image_np, i * interval_secs)
+        if reused is None:
+            gate.record(0, i * interval_secs, i)
+            reused = i
+        sources.append(reused)
+    return np.array(sources)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Skip rate and count error of the motion gate per threshold')
+    parser.add_argument('-images', default='data/images', help='directory of consecutive JPEG frames of one camera')
+    parser.add_argument('-limit', type=int, default=1000, help='number of frames to replay')
+    parser.add_argument('-thresholds', default='0.005,0.01,0.02,0.05,0.1', help='comma separated thresholds')
+    parser.add_argument('-interval_secs', type=float, default=1, help='seconds between consecutive frames')
+    parser.add_argument('-max_reuse_secs', type=int, default=300, help='MotionGate max_reuse_secs')
+    parser.add_argument('-model', help='detector model to measure the count error with, as -model of analyzeimages.py')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.images, '*.jpg')))[:args.limit]
+    images = [image_np for image_np in (decode_image(path) for path in paths) if image_np.size != 0]
+    counts = detection_counts(args.model, images) if args.model else None
+    print(f"Replaying {len(images)} frames from {args.images}")
+
+    for threshold in [float(v) for v in args.thresholds.split(',')]:
+        sources = replay(images, threshold, args.interval_secs, args.max_reuse_secs)
+        skipped = sources != np.arange(len(images))
+        line = f"{f'threshold={threshold}':<20}{100 * np.mean(skipped):>8.1f}% skipped"
+        if counts is not None:
+            errors = np.abs(counts[sources] - counts)
+            skipped_error = np.mean(errors[skipped]) if skipped.any() else 0.0
+            line += f"  mean abs count error {np.mean(errors):.3f}, {skipped_error:.3f} on skipped frames"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
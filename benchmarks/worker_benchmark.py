@@ -0,0 +1,84 @@
+r"""Benchmark multi-process CPU inference
+
+Sweeps the number of inference processes and the intra_op threads of each over the frames in data/images. Every
+worker runs the detection graph on CPU with its own session on an equal share of the frames, optionally pinned to
+its own cores, and all workers start together. Reports aggregate images/sec and images/sec per core used, and
+names the best configuration per core. Needs the detector backend and model given by -model.
+
+
+Example usage:
+    python benchmarks/worker_benchmark.py -images data/images -limit 200 -workers 1,2,4 -threads 1,2,4 -pin_cores
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from inferenceworkers import cores_for_worker, pin_to_cores
+
+
+def run_worker(index, paths, model, threads, pin_cores, barrier, results):
+    import numpy as np
+    from analyzeimages import AnalyzeImages
+    from detectors import CPU_DEVICE, create_detector
+    from framedecode import decode_image
+
+    if pin_cores:
+        pin_to_cores(cores_for_worker(index, threads))
+    images = [image_np for image_np in (decode_image(path) for path in paths) if image_np.size != 0]
+    config = AnalyzeImages.create_session_config(threads, 1)
+    with create_detector(model, CPU_DEVICE, config, threads) as detector:
+        # The first call builds the kernels, keep it out of the measurements
+        detector.detect(np.expand_dims(images[0], axis=0))
+        barrier.wait()
+        start = time.perf_counter()
+        for image_np in images:
+            detector.detect(np.expand_dims(image_np, axis=0))
+        results.put((len(images), time.perf_counter() - start))
+
+
+def measure(paths, model, num_workers, threads, pin_cores):
+    barrier = multiprocessing.Barrier(num_workers)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_worker, args=(i, paths[i::num_workers], model, threads,
+                                                                  pin_cores, barrier, results))
+                 for i in range(num_workers)]
+    for process in processes:
+        process.start()
+    measurements = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    images_per_sec = sum(count for count, _ in measurements) / max(elapsed for _, elapsed in measurements)
+    cores = min(num_workers * threads, os.cpu_count())
+    print(f"{f'workers={num_workers} threads={threads}':<24}{images_per_sec:>10.2f} images/s"
+          f"{images_per_sec / cores:>10.2f} images/s/core")
+    return images_per_sec / cores
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark multi-process CPU inference over camera frames')
+    parser.add_argument('-images', default='data/images', help='directory of JPEG frames')
+    parser.add_argument('-limit', type=int, default=200, help='number of frames to run through the model')
+    parser.add_argument('-workers', default='1,2,4', help='comma separated worker counts to compare')
+    parser.add_argument('-threads', default='1,2,4', help='comma separated intra_op thread counts to compare')
+    parser.add_argument('-model', default='faster_rcnn_resnet50', help='detector model, as -model of analyzeimages.py')
+    parser.add_argument('-pin_cores', action='store_true', help='pin each worker to its own cores')
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.images, '*.jpg')))[:args.limit]
+    print(f"Running {len(paths)} frames from {args.images} on {os.cpu_count()} cores")
+    results = {}
+    for num_workers in [int(v) for v in args.workers.split(',')]:
+        for threads in [int(v) for v in args.threads.split(',')]:
+            results[(num_workers, threads)] = measure(paths, args.model, num_workers, threads, args.pin_cores)
+    num_workers, threads = max(results, key=results.get)
+    print(f"Best per core: workers={num_workers} threads={threads} at {results[(num_workers, threads)]:.2f} "
+          f"images/s/core")
+
+
+if __name__ == '__main__':
+    main()
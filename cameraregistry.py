@@ -0,0 +1,150 @@
+r"""Persistent registry of DOT camera IDs
+
+Resolving a camera ID means fetching one google_popup.php page per camera location, which takes minutes when done
+sequentially for ~1000 locations. The registry keeps the resolved CameraObjects on disk along with when each one was
+resolved and a fingerprint of the marker it came from. On restart, only locations that are new, whose marker
+changed, that failed to resolve last time, or whose entry is older than REGISTRY_MAX_AGE_SECS are resolved again,
+and those are resolved concurrently.
+
+
+Example usage:
+    registry = CameraRegistry("/tmp/camera_registry.json")
+    camera_objects = registry.refresh(SaveImages.get_camera_objects_without_camera_id())
+"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from saveimages import SaveImages, SaveImagesConfig, CameraObject
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+REGISTRY_VERSION = 1
+
+
+class RegistryEntry:
+
+    def __init__(self, camera_object, fingerprint, resolved_at) -> None:
+        super().__init__()
+
+        self.camera_object = camera_object
+        self.fingerprint = fingerprint
+        self.resolved_at = resolved_at
+
+    def to_json(self):
+        return {'camera': self.camera_object.__dict__, 'fingerprint': self.fingerprint, 'resolvedAt': self.resolved_at}
+
+    @staticmethod
+    def from_json(data):
+        camera_object = CameraObject()
+        camera_object.__dict__.update(data['camera'])
+        return RegistryEntry(camera_object, data['fingerprint'], data['resolvedAt'])
+
+
+class CameraRegistry:
+
+    def __init__(self, path,
+                 num_workers=SaveImagesConfig.REGISTRY_NUM_WORKERS,
+                 max_age_secs=SaveImagesConfig.REGISTRY_MAX_AGE_SECS):
+        self._path = path
+        self._num_workers = num_workers
+        self._max_age_secs = max_age_secs
+
+    @staticmethod
+    def fingerprint(camera_object):
+        """Identifies the marker a camera object was built from, so a moved or renamed location is re-resolved"""
+        return '|'.join(str(v) for v in [camera_object.name, camera_object.latitude, camera_object.longitude])
+
+    def load(self):
+        """Return the cached entries keyed by location ID, or an empty dict when there is no usable cache"""
+        try:
+            with open(self._path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (IOError, ValueError):
+            log.exception(f"Could not read camera registry={self._path}, resolving all cameras")
+            return {}
+
+        try:
+            if data.get('version') != REGISTRY_VERSION:
+                log.warning(f"Ignoring camera registry={self._path} with version={data.get('version')}")
+                return {}
+            entries = [RegistryEntry.from_json(e) for e in data['cameras']]
+            return {str(e.camera_object.locationId): e for e in entries}
+        except (AttributeError, KeyError, TypeError):
+            # Valid JSON that is not a registry, or has malformed entries
+            log.exception(f"Could not parse camera registry={self._path}, resolving all cameras")
+            return {}
+
+    def save(self, entries):
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'version': REGISTRY_VERSION,
+                'savedAt': time.time(),
+                'cameras': [e.to_json() for e in entries]
+            }, f)
+        os.replace(tmp_path, self._path)
+
+    def refresh(self, camera_objects):
+        """Fill camera IDs for the current list of locations, resolving only what the cache cannot answer
+
+        Returns the camera objects that have a camera ID, in the order of the given list.
+        """
+        now = time.time()
+        cached = self.load()
+        entries = []
+        to_resolve = []
+        for camera_object in camera_objects:
+            fingerprint = CameraRegistry.fingerprint(camera_object)
+            entry = cached.get(str(camera_object.locationId))
+            if entry is not None and entry.fingerprint == fingerprint:
+                # Keep the cached ID even when it is due for re-resolution, in case the refresh fails
+                camera_object.cameraId = entry.camera_object.cameraId
+                entry = RegistryEntry(camera_object, fingerprint, entry.resolved_at)
+                if camera_object.cameraId is None or now - entry.resolved_at >= self._max_age_secs:
+                    to_resolve.append(entry)
+            else:
+                entry = RegistryEntry(camera_object, fingerprint, 0)
+                to_resolve.append(entry)
+            entries.append(entry)
+
+        log.info(f"Camera registry: {len(entries) - len(to_resolve)} cached, {len(to_resolve)} to resolve, "
+                 f"{len(set(cached) - set(str(c.locationId) for c in camera_objects))} removed")
+        if to_resolve:
+            self._resolve(to_resolve)
+            self.save(entries)
+        elif len(cached) != len(entries):
+            self.save(entries)
+
+        resolved = [e.camera_object for e in entries if e.camera_object.cameraId is not None]
+        if len(resolved) < len(entries):
+            log.warning(f"Could not resolve camera IDs for {len(entries) - len(resolved)} locations")
+        return resolved
+
+    def _resolve(self, entries):
+        start_time = time.time()
+        with requests.Session() as session, ThreadPoolExecutor(max_workers=self._num_workers) as executor:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self._num_workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            for entry, camera_id in zip(entries, executor.map(lambda e: self._resolve_one(session, e), entries)):
+                if camera_id is not None:
+                    entry.camera_object.cameraId = camera_id
+                    entry.resolved_at = time.time()
+        log.info(f"Resolved {len(entries)} camera locations in {time.time() - start_time:.1f}s")
+
+    @staticmethod
+    def _resolve_one(session, entry):
+        location_id = entry.camera_object.locationId
+        try:
+            return SaveImages.get_dot_camera_id_for_location_id(location_id, session=session)
+        except (requests.RequestException, ValueError, IndexError):
+            log.exception(f"Could not resolve camera ID for location ID={location_id}")
+            return None
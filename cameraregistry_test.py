@@ -0,0 +1,73 @@
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from cameraregistry import *
+
+
+class TestCameraRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'registry.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def make_locations(*location_ids, name="1 Ave @ 110 St"):
+        camera_objects = []
+        for location_id in location_ids:
+            co = CameraObject()
+            co.locationId = str(location_id)
+            co.latitude = "40.79142677512476"
+            co.longitude = "-73.93807411193848"
+            co.name = name
+            camera_objects.append(co)
+        return camera_objects
+
+    @staticmethod
+    def fake_camera_id(location_id, session=None):
+        return int(location_id) + 1000
+
+    def test_refresh_resolves_everything_without_cache(self):
+        with patch.object(SaveImages, 'get_dot_camera_id_for_location_id', side_effect=self.fake_camera_id) as mock_id:
+            camera_objects = CameraRegistry(self.path).refresh(self.make_locations(1, 2, 3))
+            assert mock_id.call_count == 3
+        assert [c.cameraId for c in camera_objects] == [1001, 1002, 1003]
+        assert os.path.exists(self.path)
+
+    def test_refresh_only_resolves_new_and_changed_locations(self):
+        with patch.object(SaveImages, 'get_dot_camera_id_for_location_id', side_effect=self.fake_camera_id):
+            CameraRegistry(self.path).refresh(self.make_locations(1, 2, 3))
+
+        locations = self.make_locations(1, 2) + self.make_locations(3, name="moved") + self.make_locations(4)
+        with patch.object(SaveImages, 'get_dot_camera_id_for_location_id', side_effect=self.fake_camera_id) as mock_id:
+            camera_objects = CameraRegistry(self.path).refresh(locations)
+            resolved = sorted(c[0][0] for c in mock_id.call_args_list)
+        assert resolved == ['3', '4']
+        assert [c.cameraId for c in camera_objects] == [1001, 1002, 1003, 1004]
+
+    def test_refresh_keeps_stale_id_when_resolution_fails(self):
+        with patch.object(SaveImages, 'get_dot_camera_id_for_location_id', side_effect=self.fake_camera_id):
+            CameraRegistry(self.path).refresh(self.make_locations(1))
+
+        with patch.object(SaveImages, 'get_dot_camera_id_for_location_id', side_effect=requests.ConnectionError):
+            camera_objects = CameraRegistry(self.path, max_age_secs=0).refresh(self.make_locations(1, 2))
+        assert len(camera_objects) == 1
+        assert camera_objects[0].cameraId == 1001
+
+    def test_load_ignores_corrupt_cache(self):
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        assert CameraRegistry(self.path).load() == {}
+
+    def test_refresh_resolves_everything_when_cache_is_not_a_registry(self):
+        for data in [{'version': REGISTRY_VERSION}, {'version': REGISTRY_VERSION, 'cameras': [{'camera': {}}]},
+                     {'version': REGISTRY_VERSION, 'cameras': None}, ['not', 'a', 'registry']]:
+            with open(self.path, 'w') as f:
+                json.dump(data, f)
+            assert CameraRegistry(self.path).load() == {}
+            with patch.object(SaveImages, 'get_dot_camera_id_for_location_id', side_effect=self.fake_camera_id):
+                camera_objects = CameraRegistry(self.path).refresh(self.make_locations(1, 2))
+            assert [c.cameraId for c in camera_objects] == [1001, 1002]
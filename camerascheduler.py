@@ -0,0 +1,159 @@
+r"""Per-camera fetch scheduler
+
+Instead of fetching every camera in one burst and then sleeping, each camera has its own next-due time in a priority
+queue. Initial due times are spread evenly over one interval, so requests go out at a steady rate rather than all
+at once. A camera that fails is retried after an exponential backoff with jitter, so cameras that are offline stop
+costing a request every cycle. A token bucket caps the global fetch rate.
+
+
+Example usage:
+    scheduler = CameraScheduler(camera_objects, interval_secs=15, max_fetches_per_sec=100)
+    fetcher.run_scheduled(scheduler)
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+
+from saveimages import SaveImagesConfig
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` acquisitions per second with bursts of up to `burst`"""
+
+    def __init__(self, rate, burst=1, clock=time.monotonic):
+        self._rate = float(rate)
+        self._burst = float(burst)
+        self._clock = clock
+        self._tokens = float(burst)
+        self._updated_at = clock()
+
+    def try_acquire(self):
+        """Take a token and return 0, or return the number of seconds until a token is available"""
+        now = self._clock()
+        self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+
+class CameraSchedule:
+
+    def __init__(self, camera_object, next_due) -> None:
+        super().__init__()
+
+        self.camera_object = camera_object
+        self.next_due = next_due
+        self.failures = 0
+
+    def __repr__(self):
+        return f"{self.camera_object} due={self.next_due:.1f} failures={self.failures}"
+
+
+class CameraScheduler:
+
+    def __init__(self, camera_objects,
+                 interval_secs=SaveImagesConfig.SCHEDULER_INTERVAL_SECS,
+                 max_fetches_per_sec=SaveImagesConfig.SCHEDULER_MAX_FETCHES_PER_SEC,
+                 backoff_base_secs=SaveImagesConfig.SCHEDULER_BACKOFF_BASE_SECS,
+                 backoff_max_secs=SaveImagesConfig.SCHEDULER_BACKOFF_MAX_SECS,
+                 jitter=SaveImagesConfig.SCHEDULER_JITTER,
+                 clock=time.monotonic,
+                 rng=None):
+        self._interval_secs = interval_secs
+        self._backoff_base_secs = backoff_base_secs
+        self._backoff_max_secs = backoff_max_secs
+        self._jitter = jitter
+        self._clock = clock
+        self._rng = rng or random.Random()
+        self._rate_limiter = RateLimiter(max_fetches_per_sec, clock=clock)
+        self._counter = itertools.count()
+        self._heap = []
+
+        now = clock()
+        total = len(camera_objects)
+        for i, camera_object in enumerate(camera_objects):
+            self._push(CameraSchedule(camera_object, now + interval_secs * i / max(total, 1)))
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _push(self, schedule):
+        # The counter breaks ties so CameraSchedule objects are never compared
+        heapq.heappush(self._heap, (schedule.next_due, next(self._counter), schedule))
+
+    def pop_due(self):
+        """Return (schedule, 0) when a camera may be fetched now, else (None, seconds to wait before asking again)"""
+        if not self._heap:
+            return None, 1.0
+        wait = self._heap[0][0] - self._clock()
+        if wait > 0:
+            return None, wait
+        wait = self._rate_limiter.try_acquire()
+        if wait > 0:
+            return None, wait
+        return heapq.heappop(self._heap)[2], 0.0
+
+    def backoff_secs(self, failures):
+        delay = min(self._backoff_base_secs * 2 ** (failures - 1), self._backoff_max_secs)
+        return delay * self._rng.uniform(1 - self._jitter, 1 + self._jitter)
+
+    def report(self, schedule, success):
+        """Put a camera back in the queue after a fetch attempt"""
+        now = self._clock()
+        if success:
+            if schedule.failures > 0:
+                log.info(f"Camera recovered after {schedule.failures} failures: {schedule.camera_object}")
+            schedule.failures = 0
+            schedule.next_due = now + self._interval_secs
+        else:
+            schedule.failures += 1
+            schedule.next_due = now + self.backoff_secs(schedule.failures)
+        self._push(schedule)
+
+    def offline_count(self):
+        return sum(1 for _, _, s in self._heap if s.failures > 0)
+
+    async def run(self, fetch_camera, should_fetch=None, stop_event=None):
+        """Fetch cameras as they become due until stop_event is set
+
+        fetch_camera is a coroutine function taking a CameraObject and returning True on success. should_fetch is an
+        optional callable checked at most once a second; while it returns False, due cameras wait in the queue.
+        """
+        in_flight = set()
+        fetch_allowed, checked_at = True, None
+
+        async def fetch(schedule):
+            try:
+                success = await fetch_camera(schedule.camera_object)
+            except Exception:
+                log.exception(f"Fetch failed for camera {schedule.camera_object}")
+                success = False
+            self.report(schedule, success)
+
+        while stop_event is None or not stop_event.is_set():
+            if should_fetch is not None and (checked_at is None or self._clock() - checked_at >= 1.0):
+                fetch_allowed, checked_at = should_fetch(), self._clock()
+            if not fetch_allowed:
+                await asyncio.sleep(1.0)
+                continue
+
+            schedule, wait = self.pop_due()
+            if schedule is None:
+                await asyncio.sleep(min(wait, 1.0))
+                continue
+
+            task = asyncio.ensure_future(fetch(schedule))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+        if in_flight:
+            await asyncio.gather(*in_flight)
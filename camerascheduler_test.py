@@ -0,0 +1,98 @@
+import asyncio
+import random
+import unittest
+from camerascheduler import *
+from saveimages import CameraObject
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCameraScheduler(unittest.TestCase):
+
+    @staticmethod
+    def make_cameras(count):
+        cameras = []
+        for i in range(count):
+            co = CameraObject()
+            co.cameraId = i
+            cameras.append(co)
+        return cameras
+
+    def test_initial_due_times_are_spread_over_interval(self):
+        clock = FakeClock()
+        scheduler = CameraScheduler(self.make_cameras(4), interval_secs=20, max_fetches_per_sec=1000, clock=clock)
+        due = sorted(entry[0] - clock.now for entry in scheduler._heap)
+        assert due == [0, 5, 10, 15]
+
+    def test_pop_due_waits_for_due_time(self):
+        clock = FakeClock()
+        scheduler = CameraScheduler(self.make_cameras(2), interval_secs=10, max_fetches_per_sec=1000, clock=clock)
+        schedule, wait = scheduler.pop_due()
+        assert schedule.camera_object.cameraId == 0
+        schedule, wait = scheduler.pop_due()
+        assert schedule is None
+        assert wait == 5
+        clock.now += 5
+        schedule, wait = scheduler.pop_due()
+        assert schedule.camera_object.cameraId == 1
+
+    def test_rate_limit_caps_fetches(self):
+        clock = FakeClock()
+        scheduler = CameraScheduler(self.make_cameras(10), interval_secs=0, max_fetches_per_sec=2, clock=clock)
+        assert scheduler.pop_due()[0] is not None
+        schedule, wait = scheduler.pop_due()
+        assert schedule is None
+        assert wait == 0.5
+        clock.now += 0.5
+        assert scheduler.pop_due()[0] is not None
+
+    def test_failures_back_off_exponentially_and_reset_on_success(self):
+        clock = FakeClock()
+        scheduler = CameraScheduler(self.make_cameras(1), interval_secs=10, max_fetches_per_sec=1000,
+                                    backoff_base_secs=30, backoff_max_secs=100, jitter=0, clock=clock)
+        schedule, _ = scheduler.pop_due()
+        delays = []
+        for _ in range(4):
+            scheduler.report(schedule, False)
+            delays.append(schedule.next_due - clock.now)
+            clock.now = schedule.next_due
+            schedule, _ = scheduler.pop_due()
+        assert delays == [30, 60, 100, 100]
+        assert scheduler.offline_count() == 0
+        scheduler.report(schedule, True)
+        assert schedule.failures == 0
+        assert schedule.next_due - clock.now == 10
+
+    def test_backoff_jitter_stays_in_bounds(self):
+        scheduler = CameraScheduler([], backoff_base_secs=10, backoff_max_secs=1000, jitter=0.2, rng=random.Random(1))
+        for _ in range(100):
+            assert 16 <= scheduler.backoff_secs(2) <= 24
+
+    def test_run_fetches_due_cameras_until_stopped(self):
+        scheduler = CameraScheduler(self.make_cameras(3), interval_secs=60, max_fetches_per_sec=1000)
+        fetched = []
+
+        async def fetch_camera(camera_object):
+            fetched.append(camera_object.cameraId)
+            if len(fetched) == 1:
+                stop_event.set()
+            return camera_object.cameraId != 0
+
+        async def run():
+            await scheduler.run(fetch_camera, stop_event=stop_event)
+
+        loop = asyncio.new_event_loop()
+        try:
+            stop_event = asyncio.Event()
+            loop.run_until_complete(run())
+        finally:
+            loop.close()
+        assert fetched == [0]
+        assert scheduler.offline_count() == 1
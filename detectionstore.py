@@ -0,0 +1,285 @@
+r"""Raw detection store
+
+Only the thresholded counts reach DynamoDB, so changing DETECTION_LIMIT or counting another class used to mean
+re-inferring the archived frames. The analyzer also appends the raw detections of every frame, down to a low score
+floor, to a local columnar store. Counts for any thresholds and classes can then be recomputed from the store
+with a few vectorized passes (see recountdetections.py).
+
+The store is a directory of segments. A writer appends to its own segment, named after the day, host and process,
+and starts a new one when the day changes. A segment holds one raw little-endian file per column, which is
+memory-mapped for reading, and a meta.json with the row counts:
+
+    frames      location_id int32, timestamp int64, source_timestamp int64, first int64, count int32
+    detections  class_id uint16, score float32, box uint16 x4 (ymin, xmin, ymax, xmax in frame pixels)
+
+first and count locate the detections of a frame. A frame whose counts were carried forward by the motion gate
+has no detections of its own and refers to its reference frame through source_timestamp (which is the frame's
+own timestamp otherwise). Columns are appended before meta.json is atomically replaced, so a reader only ever sees
+complete rows, even after a crash.
+
+
+Example usage:
+    writer = DetectionStoreWriter("/data/detections")
+    writer.add(368, 1539560991, boxes, scores, classes, num, image_shape=(240, 352))
+    writer.close()
+
+    frames, detections = DetectionStore("/data/detections").load(start=1538352000, end=1541030400)
+"""
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+STORE_VERSION = 1
+META_NAME = 'meta.json'
+DEFAULT_SCORE_FLOOR = .05
+
+FRAME_COLUMNS = (
+    ('location_id', '<i4'),
+    ('timestamp', '<i8'),
+    ('source_timestamp', '<i8'),
+    ('first', '<i8'),
+    ('count', '<i4'),
+)
+DETECTION_COLUMNS = (
+    ('class_id', '<u2'),
+    ('score', '<f4'),
+    ('box', '<u2', 4),
+)
+
+
+def column_shape(column, rows):
+    return (rows,) + tuple(column[2:])
+
+
+class DetectionStoreWriter:
+    """Buffers detections of frames and appends them to this process's segment every flush_frames frames"""
+
+    def __init__(self, root, score_floor=DEFAULT_SCORE_FLOOR, flush_frames=500, clock=datetime.date.today):
+        self._root = root
+        self._score_floor = score_floor
+        self._flush_frames = flush_frames
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._segment = None
+        self._segment_day = None
+        # Rows already in the current segment
+        self._segment_frames = 0
+        self._segment_detections = 0
+        self._pending_rows = 0
+        self._pending_frames = {name: [] for name, *_ in FRAME_COLUMNS}
+        self._pending_detections = {name: [] for name, *_ in DETECTION_COLUMNS}
+        self._pending_count = 0
+
+    def add(self, location_id, timestamp, boxes, scores, classes, num, image_shape, offset=(0, 0)):
+        """Record the detections of one frame
+
+        boxes are normalized to the analyzed image of image_shape, which sits at offset=(top, left) in the frame
+        when only a region of interest was analyzed.
+        """
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        scores = np.asarray(scores).reshape(-1)
+        classes = np.asarray(classes).reshape(-1)
+        keep = np.arange(len(scores)) < int(np.asarray(num).reshape(-1)[0])
+        keep &= scores >= self._score_floor
+        height, width = image_shape[:2]
+        pixels = boxes[keep] * [height, width, height, width] + [offset[0], offset[1], offset[0], offset[1]]
+        with self._lock:
+            self._add_frame(location_id, timestamp, timestamp, int(keep.sum()))
+            self._pending_detections['class_id'].append(classes[keep].astype(np.uint16))
+            self._pending_detections['score'].append(scores[keep].astype(np.float32))
+            self._pending_detections['box'].append(np.clip(np.rint(pixels), 0, 65535).astype(np.uint16))
+            self._flush_if_full()
+
+    def add_reused(self, location_id, timestamp, source_timestamp):
+        """Record a frame whose counts were carried forward from the frame at source_timestamp"""
+        with self._lock:
+            self._add_frame(location_id, timestamp, source_timestamp, 0)
+            self._flush_if_full()
+
+    def _add_frame(self, location_id, timestamp, source_timestamp, count):
+        pending = self._pending_frames
+        pending['location_id'].append(int(location_id))
+        pending['timestamp'].append(int(timestamp))
+        pending['source_timestamp'].append(int(source_timestamp))
+        # Relative to the pending detections until the flush, when the segment they go to is known
+        pending['first'].append(self._pending_rows)
+        pending['count'].append(count)
+        self._pending_rows += count
+        self._pending_count += 1
+
+    def _flush_if_full(self):
+        if self._pending_count >= self._flush_frames:
+            self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+    def _segment_directory(self):
+        today = self._clock()
+        if self._segment is None or today != self._segment_day:
+            name = f"{today.isoformat()}-{socket.gethostname()}-{os.getpid()}"
+            self._segment = os.path.join(self._root, name)
+            self._segment_day = today
+            os.makedirs(self._segment, exist_ok=True)
+            # A restarted process with a recycled pid keeps appending to the same segment, after dropping any rows
+            # its predecessor appended without recording them in meta.json
+            meta = read_meta(self._segment)
+            self._segment_frames = meta['frames'] if meta else 0
+            self._segment_detections = meta['detections'] if meta else 0
+            for column in FRAME_COLUMNS:
+                _truncate(self._segment, column, self._segment_frames)
+            for column in DETECTION_COLUMNS:
+                _truncate(self._segment, column, self._segment_detections)
+        return self._segment
+
+    def _flush(self):
+        if not self._pending_count:
+            return
+        segment = self._segment_directory()
+        self._pending_frames['first'] = [first + self._segment_detections for first in self._pending_frames['first']]
+        for name, dtype, *_ in DETECTION_COLUMNS:
+            values = self._pending_detections[name]
+            if values:
+                _append(segment, name, np.concatenate(values).astype(dtype))
+        for name, dtype, *_ in FRAME_COLUMNS:
+            _append(segment, name, np.asarray(self._pending_frames[name], dtype=dtype))
+        self._segment_frames += self._pending_count
+        self._segment_detections += self._pending_rows
+        write_meta(segment, self._segment_frames, self._segment_detections)
+        log.debug(f"Flushed {self._pending_count} frames to detection store segment={segment}")
+        self._pending_frames = {name: [] for name, *_ in FRAME_COLUMNS}
+        self._pending_detections = {name: [] for name, *_ in DETECTION_COLUMNS}
+        self._pending_count = 0
+        self._pending_rows = 0
+
+
+def _append(segment, name, values):
+    with open(os.path.join(segment, f"{name}.bin"), 'ab') as f:
+        values.tofile(f)
+
+
+def _truncate(segment, column, rows):
+    path = os.path.join(segment, f"{column[0]}.bin")
+    size = int(np.prod(column_shape(column, rows))) * np.dtype(column[1]).itemsize
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        with open(path, 'r+b') as f:
+            f.truncate(size)
+
+
+def read_meta(segment):
+    try:
+        with open(os.path.join(segment, META_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_meta(segment, frames, detections):
+    path = os.path.join(segment, META_NAME)
+    with open(path + '.part', 'w') as f:
+        json.dump({'version': STORE_VERSION, 'frames': frames, 'detections': detections}, f)
+    os.replace(path + '.part', path)
+
+
+def _map_column(segment, column, rows):
+    name, dtype = column[:2]
+    if rows == 0:
+        return np.empty(column_shape(column, 0), dtype=dtype)
+    return np.memmap(os.path.join(segment, f"{name}.bin"), dtype=dtype, mode='r', shape=column_shape(column, rows))
+
+
+class DetectionStore:
+    """Reads the segments of a store as memory-mapped columns"""
+
+    def __init__(self, root) -> None:
+        super().__init__()
+
+        self._root = root
+
+    def segments(self):
+        if not os.path.isdir(self._root):
+            return []
+        return sorted(os.path.join(self._root, name) for name in os.listdir(self._root)
+                      if os.path.isfile(os.path.join(self._root, name, META_NAME)))
+
+    @staticmethod
+    def read_segment(segment):
+        """(frames, detections), each a dict of column name to memory-mapped array"""
+        meta = read_meta(segment)
+        frames = {column[0]: _map_column(segment, column, meta['frames']) for column in FRAME_COLUMNS}
+        detections = {column[0]: _map_column(segment, column, meta['detections']) for column in DETECTION_COLUMNS}
+        return frames, detections
+
+    def load(self, start=None, end=None, location_ids=None):
+        """Frames with start <= timestamp < end of the given cameras, and their detections, across all segments
+
+        The detection rows of the returned frames are contiguous: frames['first'] indexes the returned detections.
+        """
+        all_frames, all_detections = [], []
+        offset = 0
+        for segment in self.segments():
+            frames, detections = DetectionStore.read_segment(segment)
+            keep = np.ones(len(frames['timestamp']), dtype=bool)
+            if start is not None:
+                keep &= frames['timestamp'] >= start
+            if end is not None:
+                keep &= frames['timestamp'] < end
+            if location_ids is not None:
+                keep &= np.isin(frames['location_id'], list(location_ids))
+            if not keep.any():
+                continue
+            selected = {name: np.asarray(values[keep]) for name, values in frames.items()}
+            rows = np.repeat(selected['first'], selected['count']) + _ranges(selected['count'])
+            all_detections.append({name: np.asarray(values[rows]) for name, values in detections.items()})
+            selected['first'] = offset + np.concatenate([[0], np.cumsum(selected['count'])[:-1]]).astype(np.int64)
+            offset += len(rows)
+            all_frames.append(selected)
+        return _concat(all_frames, FRAME_COLUMNS), _concat(all_detections, DETECTION_COLUMNS)
+
+
+def _ranges(counts):
+    """0..count-1 for each count, concatenated"""
+    counts = np.asarray(counts, dtype=np.int64)
+    if counts.sum() == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) - np.repeat(starts, counts)
+
+
+def _concat(parts, columns):
+    if not parts:
+        return {column[0]: np.empty(column_shape(column, 0), dtype=column[1]) for column in columns}
+    return {column[0]: np.concatenate([part[column[0]] for part in parts]) for column in columns}
+
+
+def recount(frames, detections, counter):
+    """[frames, len(counter.class_names)] counts of the loaded frames for the counter's classes and thresholds
+
+    Frames whose counts were carried forward get the recomputed counts of their reference frame, when it is loaded.
+    """
+    num_frames = len(frames['timestamp'])
+    frame_index = np.repeat(np.arange(num_frames), frames['count'])
+    counts = counter.count_flat(frame_index, detections['score'], detections['class_id'], num_frames)
+
+    reused = frames['source_timestamp'] != frames['timestamp']
+    if reused.any():
+        keys = frames['location_id'].astype(np.int64) * 10 ** 10 + frames['timestamp']
+        source_keys = frames['location_id'].astype(np.int64) * 10 ** 10 + frames['source_timestamp']
+        order = np.argsort(keys, kind='stable')
+        positions = np.clip(np.searchsorted(keys, source_keys, sorter=order), 0, num_frames - 1)
+        sources = order[positions]
+        found = reused & (keys[sources] == source_keys)
+        counts[found] = counts[sources[found]]
+    return counts
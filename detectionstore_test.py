@@ -0,0 +1,88 @@
+import datetime
+import shutil
+import tempfile
+import unittest
+from detectionstore import *
+from postprocess import DetectionCounter
+
+CATEGORY_INDEX = {1: {'id': 1, 'name': 'pedestrian'}, 3: {'id': 3, 'name': 'car'}}
+
+
+def detections(scores, classes):
+    k = len(scores)
+    boxes = np.tile([[0.25, 0.5, 0.75, 1.0]], (1, k, 1))
+    return boxes, np.array([scores]), np.array([classes], dtype=np.float32), np.array([float(k)])
+
+
+class TestDetectionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_round_trip_keeps_detections_above_floor_in_frame_pixels(self):
+        writer = DetectionStoreWriter(self.root, score_floor=0.1)
+        writer.add(368, 1000, *detections([0.9, 0.3, 0.05], [3, 1, 3]), image_shape=(100, 200), offset=(10, 20))
+        writer.add(261, 1001, *detections([], []), image_shape=(100, 200))
+        writer.close()
+
+        frames, dets = DetectionStore(self.root).load()
+        assert frames['location_id'].tolist() == [368, 261]
+        assert frames['count'].tolist() == [2, 0]
+        assert dets['class_id'].tolist() == [3, 1]
+        np.testing.assert_allclose(dets['score'], [0.9, 0.3], rtol=1e-6)
+        assert dets['box'][0].tolist() == [35, 120, 85, 220]
+
+    def test_recount_with_other_thresholds(self):
+        writer = DetectionStoreWriter(self.root, score_floor=0.1, flush_frames=1)
+        writer.add(368, 1000, *detections([0.9, 0.5, 0.3], [3, 3, 1]), image_shape=(100, 200))
+        writer.add(368, 1015, *detections([0.35], [3]), image_shape=(100, 200))
+        writer.add_reused(368, 1030, 1000)
+        writer.close()
+
+        frames, dets = DetectionStore(self.root).load()
+        counts = recount(frames, dets, DetectionCounter(CATEGORY_INDEX, 0.4))
+        assert counts.tolist() == [[0, 2], [0, 0], [0, 2]]
+        counts = recount(frames, dets, DetectionCounter(CATEGORY_INDEX, 0.4, {'car': 0.6, 'pedestrian': 0.2}))
+        assert counts.tolist() == [[1, 1], [0, 0], [1, 1]]
+
+    def test_load_filters_by_time_and_camera_across_segments(self):
+        days = iter([datetime.date(2018, 10, 1), datetime.date(2018, 10, 2)])
+        writer = DetectionStoreWriter(self.root, flush_frames=1, clock=lambda: next(days))
+        writer.add(368, 1000, *detections([0.9], [3]), image_shape=(100, 200))
+        writer.add(261, 2000, *detections([0.8, 0.7], [1, 1]), image_shape=(100, 200))
+        assert len(DetectionStore(self.root).segments()) == 2
+
+        frames, dets = DetectionStore(self.root).load(start=1500)
+        assert frames['timestamp'].tolist() == [2000]
+        assert frames['first'].tolist() == [0]
+        assert dets['class_id'].tolist() == [1, 1]
+        frames, _ = DetectionStore(self.root).load(location_ids=[368])
+        assert frames['timestamp'].tolist() == [1000]
+
+    def test_rows_not_in_meta_are_ignored_and_dropped_on_reopen(self):
+        writer = DetectionStoreWriter(self.root, flush_frames=1)
+        writer.add(368, 1000, *detections([0.9], [3]), image_shape=(100, 200))
+        segment = DetectionStore(self.root).segments()[0]
+        # A crash after appending a column but before updating meta.json
+        with open(os.path.join(segment, 'score.bin'), 'ab') as f:
+            np.array([0.5], dtype='<f4').tofile(f)
+        frames, dets = DetectionStore(self.root).load()
+        assert len(dets['score']) == 1
+
+        DetectionStoreWriter(self.root, flush_frames=1).add(368, 1015, *detections([0.8], [1]),
+                                                            image_shape=(100, 200))
+        frames, dets = DetectionStore(self.root).load()
+        assert frames['first'].tolist() == [0, 1]
+        np.testing.assert_allclose(dets['score'], [0.9, 0.8], rtol=1e-6)
+
+    def test_empty_store(self):
+        frames, dets = DetectionStore(self.root).load()
+        assert len(frames['timestamp']) == 0
+        assert recount(frames, dets, DetectionCounter(CATEGORY_INDEX)).shape == (0, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+r"""Object detector backends for the analyzer
+
+Every backend takes an [N, H, W, 3] uint8 batch and returns the outputs of the TensorFlow object detection API:
+    boxes    [N, K, 4] float, normalized (ymin, xmin, ymax, xmax)
+    scores   [N, K] float, sorted descending
+    classes  [N, K] float, label map IDs (1-based COCO IDs for the COCO models)
+    num      [N] float, number of valid detections per frame
+
+Backends:
+    tf      a frozen TensorFlow 1 graph exported by the object detection API
+    onnx    an ONNX model run with ONNX Runtime, e.g. an SSD graph converted with tf2onnx, optionally quantized
+    opencv  a frozen TensorFlow SSD graph run with the OpenCV DNN module, with its text graph config
+
+Models are selected by name from MODELS, or given as "<backend>:<model path>[:<config path>]". onnxruntime and
+opencv-python are only needed for their backends and are imported when the backend is created.
+
+The tf backend records a full trace of its next session runs when its tracer asks for them, see profiling.py.
+
+With a cache directory, the tf and onnx backends load an optimized copy of the model from graphcache.py. warm_up()
+runs a blank batch through the model so the one-off costs of the first run are paid before real frames arrive.
+
+
+Example usage:
+    detector = create_detector('ssd_mobilenet_v2', num_threads=4)
+    boxes, scores, classes, num = detector.detect(np.stack(images))
+    detector.close()
+"""
+import logging
+import os
+import time
+
+import numpy as np
+
+from graphcache import load_artifact, load_optimized_graph_def, optimized_onnx_model, read_graph_def
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+GPU_DEVICE = '/gpu:1'
+CPU_DEVICE = '/cpu:0'
+
+BACKEND_TF = 'tf'
+BACKEND_ONNX = 'onnx'
+BACKEND_OPENCV = 'opencv'
+BACKENDS = (BACKEND_TF, BACKEND_ONNX, BACKEND_OPENCV)
+
+DEFAULT_MODEL = 'faster_rcnn_resnet50'
+
+# name: (backend, model path, config path)
+MODELS = {
+    'faster_rcnn_resnet50': (BACKEND_TF, './faster_rcnn_resnet50_coco_2018_01_28/frozen_inference_graph.pb', None),
+    'ssd_mobilenet_v2': (BACKEND_TF, './ssd_mobilenet_v2_coco_2018_03_29/frozen_inference_graph.pb', None),
+    'ssd_mobilenet_v2_onnx': (BACKEND_ONNX, './ssd_mobilenet_v2_coco_2018_03_29/model.onnx', None),
+    'ssd_mobilenet_v2_int8': (BACKEND_ONNX, './ssd_mobilenet_v2_coco_2018_03_29/model.int8.onnx', None),
+    'ssd_mobilenet_v2_opencv': (BACKEND_OPENCV, './ssd_mobilenet_v2_coco_2018_03_29/frozen_inference_graph.pb',
+                                './ssd_mobilenet_v2_coco_2018_03_29/ssd_mobilenet_v2_coco_2018_03_29.pbtxt'),
+}
+
+INPUT_NAME = 'image_tensor'
+OUTPUT_NAMES = ('detection_boxes', 'detection_scores', 'detection_classes', 'num_detections')
+# Resolution of the DOT camera frames
+WARMUP_IMAGE_SHAPE = (240, 352, 3)
+
+
+class Detector:
+
+    name = None
+    # profiling.StepTracer asking for traces of the next runs; only the tf backend records them
+    tracer = None
+
+    def detect(self, images_np):
+        """(boxes, scores, classes, num) for an [N, H, W, 3] uint8 batch"""
+        raise NotImplementedError
+
+    def warm_up(self, image_shape=WARMUP_IMAGE_SHAPE, batch_size=1):
+        """Run a blank batch through the model, return how long it took"""
+        started = time.time()
+        self.detect(np.zeros((batch_size,) + tuple(image_shape), dtype=np.uint8))
+        return time.time() - started
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TensorFlowDetector(Detector):
+
+    def __init__(self, model_path, device=GPU_DEVICE, session_config=None, cache_dir=None) -> None:
+        super().__init__()
+
+        import tensorflow as tf
+        self.name = f"{BACKEND_TF}:{model_path}"
+        self.graph = TensorFlowDetector.load_graph(model_path, device, cache_dir)
+        self.session = tf.Session(graph=self.graph, config=session_config)
+        self._image_tensor = self.graph.get_tensor_by_name(f'{INPUT_NAME}:0')
+        self._outputs = [self.graph.get_tensor_by_name(f'{name}:0') for name in OUTPUT_NAMES]
+
+    @staticmethod
+    def load_graph(model_path, device=GPU_DEVICE, cache_dir=None):
+        import tensorflow as tf
+
+        def import_graph(path):
+            with tf.device(device):
+                detection_graph = tf.Graph()
+                with detection_graph.as_default():
+                    tf.import_graph_def(read_graph_def(path), name='')
+                return detection_graph
+
+        if cache_dir:
+            # A cached graph that does not parse or import is moved aside and the model is imported instead
+            return load_optimized_graph_def(model_path, cache_dir, INPUT_NAME, OUTPUT_NAMES, load=import_graph)
+        return import_graph(model_path)
+
+    def detect(self, images_np):
+        feed_dict = {self._image_tensor: images_np}
+        if self.tracer is not None and self.tracer.take():
+            import tensorflow as tf
+            run_metadata = tf.RunMetadata()
+            outputs = self.session.run(self._outputs, feed_dict=feed_dict,
+                                       options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                                       run_metadata=run_metadata)
+            self.tracer.save(run_metadata, len(images_np))
+            return tuple(outputs)
+        return tuple(self.session.run(self._outputs, feed_dict=feed_dict))
+
+    def close(self):
+        self.session.close()
+
+
+class OnnxDetector(Detector):
+    """Runs an object detection API graph converted to ONNX; the input takes the uint8 batch as is"""
+
+    def __init__(self, model_path, num_threads=0, cache_dir=None) -> None:
+        super().__init__()
+
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx detector backend needs onnxruntime, pip install onnxruntime")
+        self.name = f"{BACKEND_ONNX}:{model_path}"
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        optimized_path = optimized_onnx_model(model_path, cache_dir, onnxruntime.__version__) if cache_dir else None
+
+        def create_session(path):
+            if path == optimized_path:
+                # The cached model is optimized already, optimizing it again only costs startup time
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+            else:
+                options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            return onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+        self.session = load_artifact(model_path, optimized_path, create_session)
+        self._input_name = self.session.get_inputs()[0].name
+        # tf2onnx keeps the TensorFlow names, with or without the ":0" suffix
+        names = {output.name.split(':')[0]: output.name for output in self.session.get_outputs()}
+        self._output_names = [names[name] for name in OUTPUT_NAMES]
+
+    def detect(self, images_np):
+        boxes, scores, classes, num = self.session.run(self._output_names, {self._input_name: images_np})
+        return boxes, scores, classes, num
+
+
+class OpenCVDetector(Detector):
+    """Runs a frozen TensorFlow SSD graph with the OpenCV DNN module at a fixed input size"""
+
+    def __init__(self, model_path, config_path, input_size=(300, 300), num_threads=0) -> None:
+        super().__init__()
+
+        try:
+            import cv2
+        except ImportError:
+            raise ImportError("The opencv detector backend needs OpenCV, pip install opencv-python-headless")
+        self.name = f"{BACKEND_OPENCV}:{model_path}"
+        self._cv2 = cv2
+        if num_threads:
+            cv2.setNumThreads(num_threads)
+        self.net = cv2.dnn.readNetFromTensorflow(model_path, config_path)
+        self._input_size = input_size
+
+    def detect(self, images_np):
+        # Frames are RGB already, which is what the TensorFlow graph was trained on
+        blob = self._cv2.dnn.blobFromImages(list(images_np), size=self._input_size, swapRB=False)
+        self.net.setInput(blob)
+        return opencv_to_detections(self.net.forward(), len(images_np))
+
+
+def opencv_to_detections(output, batch_size):
+    """Convert the [1, 1, K, 7] (image, class, score, xmin, ymin, xmax, ymax) output of an OpenCV DetectionOutput
+    layer to the (boxes, scores, classes, num) of the object detection API"""
+    rows = output.reshape(-1, 7)
+    per_image = [rows[rows[:, 0] == i] for i in range(batch_size)]
+    max_detections = max([len(r) for r in per_image] + [1])
+    boxes = np.zeros((batch_size, max_detections, 4), dtype=np.float32)
+    scores = np.zeros((batch_size, max_detections), dtype=np.float32)
+    classes = np.zeros((batch_size, max_detections), dtype=np.float32)
+    num = np.zeros(batch_size, dtype=np.float32)
+    for i, r in enumerate(per_image):
+        r = r[np.argsort(-r[:, 2], kind='stable')]
+        n = len(r)
+        boxes[i, :n] = r[:, [4, 3, 6, 5]]
+        scores[i, :n] = r[:, 2]
+        classes[i, :n] = r[:, 1]
+        num[i] = n
+    return boxes, scores, classes, num
+
+
+def parse_model(spec):
+    """(backend, model path, config path) of a model name from MODELS or a "<backend>:<path>[:<config>]" spec"""
+    if spec in MODELS:
+        return MODELS[spec]
+    backend, _, paths = spec.partition(':')
+    if backend not in BACKENDS or not paths:
+        raise ValueError(f"Unknown model={spec}, expected one of {sorted(MODELS)} or <backend>:<model path>")
+    model_path, _, config_path = paths.partition(':')
+    if backend == BACKEND_OPENCV and not config_path:
+        raise ValueError(f"The {BACKEND_OPENCV} backend needs a text graph config: {spec}:<config path>")
+    return backend, model_path, config_path or None
+
+
+def create_detector(spec=DEFAULT_MODEL, device=GPU_DEVICE, session_config=None, num_threads=0, cache_dir=None):
+    backend, model_path, config_path = parse_model(spec)
+    log.info(f"Loading {backend} detector from {model_path}")
+    if backend == BACKEND_TF:
+        return TensorFlowDetector(model_path, device, session_config, cache_dir)
+    if backend == BACKEND_ONNX:
+        return OnnxDetector(model_path, num_threads, cache_dir)
+    return OpenCVDetector(model_path, config_path, num_threads=num_threads)
@@ -0,0 +1,61 @@
+import unittest
+from detectors import *
+
+
+class TestDetectors(unittest.TestCase):
+
+    def test_parse_model_by_name(self):
+        assert parse_model('faster_rcnn_resnet50') == MODELS['faster_rcnn_resnet50']
+
+    def test_parse_model_spec(self):
+        assert parse_model('onnx:/models/ssd.int8.onnx') == (BACKEND_ONNX, '/models/ssd.int8.onnx', None)
+        assert parse_model('opencv:/models/ssd.pb:/models/ssd.pbtxt') == (BACKEND_OPENCV, '/models/ssd.pb',
+                                                                          '/models/ssd.pbtxt')
+
+    def test_parse_model_rejects_unknown_backend_and_missing_config(self):
+        with self.assertRaises(ValueError):
+            parse_model('caffe:/models/ssd.caffemodel')
+        with self.assertRaises(ValueError):
+            parse_model('not_a_model')
+        with self.assertRaises(ValueError):
+            parse_model('opencv:/models/ssd.pb')
+
+    def test_opencv_output_is_split_per_image_and_sorted_by_score(self):
+        output = np.array([[[
+            [0, 3, 0.5, 0.1, 0.2, 0.3, 0.4],
+            [1, 1, 0.7, 0.0, 0.0, 1.0, 1.0],
+            [0, 8, 0.9, 0.5, 0.6, 0.7, 0.8],
+        ]]], dtype=np.float32)
+        boxes, scores, classes, num = opencv_to_detections(output, 3)
+        assert boxes.shape == (3, 2, 4)
+        np.testing.assert_array_equal(num, [2, 1, 0])
+        np.testing.assert_allclose(scores[0], [0.9, 0.5])
+        np.testing.assert_array_equal(classes[0], [8, 3])
+        np.testing.assert_allclose(boxes[0, 1], [0.2, 0.1, 0.4, 0.3])
+        np.testing.assert_array_equal(scores[2], [0, 0])
+
+    def test_missing_optional_backend_explains_how_to_install(self):
+        try:
+            import onnxruntime
+        except ImportError:
+            with self.assertRaises(ImportError) as context:
+                create_detector('onnx:/models/ssd.onnx')
+            assert 'pip install onnxruntime' in str(context.exception)
+
+    def test_warm_up_runs_a_blank_batch(self):
+        class RecordingDetector(Detector):
+            def __init__(self):
+                self.batches = []
+
+            def detect(self, images_np):
+                self.batches.append(images_np)
+
+        detector = RecordingDetector()
+        assert detector.warm_up(batch_size=4) >= 0
+        assert detector.batches[0].shape == (4,) + WARMUP_IMAGE_SHAPE
+        assert detector.batches[0].dtype == np.uint8
+        assert not detector.batches[0].any()
+
+
+if __name__ == '__main__':
+    unittest.main()
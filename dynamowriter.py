@@ -0,0 +1,415 @@
+r"""Buffered, asynchronous DynamoDB result writer
+
+Writing each TrafficResult with its own put_item puts a network round trip on the path of every frame, and a
+throttled table stalls the analyzer. ResultWriter queues items instead and a background thread writes them with
+BatchWriteItem, 25 at a time. Unprocessed items and retryable errors (throttling, 5xx) are retried with
+exponential backoff and jitter, so throttling slows the writer down without blocking the frames.
+
+Every item is first appended to a local write-ahead log with a sequence number. Each time a batch is written, the
+sequence number up to which everything reached DynamoDB is checkpointed. On startup, items past the checkpoint are
+written again (puts of the same key are idempotent), so results queued when the process died are not lost. The
+log is truncated whenever the writer has caught up.
+
+With a log, retryable errors are retried for as long as the writer is open, so an outage of DynamoDB does not drop
+results, and put() never blocks: once the queue is full, items are only appended to the log, and the writer reads
+them back from it as the queue drains. Without a log, put() blocks while the queue is full. A batch DynamoDB
+rejects outright (e.g. a ValidationException) is written again one item at a time, and only the items rejected on
+their own are logged and checkpointed past. A batch still failing when the writer closes stops the checkpoint
+where it is, and its items are written on the next start.
+
+
+Example usage:
+    writer = ResultWriter('ourcamera_v2', wal_path='/tmp/ourcamera_results.wal')
+    writer.put({'cameraLocationId': '368', 'timestamp': '1539560991', 'cars': 3, 'trucks': 0, 'people': 1})
+    writer.close()
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+import boto3
+import botocore.exceptions
+import numpy as np
+
+from metrics import OUTCOME_ERROR, OUTCOME_OK, REGISTRY, record_stage
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+MAX_BATCH_SIZE = 25
+KEY_ATTRIBUTES = ('cameraLocationId', 'timestamp')
+# Error codes it is safe to retry with exponential backoff, see ERROR_HELP_STRINGS in src/scripts/dynamodb_ops.py
+RETRYABLE_ERRORS = {
+    'InternalServerError',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'ServiceUnavailable',
+    'ThrottlingException',
+}
+
+STAGE_DYNAMODB_WRITE = 'dynamodb_write'
+QUEUE_DEPTH = REGISTRY.gauge('ourcamera_dynamodb_queue_depth', 'Results waiting to be written', ('table',))
+
+# Outcomes of writing a batch
+WRITTEN = 'written'
+REJECTED = 'rejected'
+FAILED = 'failed'
+# Most log entries read back at a time when the queue is unbounded
+SPILL_READ_LIMIT = 1000
+
+_STOP = object()
+
+
+class WriterStats:
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.written = 0
+        self.batches = 0
+        self.retried = 0
+        self.failed = 0
+        self.flush_latencies = []
+
+    def report(self):
+        latencies = self.flush_latencies
+        return {
+            'written': self.written,
+            'batches': self.batches,
+            'retried': self.retried,
+            'failed': self.failed,
+            'flush_p50_secs': round(float(np.percentile(latencies, 50)), 3) if latencies else 0.0,
+            'flush_p95_secs': round(float(np.percentile(latencies, 95)), 3) if latencies else 0.0,
+        }
+
+
+class WriteAheadLog:
+    """Append-only log of (sequence number, item) lines with a checkpoint of the durable prefix"""
+
+    def __init__(self, path, fsync=False) -> None:
+        super().__init__()
+
+        self.path = path
+        self._checkpoint_path = path + '.checkpoint'
+        self._fsync = fsync
+        self._file = None
+        self._lock = threading.Lock()
+        self._last_appended = 0
+
+    def recover(self):
+        """(last sequence number, items logged after the checkpoint)"""
+        checkpoint = self.checkpoint()
+        last_seq, pending = checkpoint, []
+        if os.path.exists(self.path):
+            good_size = 0
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        seq, item = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash; nothing after it was acknowledged to a caller either
+                        break
+                    good_size += len(line)
+                    last_seq = max(last_seq, seq)
+                    if seq > checkpoint:
+                        pending.append((seq, item))
+            # New entries go right after the last complete one, not after the torn line
+            if good_size < os.path.getsize(self.path):
+                with open(self.path, 'r+b') as f:
+                    f.truncate(good_size)
+        self._last_appended = last_seq
+        return last_seq, pending
+
+    def read_from(self, offset, limit):
+        """Up to limit (sequence number, item, offset after it) entries logged from byte offset on, and the offset
+        after the last line read
+        """
+        entries = []
+        if not os.path.exists(self.path):
+            return entries, offset
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            while len(entries) < limit:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    # The end of the log, or a line still being written
+                    break
+                offset += len(line)
+                try:
+                    seq, item = json.loads(line)
+                    entries.append((seq, item, offset))
+                except ValueError:
+                    log.warning(f"Skipping a malformed entry of write-ahead log={self.path}")
+        return entries, offset
+
+    def checkpoint(self):
+        try:
+            with open(self._checkpoint_path) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def append(self, seq, item):
+        """Log an item, return the byte offset of its entry"""
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            offset = self._file.seek(0, os.SEEK_END)
+            self._file.write(json.dumps([seq, item]) + '\n')
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+            self._last_appended = seq
+            return offset
+
+    def commit(self, seq, truncate=True):
+        """Record that everything up to seq is written; start a new log when nothing is pending any more
+
+        Pass truncate=False while entries are being read back with read_from(), whose offsets truncating would move.
+        """
+        with self._lock:
+            with open(self._checkpoint_path + '.part', 'w') as f:
+                f.write(str(seq))
+            os.replace(self._checkpoint_path + '.part', self._checkpoint_path)
+            if truncate and seq >= self._last_appended:
+                if self._file is None:
+                    self._file = open(self.path, 'a')
+                self._file.truncate(0)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class ResultWriter:
+
+    def __init__(self, table_name, key=None, secret=None, region='us-east-1', client=None, wal_path=None,
+                 max_queue_size=10000, flush_interval_secs=1.0, max_attempts=8, backoff_base_secs=0.1,
+                 backoff_max_secs=10.0, sleep=time.sleep):
+        if client is None:
+            session = boto3.Session(aws_access_key_id=key, aws_secret_access_key=secret, region_name=region)
+            # The resource client serializes plain Python values, the same items put_item took
+            client = session.resource('dynamodb').meta.client
+        self._client = client
+        self._table_name = table_name
+        self._flush_interval_secs = flush_interval_secs
+        self._max_attempts = max_attempts
+        self._backoff_base_secs = backoff_base_secs
+        self._backoff_max_secs = backoff_max_secs
+        self._sleep = sleep
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = WriterStats()
+        self._closed = False
+        self._wal = WriteAheadLog(wal_path) if wal_path else None
+        # Cleared once a batch fails for good, to keep its items past the checkpoint
+        self._checkpointing = True
+        self._seq = 0
+        # While spilling, put() only logs items, and the worker reads them back from _spill_offset of the log;
+        # _read_seq is the last item read back
+        self._spilling = False
+        self._spill_offset = 0
+        self._read_seq = 0
+        if self._wal is not None:
+            self._seq, pending = self._wal.recover()
+            if pending:
+                log.info(f"Replaying {len(pending)} results from write-ahead log={wal_path}")
+                # Read back from the log like spilled items, the log may hold more than the queue does
+                self._spilling = True
+                self._read_seq = pending[0][0] - 1
+        QUEUE_DEPTH.labels(table_name).set_function(self._queue.qsize)
+        self._worker = threading.Thread(target=self._work, name='dynamodb-writer', daemon=True)
+        self._worker.start()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def put(self, item):
+        """Queue an item for writing; without a log, block while the queue is full"""
+        if self._closed:
+            raise RuntimeError("ResultWriter is closed")
+        # Sequence numbers, log order and queue order have to agree for the checkpoint to mean anything
+        with self._lock:
+            self._seq += 1
+            if self._wal is None:
+                self._queue.put((self._seq, item))
+                return
+            offset = self._wal.append(self._seq, item)
+            if self._spilling:
+                return
+            try:
+                self._queue.put_nowait((self._seq, item))
+            except queue.Full:
+                log.warning(f"Result queue is full, spilling results to write-ahead log={self._wal.path}")
+                self._spilling = True
+                self._spill_offset = offset
+                self._read_seq = self._seq - 1
+
+    def join(self):
+        """Block until every queued or spilled item has been written or has failed"""
+        while True:
+            self._queue.join()
+            with self._lock:
+                if not self._spilling:
+                    return
+            time.sleep(0.01)
+
+    def close(self):
+        self._closed = True
+        self._queue.put(_STOP)
+        self._worker.join()
+        if self._wal is not None:
+            self._wal.close()
+
+    def report(self):
+        with self._stats_lock:
+            report = self.stats.report()
+            self.stats.flush_latencies = []
+        report['queue_depth'] = self.queue_depth
+        return report
+
+    def _work(self):
+        batch = []
+        deadline = None
+        stopping = False
+        while True:
+            if self._queue.empty():
+                with self._lock:
+                    spilling = self._spilling
+                if spilling:
+                    self._read_back()
+                elif stopping:
+                    self._flush(batch)
+                    return
+            if batch:
+                timeout = max(deadline - time.monotonic(), 0)
+            else:
+                timeout = self._flush_interval_secs if stopping or self._spilling else None
+            try:
+                entry = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                entry = None
+            if entry is _STOP:
+                # Spilled items are still written, unless DynamoDB is failing: then they wait for the next start
+                stopping = True
+                self._queue.task_done()
+                if not self._checkpointing:
+                    return
+                continue
+            if entry is not None:
+                if not batch:
+                    deadline = time.monotonic() + self._flush_interval_secs
+                batch.append(entry)
+            if len(batch) >= MAX_BATCH_SIZE or (batch and entry is None):
+                self._flush(batch)
+                batch = []
+                if stopping and not self._checkpointing:
+                    return
+
+    def _read_back(self):
+        """Queue the next spilled items from the log, or stop spilling once every logged item has been read back"""
+        # close() may put its stop marker in the queue meanwhile, leave room for it
+        limit = max(self._queue.maxsize - self._queue.qsize() - 1, 1) if self._queue.maxsize > 0 else SPILL_READ_LIMIT
+        while True:
+            entries, offset = self._wal.read_from(self._spill_offset, limit)
+            queued = 0
+            for seq, item, end in entries:
+                # Entries up to the checkpoint are still in the log on startup
+                if seq > self._read_seq:
+                    try:
+                        self._queue.put_nowait((seq, item))
+                    except queue.Full:
+                        return
+                    self._read_seq = seq
+                    queued += 1
+                self._spill_offset = end
+            self._spill_offset = offset
+            if queued:
+                return
+            if not entries:
+                with self._lock:
+                    if self._read_seq >= self._seq:
+                        self._spilling = False
+                        log.info(f"Caught up with the results in write-ahead log={self._wal.path}")
+                return
+
+    def _flush(self, batch):
+        if not batch:
+            return
+        start = time.monotonic()
+        # A batch may not hold the same key twice, the later result of a frame wins
+        items = list({tuple(item.get(k) for k in KEY_ATTRIBUTES): item for _, item in batch}.values())
+        outcome = self._write(items)
+        written = len(items) if outcome == WRITTEN else 0
+        if outcome == REJECTED and len(items) > 1:
+            # Find the items DynamoDB rejects, so the others are still written
+            log.info(f"Writing the {len(items)} results of the rejected batch one at a time")
+            outcomes = [self._write([item]) for item in items]
+            written = outcomes.count(WRITTEN)
+            outcome = FAILED if FAILED in outcomes else REJECTED
+        elapsed = time.monotonic() - start
+        record_stage(STAGE_DYNAMODB_WRITE, elapsed, items=len(items),
+                     outcome=OUTCOME_OK if written == len(items) else OUTCOME_ERROR)
+        with self._stats_lock:
+            self.stats.batches += 1
+            self.stats.flush_latencies.append(elapsed)
+            self.stats.written += written
+            self.stats.failed += len(items) - written
+        if self._wal is not None:
+            # Rejected items are logged and left behind, so one bad item cannot hold back every later one. Items
+            # that could not be written in time stay past the checkpoint, to be written on the next start.
+            if outcome == FAILED:
+                self._checkpointing = False
+            if self._checkpointing:
+                with self._lock:
+                    self._wal.commit(batch[-1][0], truncate=not self._spilling)
+        for _ in batch:
+            self._queue.task_done()
+
+    def _backoff(self, attempt):
+        delay = min(self._backoff_base_secs * 2 ** min(attempt, 32), self._backoff_max_secs)
+        self._sleep(delay * random.uniform(0.5, 1.0))
+
+    def _write(self, items):
+        """WRITTEN, REJECTED on an error that is not retryable, or FAILED once retrying is given up
+
+        Without a log, retrying is given up after max_attempts. With one, it goes on until the writer is closed.
+        """
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        attempt = 0
+        while True:
+            try:
+                response = self._client.batch_write_item(RequestItems={self._table_name: requests})
+            except botocore.exceptions.ClientError as e:
+                code = e.response['Error']['Code']
+                if code not in RETRYABLE_ERRORS:
+                    log.error(f"Could not write {len(requests)} results [{code}]: {e}; items={requests}")
+                    return REJECTED
+                log.warning(f"Writing {len(requests)} results failed [{code}], retrying")
+            except botocore.exceptions.BotoCoreError as e:
+                log.warning(f"Writing {len(requests)} results failed ({e}), retrying")
+            else:
+                requests = response.get('UnprocessedItems', {}).get(self._table_name, [])
+                if not requests:
+                    return WRITTEN
+                log.debug(f"{len(requests)} results unprocessed, retrying")
+            attempt += 1
+            if attempt >= self._max_attempts and (self._wal is None or self._closed):
+                break
+            with self._stats_lock:
+                self.stats.retried += 1
+            self._backoff(attempt - 1)
+        if self._wal is not None:
+            log.error(f"Giving up on {len(requests)} results after {attempt} attempts, they are written again on "
+                      f"the next start from write-ahead log={self._wal.path}")
+        else:
+            log.error(f"Giving up on {len(requests)} results after {attempt} attempts; items={requests}")
+        return FAILED
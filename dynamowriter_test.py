@@ -0,0 +1,256 @@
+import shutil
+import tempfile
+import threading
+import unittest
+from mock import MagicMock
+from dynamowriter import *
+
+try:
+    from moto import mock_aws
+except ImportError:
+    from moto import mock_dynamodb2 as mock_aws
+
+TABLE = "ourcamera_v2"
+
+
+def make_item(location_id, timestamp, cars=1):
+    return {'cameraLocationId': str(location_id), 'timestamp': str(timestamp), 'cars': cars, 'trucks': 0,
+            'people': 0, 'counts': {'car': cars}}
+
+
+class TestResultWriter(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.mock = mock_aws()
+        self.mock.start()
+        dynamodb = boto3.resource('dynamodb', region_name='us-east-1', aws_access_key_id='fake',
+                                  aws_secret_access_key='fake')
+        self.table = dynamodb.create_table(
+            TableName=TABLE,
+            KeySchema=[{'AttributeName': 'cameraLocationId', 'KeyType': 'HASH'},
+                       {'AttributeName': 'timestamp', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'cameraLocationId', 'AttributeType': 'S'},
+                                  {'AttributeName': 'timestamp', 'AttributeType': 'S'}],
+            ProvisionedThroughput={'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5})
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        self.mock.stop()
+
+    def test_writes_items_in_batches_of_25(self):
+        writer = ResultWriter(TABLE, 'fake', 'fake', flush_interval_secs=0.05)
+        for timestamp in range(60):
+            writer.put(make_item(368, timestamp))
+        writer.close()
+
+        assert self.table.scan()['Count'] == 60
+        item = self.table.get_item(Key={'cameraLocationId': '368', 'timestamp': '7'})['Item']
+        assert item['counts'] == {'car': 1}
+        report = writer.report()
+        assert report['written'] == 60
+        assert report['batches'] >= 3
+        assert report['failed'] == 0
+        assert report['queue_depth'] == 0
+
+    def test_records_stage_metrics(self):
+        from metrics import STAGE_ITEMS
+        before = STAGE_ITEMS.labels(STAGE_DYNAMODB_WRITE, 'ok').value()
+        writer = ResultWriter(TABLE, 'fake', 'fake', flush_interval_secs=0.05)
+        for timestamp in range(3):
+            writer.put(make_item(368, timestamp))
+        writer.close()
+        assert STAGE_ITEMS.labels(STAGE_DYNAMODB_WRITE, 'ok').value() == before + 3
+        assert QUEUE_DEPTH.labels(TABLE).value() == 0
+
+    def test_flushes_a_partial_batch_after_the_interval(self):
+        writer = ResultWriter(TABLE, 'fake', 'fake', flush_interval_secs=0.05)
+        writer.put(make_item(368, 1))
+        writer.join()
+        assert self.table.scan()['Count'] == 1
+        writer.close()
+
+    def test_later_result_of_a_frame_wins_within_a_batch(self):
+        writer = ResultWriter(TABLE, 'fake', 'fake', flush_interval_secs=0.5)
+        writer.put(make_item(368, 1, cars=1))
+        writer.put(make_item(368, 1, cars=4))
+        writer.close()
+        assert self.table.get_item(Key={'cameraLocationId': '368', 'timestamp': '1'})['Item']['cars'] == 4
+
+    def test_retries_unprocessed_items_and_throttling(self):
+        client = MagicMock()
+        throttled = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'ProvisionedThroughputExceededException', 'Message': 'slow down'}}, 'BatchWriteItem')
+        unprocessed = {'UnprocessedItems': {TABLE: [{'PutRequest': {'Item': make_item(368, 2)}}]}}
+        client.batch_write_item.side_effect = [throttled, unprocessed, {'UnprocessedItems': {}}]
+        sleep = MagicMock()
+        writer = ResultWriter(TABLE, client=client, flush_interval_secs=0.01, sleep=sleep)
+        writer.put(make_item(368, 1))
+        writer.put(make_item(368, 2))
+        writer.close()
+
+        assert client.batch_write_item.call_count == 3
+        retried = client.batch_write_item.call_args_list[2][1]['RequestItems'][TABLE]
+        assert retried == [{'PutRequest': {'Item': make_item(368, 2)}}]
+        assert sleep.call_count == 2
+        delays = [call[0][0] for call in sleep.call_args_list]
+        assert delays[1] > delays[0] * 0.5
+        assert writer.stats.retried == 2
+        assert writer.stats.written == 2
+
+    def test_gives_up_on_errors_that_are_not_retryable(self):
+        client = MagicMock()
+        client.batch_write_item.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'ValidationException', 'Message': 'bad item'}}, 'BatchWriteItem')
+        writer = ResultWriter(TABLE, client=client, flush_interval_secs=0.01, sleep=MagicMock())
+        writer.put(make_item(368, 1))
+        writer.close()
+        assert client.batch_write_item.call_count == 1
+        assert writer.stats.failed == 1
+
+    def test_checkpoints_past_items_that_are_not_retryable(self):
+        wal_path = os.path.join(self.directory, 'results.wal')
+        client = MagicMock()
+        client.batch_write_item.side_effect = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'ValidationException', 'Message': 'bad item'}}, 'BatchWriteItem')
+        writer = ResultWriter(TABLE, client=client, wal_path=wal_path, flush_interval_secs=0.01, sleep=MagicMock())
+        writer.put(make_item(368, 1))
+        writer.close()
+        assert WriteAheadLog(wal_path).recover() == (1, [])
+
+    def test_keeps_retrying_an_outage_with_a_write_ahead_log(self):
+        wal_path = os.path.join(self.directory, 'results.wal')
+        client = MagicMock()
+        throttled = botocore.exceptions.ClientError(
+            {'Error': {'Code': 'ThrottlingException', 'Message': 'slow down'}}, 'BatchWriteItem')
+        client.batch_write_item.side_effect = [throttled] * 10 + [{'UnprocessedItems': {}}]
+        writer = ResultWriter(TABLE, client=client, wal_path=wal_path, flush_interval_secs=0.01, max_attempts=3,
+                              sleep=MagicMock())
+        writer.put(make_item(368, 1))
+        writer.join()
+        writer.close()
+        assert client.batch_write_item.call_count == 11
+        assert writer.stats.written == 1
+        assert WriteAheadLog(wal_path).recover() == (1, [])
+
+    def test_put_does_not_block_during_an_outage_with_a_write_ahead_log(self):
+        wal_path = os.path.join(self.directory, 'results.wal')
+        recovered = threading.Event()
+        written = []
+
+        def batch_write_item(RequestItems):
+            if not recovered.is_set():
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'ServiceUnavailable', 'Message': 'down'}}, 'BatchWriteItem')
+            written.extend(request['PutRequest']['Item']['timestamp'] for request in RequestItems[TABLE])
+            return {'UnprocessedItems': {}}
+
+        client = MagicMock()
+        client.batch_write_item.side_effect = batch_write_item
+        writer = ResultWriter(TABLE, client=client, wal_path=wal_path, max_queue_size=3, flush_interval_secs=0.01,
+                              sleep=lambda secs: time.sleep(0.001))
+        started = time.monotonic()
+        for timestamp in range(1, 51):
+            writer.put(make_item(368, timestamp))
+        assert time.monotonic() - started < 1
+        recovered.set()
+        writer.join()
+        writer.close()
+        assert written == [str(timestamp) for timestamp in range(1, 51)]
+        assert writer.stats.written == 50
+        assert WriteAheadLog(wal_path).recover() == (50, [])
+
+    def test_rejected_batch_is_written_one_item_at_a_time(self):
+        wal_path = os.path.join(self.directory, 'results.wal')
+        written = []
+
+        def batch_write_item(RequestItems):
+            items = [request['PutRequest']['Item'] for request in RequestItems[TABLE]]
+            if any(item['cars'] < 0 for item in items):
+                raise botocore.exceptions.ClientError(
+                    {'Error': {'Code': 'ValidationException', 'Message': 'bad item'}}, 'BatchWriteItem')
+            written.extend(item['timestamp'] for item in items)
+            return {'UnprocessedItems': {}}
+
+        client = MagicMock()
+        client.batch_write_item.side_effect = batch_write_item
+        writer = ResultWriter(TABLE, client=client, wal_path=wal_path, flush_interval_secs=0.5, sleep=MagicMock())
+        writer.put(make_item(368, 1))
+        writer.put(make_item(368, 2, cars=-1))
+        writer.put(make_item(368, 3))
+        writer.close()
+        assert written == ['1', '3']
+        assert writer.stats.written == 2
+        assert writer.stats.failed == 1
+        assert WriteAheadLog(wal_path).recover() == (3, [])
+
+    def test_leaves_items_failing_at_close_in_the_write_ahead_log(self):
+        wal_path = os.path.join(self.directory, 'results.wal')
+        client = MagicMock()
+        client.batch_write_item.side_effect = botocore.exceptions.EndpointConnectionError(endpoint_url='dynamodb')
+        writer = ResultWriter(TABLE, client=client, wal_path=wal_path, flush_interval_secs=0.01, max_attempts=3,
+                              sleep=lambda secs: time.sleep(0.001))
+        writer.put(make_item(368, 1))
+        writer.put(make_item(368, 2))
+        time.sleep(0.05)
+        writer.close()
+        assert writer.stats.failed == 2
+        assert WriteAheadLog(wal_path).recover() == (2, [(1, make_item(368, 1)), (2, make_item(368, 2))])
+
+        # The next writer starts by writing them
+        writer = ResultWriter(TABLE, 'fake', 'fake', wal_path=wal_path, flush_interval_secs=0.01)
+        writer.close()
+        assert self.table.scan()['Count'] == 2
+        assert WriteAheadLog(wal_path).recover() == (2, [])
+
+    def test_put_after_close_raises(self):
+        writer = ResultWriter(TABLE, 'fake', 'fake')
+        writer.close()
+        with self.assertRaises(RuntimeError):
+            writer.put(make_item(368, 1))
+
+    def test_replays_unwritten_items_from_the_write_ahead_log(self):
+        wal_path = os.path.join(self.directory, 'results.wal')
+        # A process logged two results and died before flushing them
+        wal = WriteAheadLog(wal_path)
+        wal.append(1, make_item(368, 1))
+        wal.append(2, make_item(368, 2))
+        wal.close()
+
+        writer = ResultWriter(TABLE, 'fake', 'fake', wal_path=wal_path, flush_interval_secs=0.01)
+        writer.put(make_item(368, 3))
+        writer.close()
+
+        assert self.table.scan()['Count'] == 3
+        assert WriteAheadLog(wal_path).recover() == (3, [])
+        assert os.path.getsize(wal_path) == 0
+
+    def test_replays_more_items_than_the_queue_holds(self):
+        wal_path = os.path.join(self.directory, 'results.wal')
+        wal = WriteAheadLog(wal_path)
+        for seq in range(1, 12):
+            wal.append(seq, make_item(368, seq))
+        wal.close()
+
+        writer = ResultWriter(TABLE, 'fake', 'fake', wal_path=wal_path, max_queue_size=5, flush_interval_secs=0.01)
+        writer.close()
+
+        assert self.table.scan()['Count'] == 11
+        assert WriteAheadLog(wal_path).recover() == (11, [])
+
+    def test_write_ahead_log_ignores_a_torn_last_line(self):
+        wal_path = os.path.join(self.directory, 'results.wal')
+        wal = WriteAheadLog(wal_path)
+        wal.append(1, make_item(368, 1))
+        wal.append(2, make_item(368, 2))
+        wal.commit(1)
+        wal.close()
+        with open(wal_path, 'a') as f:
+            f.write('[3, {"cameraLoc')
+
+        assert WriteAheadLog(wal_path).recover() == (2, [(2, make_item(368, 2))])
+
+
+if __name__ == '__main__':
+    unittest.main()
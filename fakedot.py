@@ -0,0 +1,253 @@
+r"""Local stand-in for the DOT camera site
+
+Serves the three pages saveimages.py reads from webcams.nyctmc.org: the camera list (new-data.php), the popup page
+of a location that holds its camera ID (google_popup.php?cid=<locationId>) and the camera image (cctv<cameraId>.jpg).
+Camera images are taken from a directory of JPEGs, data/images by default. Like a real camera, each one shows the
+same frame for frame_interval_secs before moving to the next, and answers conditional GETs for a frame it already
+served with 304 Not Modified.
+
+Every response can be delayed by latency_secs plus a uniform jitter, and a share failure_rate of them fails with 503,
+so fetchers and backoff can be exercised and measured without the live site. Point saveimages at the server with
+its URLs:
+
+    patch.multiple(saveimages, **server.urls())
+
+
+Example usage:
+    with FakeDotServer(load_images('data/images'), num_cameras=100, latency_secs=0.05, failure_rate=0.01) as server:
+        for name, url in server.urls().items():
+            setattr(saveimages, name, url)
+        ...
+        print(server.report())
+"""
+import glob
+import hashlib
+import http.server
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.parse
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+# saveimages.get_dot_camera_id_for_location_id reads at most 3 digits before ".jpg"
+FIRST_CAMERA_ID = 100
+MAX_CAMERAS = 900
+FIRST_LOCATION_ID = 1000
+
+
+def load_images(directory, limit=None):
+    """The bytes of the JPEGs in directory, in file name order"""
+    paths = sorted(glob.glob(os.path.join(directory, '*.jpg')))[:limit]
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(f.read())
+    return images
+
+
+class FakeCamera:
+
+    def __init__(self, index, location_id, camera_id) -> None:
+        super().__init__()
+
+        self.index = index
+        self.location_id = location_id
+        self.camera_id = camera_id
+
+    def marker(self):
+        return {
+            'id': str(self.location_id),
+            'latitude': str(40.7 + self.index / 10000),
+            'longitude': str(-73.9 - self.index / 10000),
+            'title': 'images\\/camera1.png',
+            'icon': 'images\\/camera1.png',
+            'content': f'Fake camera {self.index}',
+        }
+
+
+class FakeDotStats:
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.requests = 0
+        self.lists = 0
+        self.popups = 0
+        self.images = 0
+        self.not_modified = 0
+        self.failed = 0
+        self.not_found = 0
+        self.bytes = 0
+
+    def report(self):
+        return dict(self.__dict__)
+
+
+class _FakeDotHandler(http.server.BaseHTTPRequestHandler):
+
+    # Keep-alive, as the fetchers reuse their connections
+    protocol_version = 'HTTP/1.1'
+    fake = None
+
+    def do_GET(self):
+        self.fake.handle(self)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class _FakeDotHTTPServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+    # The fetchers open hundreds of connections at once
+    request_queue_size = 512
+
+
+class FakeDotServer:
+
+    def __init__(self, images, num_cameras=100, latency_secs=0.0, latency_jitter_secs=0.0, failure_rate=0.0,
+                 frame_interval_secs=2.0, host='127.0.0.1', port=0, seed=0, clock=time.monotonic) -> None:
+        super().__init__()
+
+        if not images:
+            raise ValueError("FakeDotServer needs at least one image to serve")
+        if not 0 < num_cameras <= MAX_CAMERAS:
+            raise ValueError(f"num_cameras={num_cameras} must be between 1 and {MAX_CAMERAS}")
+        self._images = images
+        self._etags = [hashlib.md5(image).hexdigest() for image in images]
+        self.cameras = [FakeCamera(i, FIRST_LOCATION_ID + i, FIRST_CAMERA_ID + i) for i in range(num_cameras)]
+        self._by_location_id = {c.location_id: c for c in self.cameras}
+        self._by_camera_id = {c.camera_id: c for c in self.cameras}
+        self._latency_secs = latency_secs
+        self._latency_jitter_secs = latency_jitter_secs
+        self._failure_rate = failure_rate
+        self._frame_interval_secs = frame_interval_secs
+        self._rng = random.Random(seed)
+        self._clock = clock
+        self._started_at = clock()
+        self._lock = threading.Lock()
+        self.stats = FakeDotStats()
+        handler = type('FakeDotHandler', (_FakeDotHandler,), {'fake': self})
+        self._server = _FakeDotHTTPServer((host, port), handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def urls(self):
+        """The saveimages module constants pointing at this server"""
+        return {
+            'DOT_CAMERA_LIST_URL': f"{self.url}/new-data.php?query=",
+            'DOT_CAMERA_ID_URL': f"{self.url}/google_popup.php?cid=",
+            'DOT_CAMERA_IMAGE_URL': f"{self.url}/cctv",
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-dot', daemon=True)
+        self._thread.start()
+        log.info(f"Serving {len(self.cameras)} fake cameras from {len(self._images)} images on {self.url}")
+        return self
+
+    def close(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def report(self):
+        with self._lock:
+            return self.stats.report()
+
+    def frame_index(self, camera):
+        """Index of the image camera shows now; cameras start at different images and move on in step"""
+        window = int((self._clock() - self._started_at) / self._frame_interval_secs) \
+            if self._frame_interval_secs > 0 else 0
+        return (camera.index * 7 + window) % len(self._images)
+
+    def _delay_and_fail(self):
+        with self._lock:
+            self.stats.requests += 1
+            delay = self._latency_secs + self._rng.uniform(0, self._latency_jitter_secs)
+            failed = self._rng.random() < self._failure_rate
+            if failed:
+                self.stats.failed += 1
+        if delay > 0:
+            time.sleep(delay)
+        return failed
+
+    def handle(self, request):
+        url = urllib.parse.urlsplit(request.path)
+        if self._delay_and_fail():
+            self._send(request, 503, b'')
+            return
+        path = url.path.rstrip('/')
+        if path == '/new-data.php':
+            with self._lock:
+                self.stats.lists += 1
+            body = json.dumps({'markers': [c.marker() for c in self.cameras]}).encode()
+            self._send(request, 200, body, 'application/json')
+        elif path == '/google_popup.php':
+            self._send_popup(request, urllib.parse.parse_qs(url.query).get('cid', [''])[0])
+        elif path.startswith('/cctv') and path.endswith('.jpg'):
+            self._send_image(request, path[len('/cctv'):-len('.jpg')])
+        else:
+            self._not_found(request)
+
+    def _send_popup(self, request, location_id):
+        camera = self._by_location_id.get(int(location_id)) if location_id.isdigit() else None
+        if camera is None:
+            self._not_found(request)
+            return
+        with self._lock:
+            self.stats.popups += 1
+        body = (f"var currentImage = imageID;document.getElementById(currentImage).src = '\n"
+                f"http://207.251.86.238/cctv{camera.camera_id}.jpg'+'?math=';\n").encode()
+        self._send(request, 200, body, 'text/html')
+
+    def _send_image(self, request, camera_id):
+        camera = self._by_camera_id.get(int(camera_id)) if camera_id.isdigit() else None
+        if camera is None:
+            self._not_found(request)
+            return
+        index = self.frame_index(camera)
+        etag = f'"{self._etags[index]}"'
+        if request.headers.get('If-None-Match') == etag:
+            with self._lock:
+                self.stats.not_modified += 1
+            self._send(request, 304, b'', headers={'ETag': etag})
+            return
+        image = self._images[index]
+        with self._lock:
+            self.stats.images += 1
+            self.stats.bytes += len(image)
+        self._send(request, 200, image, 'image/jpeg', {'ETag': etag})
+
+    def _not_found(self, request):
+        with self._lock:
+            self.stats.not_found += 1
+        self._send(request, 404, b'')
+
+    @staticmethod
+    def _send(request, status, body, content_type='text/plain', headers=None):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        if body:
+            request.wfile.write(body)
@@ -0,0 +1,48 @@
+import unittest
+import requests
+from fakedot import *
+
+
+class TestFakeDotServer(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.images = [b'first' * 3000, b'second' * 3000, b'third' * 3000]
+        self.server = FakeDotServer(self.images, num_cameras=3, clock=lambda: self.now[0]).start()
+        self.urls = self.server.urls()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_serves_the_camera_list_and_popup_pages(self):
+        markers = requests.get(self.urls['DOT_CAMERA_LIST_URL']).json()['markers']
+        assert [m['id'] for m in markers] == ['1000', '1001', '1002']
+        page = requests.get(self.urls['DOT_CAMERA_ID_URL'] + '1001').text
+        assert 'cctv101.jpg' in page
+        assert requests.get(self.urls['DOT_CAMERA_ID_URL'] + '999').status_code == 404
+
+    def test_cameras_move_to_the_next_image_every_interval(self):
+        url = self.urls['DOT_CAMERA_IMAGE_URL'] + '100.jpg?math=0.1'
+        first = requests.get(url)
+        assert first.content == self.images[0]
+        assert requests.get(url, headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+        self.now[0] = 2.5
+        second = requests.get(url, headers={'If-None-Match': first.headers['ETag']})
+        assert second.content == self.images[1]
+        assert self.server.report()['not_modified'] == 1
+
+    def test_injects_failures(self):
+        self.server.close()
+        self.server = FakeDotServer(self.images, num_cameras=1, failure_rate=1.0).start()
+        url = self.server.urls()['DOT_CAMERA_IMAGE_URL'] + '100.jpg'
+        assert requests.get(url).status_code == 503
+        assert self.server.report()['failed'] == 1
+
+    def test_load_images(self):
+        images = load_images(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'images'), limit=2)
+        assert len(images) == 2
+        assert all(image.startswith(b'\xff\xd8') for image in images)
+
+
+if __name__ == '__main__':
+    unittest.main()
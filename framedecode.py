@@ -0,0 +1,100 @@
+r"""JPEG decode stage for the analyzer
+
+Decodes frames straight into uint8 arrays without building Python lists of pixel tuples. When the model input is
+smaller than the frame, the JPEG decoder can produce a reduced-resolution image directly (PIL draft mode scales
+by 1/2, 1/4 or 1/8 during decode), which is much cheaper than decoding at full size and resizing.
+
+DecodePool decodes frames for the analyzer, whose pipeline runs num_workers decode threads of its own calling
+decode(). map() runs decodes on a thread pool ahead of the consumer instead, for callers without such threads; the
+pool is only started by the first map(). PIL releases the GIL while decoding, so several frames are decoded in
+parallel while the model works on the current one.
+
+
+Example usage:
+    image_np = decode_image("/tmp/preprocessed/1_2_3.jpg", max_size=(300, 300))
+
+    with DecodePool(num_workers=4) as pool:
+        for frame, image_np in pool.map(frames):
+            ...
+"""
+import collections
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageFile
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+EMPTY_IMAGE = np.zeros((0, 0, 3), dtype=np.uint8)
+
+
+def image_to_array(image):
+    """HxWx3 uint8 array of a PIL image, converting to RGB when needed"""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return np.asarray(image, dtype=np.uint8)
+
+
+def decode_image(source, max_size=None):
+    """Decode a JPEG from a path, file object or bytes-like object into an HxWx3 uint8 array
+
+    With max_size=(width, height), the JPEG is decoded at the smallest scale that is still at least that large.
+    Returns an empty array when the frame cannot be decoded.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    try:
+        with Image.open(source) as image:
+            if max_size is not None:
+                image.draft('RGB', max_size)
+            return image_to_array(image)
+    except (IOError, ValueError, SyntaxError):
+        log.exception(f"Could not decode frame={source}")
+        return EMPTY_IMAGE
+
+
+class DecodePool:
+    """Decodes frames on worker threads, keeping up to `prefetch` frames decoded ahead of the consumer"""
+
+    def __init__(self, num_workers=4, prefetch=8, max_size=None, open_frame=None):
+        self.num_workers = num_workers
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._prefetch = max(prefetch, 1)
+        self._max_size = max_size
+        self._open_frame = open_frame or (lambda frame: frame.path)
+
+    def decode(self, frame):
+        return decode_image(self._open_frame(frame), self._max_size)
+
+    def map(self, frames):
+        """Yield (frame, image_np) in input order, pulling frames from the iterable only as prefetch room frees up"""
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix='decode')
+        pending = collections.deque()
+        for frame in frames:
+            pending.append((frame, self._executor.submit(self.decode, frame)))
+            if len(pending) >= self._prefetch:
+                frame, future = pending.popleft()
+                yield frame, future.result()
+        while pending:
+            frame, future = pending.popleft()
+            yield frame, future.result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
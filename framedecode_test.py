@@ -0,0 +1,48 @@
+import glob
+import unittest
+from framedecode import *
+
+SAMPLE_IMAGE = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'images', '*.jpg')))[0]
+
+
+class PathFrame:
+
+    def __init__(self, path) -> None:
+        super().__init__()
+
+        self.path = path
+
+
+class TestFrameDecode(unittest.TestCase):
+
+    def test_decode_image_returns_uint8_rgb(self):
+        image_np = decode_image(SAMPLE_IMAGE)
+        assert image_np.dtype == np.uint8
+        assert image_np.shape == (240, 352, 3)
+
+    def test_decode_image_matches_getdata_conversion(self):
+        with Image.open(SAMPLE_IMAGE) as image:
+            expected = np.array(image.getdata()).reshape((image.size[1], image.size[0], 3)).astype(np.uint8)
+        np.testing.assert_array_equal(decode_image(SAMPLE_IMAGE), expected)
+
+    def test_decode_image_from_bytes_at_reduced_resolution(self):
+        with open(SAMPLE_IMAGE, 'rb') as f:
+            data = f.read()
+        image_np = decode_image(memoryview(data), max_size=(88, 60))
+        assert image_np.shape == (60, 88, 3)
+
+    def test_decode_image_returns_empty_array_for_garbage(self):
+        assert decode_image(b'not a jpeg').size == 0
+
+    def test_decode_pool_preserves_order(self):
+        frames = [PathFrame(SAMPLE_IMAGE), PathFrame('/does/not/exist.jpg'), PathFrame(SAMPLE_IMAGE)]
+        with DecodePool(num_workers=2, prefetch=2) as pool:
+            results = list(pool.map(iter(frames)))
+        assert [frame for frame, _ in results] == frames
+        assert [image_np.size > 0 for _, image_np in results] == [True, False, True]
+
+    def test_decode_pool_starts_no_threads_for_decode(self):
+        before = threading.active_count()
+        with DecodePool(num_workers=4) as pool:
+            assert pool.decode(PathFrame(SAMPLE_IMAGE)).shape == (240, 352, 3)
+            assert threading.active_count() == before
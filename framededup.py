@@ -0,0 +1,146 @@
+r"""Drop camera frames that have not changed since the last fetch
+
+Many DOT cameras refresh less often than we poll them. For each camera this module remembers the ETag and
+Last-Modified validators of the last frame, so the next request can be made conditional and answered with a
+304 Not Modified. For servers that send no validators, it remembers a digest of the last frame body instead, and a
+frame with the same digest is dropped before it is moved into the spool, uploaded to S3 or analyzed. A frame is
+only remembered once it has been handed off, so a frame that could not be spooled is not taken for a duplicate
+when the camera serves it again.
+
+The asyncfetch fetchers (FETCH_MODE=async or scheduled) keep the state of every camera in their own process. The
+worker processes of the default pool mode share theirs through a multiprocessing.Manager dict, as any worker may
+fetch a given camera in the next cycle.
+
+Per-camera counters record how many redundant frames, bytes and inference runs were avoided.
+
+
+Example usage:
+    dedup = FrameDeduplicator()
+    headers = dedup.request_headers(camera_object)
+    ...
+    if resp.status == 304:
+        dedup.record_not_modified(camera_object)
+    elif dedup.is_duplicate(camera_object, digest, size, resp.headers):
+        ...  # discard the frame
+    else:
+        ...  # spool the frame
+        dedup.commit(camera_object, digest, size, resp.headers)
+"""
+import hashlib
+import logging
+import os
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+
+def new_digest():
+    return hashlib.blake2b(digest_size=16)
+
+
+class DedupCounters:
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.not_modified = 0
+        self.duplicate_frames = 0
+        self.bytes_avoided = 0
+
+    @property
+    def frames_avoided(self):
+        return self.not_modified + self.duplicate_frames
+
+    @property
+    def inference_runs_avoided(self):
+        # Every frame that reaches the spool is analyzed exactly once
+        return self.frames_avoided
+
+    def add(self, other):
+        self.not_modified += other.not_modified
+        self.duplicate_frames += other.duplicate_frames
+        self.bytes_avoided += other.bytes_avoided
+        return self
+
+    def __repr__(self):
+        return (f"not_modified={self.not_modified} duplicate_frames={self.duplicate_frames} "
+                f"bytes_avoided={self.bytes_avoided} inference_runs_avoided={self.inference_runs_avoided}")
+
+
+class CameraFrameState:
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self.size = 0
+
+
+class FrameDeduplicator:
+    """Keeps the validators and digest of the last frame of each camera, keyed by camera ID
+
+    states may be a mapping shared between processes, such as a multiprocessing.Manager dict. A CameraFrameState read
+    from it is a copy, so every change is stored back.
+    """
+
+    def __init__(self, states=None):
+        self._states = {} if states is None else states
+        self.counters = {}
+
+    def _state(self, camera_object):
+        state = self._states.get(camera_object.cameraId)
+        return CameraFrameState() if state is None else state
+
+    def _counters(self, camera_object):
+        return self.counters.setdefault(camera_object.cameraId, DedupCounters())
+
+    def request_headers(self, camera_object):
+        """Conditional GET headers for the next request to this camera"""
+        state = self._states.get(camera_object.cameraId)
+        headers = {}
+        if state is not None:
+            if state.etag:
+                headers['If-None-Match'] = state.etag
+            if state.last_modified:
+                headers['If-Modified-Since'] = state.last_modified
+        return headers
+
+    def record_not_modified(self, camera_object):
+        counters = self._counters(camera_object)
+        counters.not_modified += 1
+        state = self._states.get(camera_object.cameraId)
+        counters.bytes_avoided += state.size if state is not None else 0
+
+    def is_duplicate(self, camera_object, digest, size, response_headers=None):
+        """True when a freshly downloaded frame is byte-identical to the last one handed off, which is counted"""
+        state = self._states.get(camera_object.cameraId)
+        if state is None or state.digest != digest:
+            return False
+        self._record_validators(state, response_headers)
+        self._states[camera_object.cameraId] = state
+        counters = self._counters(camera_object)
+        counters.duplicate_frames += 1
+        counters.bytes_avoided += size
+        return True
+
+    def commit(self, camera_object, digest, size, response_headers=None):
+        """Remember a new frame once it has been handed off, for the next requests and duplicate checks"""
+        state = self._state(camera_object)
+        self._record_validators(state, response_headers)
+        state.digest = digest
+        state.size = size
+        self._states[camera_object.cameraId] = state
+
+    @staticmethod
+    def _record_validators(state, response_headers):
+        if response_headers is not None:
+            state.etag = response_headers.get('ETag')
+            state.last_modified = response_headers.get('Last-Modified')
+
+    def totals(self):
+        total = DedupCounters()
+        for counters in self.counters.values():
+            total.add(counters)
+        return total
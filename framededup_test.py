@@ -0,0 +1,66 @@
+import unittest
+import multiprocessing
+from framededup import *
+from saveimages import CameraObject
+
+
+class TestFrameDeduplicator(unittest.TestCase):
+
+    @staticmethod
+    def make_camera(camera_id):
+        co = CameraObject()
+        co.cameraId = camera_id
+        return co
+
+    def test_request_headers_use_last_validators(self):
+        dedup = FrameDeduplicator()
+        camera = self.make_camera(1)
+        assert dedup.request_headers(camera) == {}
+        dedup.commit(camera, b'a', 100, {'ETag': '"x"', 'Last-Modified': 'Mon, 01 Jan 2018 00:00:00 GMT'})
+        assert dedup.request_headers(camera) == {'If-None-Match': '"x"',
+                                                 'If-Modified-Since': 'Mon, 01 Jan 2018 00:00:00 GMT'}
+
+    def test_is_duplicate_compares_digest_per_camera(self):
+        dedup = FrameDeduplicator()
+        first, second = self.make_camera(1), self.make_camera(2)
+        assert not dedup.is_duplicate(first, b'a', 100)
+        dedup.commit(first, b'a', 100)
+        assert not dedup.is_duplicate(second, b'a', 100)
+        assert dedup.is_duplicate(first, b'a', 100)
+        assert not dedup.is_duplicate(first, b'b', 120)
+        assert dedup.counters[1].duplicate_frames == 1
+        assert dedup.counters[1].bytes_avoided == 100
+        assert 2 not in dedup.counters
+
+    def test_frame_is_only_remembered_once_committed(self):
+        dedup = FrameDeduplicator()
+        camera = self.make_camera(1)
+        # The first copy could not be handed off, the next one is new all the same
+        assert not dedup.is_duplicate(camera, b'a', 100, {'ETag': '"x"'})
+        assert dedup.request_headers(camera) == {}
+        assert not dedup.is_duplicate(camera, b'a', 100, {'ETag': '"x"'})
+        dedup.commit(camera, b'a', 100, {'ETag': '"x"'})
+        assert dedup.is_duplicate(camera, b'a', 100, {'ETag': '"x"'})
+        assert dedup.counters[1].duplicate_frames == 1
+
+    def test_not_modified_counts_last_frame_size(self):
+        dedup = FrameDeduplicator()
+        camera = self.make_camera(1)
+        dedup.commit(camera, b'a', 250, {'ETag': '"x"'})
+        dedup.record_not_modified(camera)
+        dedup.record_not_modified(camera)
+        totals = dedup.totals()
+        assert totals.not_modified == 2
+        assert totals.bytes_avoided == 500
+        assert totals.inference_runs_avoided == 2
+
+    def test_shares_states_between_deduplicators(self):
+        manager = multiprocessing.Manager()
+        self.addCleanup(manager.shutdown)
+        states = manager.dict()
+        camera = self.make_camera(1)
+        FrameDeduplicator(states).commit(camera, b'a', 100, {'ETag': '"x"'})
+        other = FrameDeduplicator(states)
+        assert other.request_headers(camera) == {'If-None-Match': '"x"'}
+        assert other.is_duplicate(camera, b'a', 100, {'ETag': '"y"'})
+        assert FrameDeduplicator(states).request_headers(camera) == {'If-None-Match': '"y"'}
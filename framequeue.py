@@ -0,0 +1,200 @@
+r"""Freshness-aware frame queue for the analyzer
+
+When inference falls behind, working through the spool in os.listdir order means analyzing an ever older backlog
+while new frames pile up. This queue keeps a bounded list of pending frames per camera. Cameras are served
+round-robin, and each camera's newest frame goes first. When a camera has more pending frames than its bound, or
+when a frame is older than the maximum age, frames are dropped according to a policy:
+
+    latest      keep the newest frames and drop the oldest
+    downsample  drop every other frame so the kept frames stay spread over time
+    fifo        never drop for the bound; only the maximum age applies
+
+Every drop is passed to the on_drop callback (which usually removes the file) and counted per camera and reason,
+so data latency stays bounded under overload and the losses stay visible.
+
+
+Example usage:
+    queue = FreshFrameQueue(on_drop=lambda frame, reason: os.remove(frame.path))
+    queue.scan_directory('/tmp/preprocessed')
+    frame = queue.pop()
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from saveimages import SaveImages
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+POLICY_LATEST = 'latest'
+POLICY_DOWNSAMPLE = 'downsample'
+POLICY_FIFO = 'fifo'
+POLICIES = (POLICY_LATEST, POLICY_DOWNSAMPLE, POLICY_FIFO)
+
+DROP_OVERFLOW = 'overflow'
+DROP_STALE = 'stale'
+DROP_INVALID = 'invalid_name'
+
+
+class Frame:
+
+    def __init__(self, file_name, path, timestamp, location_id) -> None:
+        super().__init__()
+
+        self.file_name = file_name
+        self.path = path
+        self.timestamp = timestamp
+        self.location_id = location_id
+
+    @staticmethod
+    def from_file(directory, file_name):
+        timestamp, location_id = SaveImages.get_timestamp_and_location_id(file_name)
+        return Frame(file_name, os.path.join(directory, file_name), timestamp, location_id)
+
+    def __repr__(self):
+        return f"Frame({self.file_name})"
+
+
+class FreshFrameQueue:
+
+    def __init__(self, policy=POLICY_LATEST, max_frames_per_camera=2, max_age_secs=300, on_drop=None,
+                 clock=time.time):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown frame policy={policy}, expected one of {POLICIES}")
+        self._policy = policy
+        self._max_frames_per_camera = max_frames_per_camera
+        self._max_age_secs = max_age_secs
+        self._on_drop = on_drop
+        self._clock = clock
+        # Cameras in the order they will be served next, each with its frames sorted oldest to newest
+        self._cameras = collections.OrderedDict()
+        self._paths = set()
+        self.drops = collections.Counter()
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, path):
+        return path in self._paths
+
+    def _drop(self, frame, reason):
+        self._paths.discard(frame.path)
+        self.drops[(frame.location_id, reason)] += 1
+        log.debug(f"Dropped {frame} reason={reason}")
+        if self._on_drop is not None:
+            self._on_drop(frame, reason)
+
+    def offer(self, frame):
+        """Queue a frame, dropping frames of the same camera if it goes over its bound"""
+        if frame.timestamp == 0:
+            self._drop(frame, DROP_INVALID)
+            return
+        if frame.path in self._paths:
+            return
+
+        frames = self._cameras.setdefault(frame.location_id, [])
+        frames.append(frame)
+        frames.sort(key=lambda f: f.timestamp)
+        self._paths.add(frame.path)
+
+        if self._policy == POLICY_FIFO or len(frames) <= self._max_frames_per_camera:
+            return
+        if self._policy == POLICY_LATEST:
+            while len(frames) > self._max_frames_per_camera:
+                self._drop(frames.pop(0), DROP_OVERFLOW)
+        else:
+            # Thin out every other frame, always keeping the newest
+            kept = frames[::-1][::2][::-1]
+            for f in frames:
+                if f not in kept:
+                    self._drop(f, DROP_OVERFLOW)
+            frames[:] = kept
+
+    def scan_directory(self, directory, exclude=(), accept=None):
+        """Queue every file in the spool directory that is not queued or excluded yet, return how many were added
+
+        With accept, only frames for which accept(frame) is true are queued; the others are left alone.
+        """
+        before = len(self._paths)
+        for file_name in os.listdir(directory):
+            path = os.path.join(directory, file_name)
+            if path not in self._paths and path not in exclude:
+                frame = Frame.from_file(directory, file_name)
+                if accept is None or accept(frame):
+                    self.offer(frame)
+        return len(self._paths) - before
+
+    def pop(self):
+        """Return the newest frame of the next camera in round-robin order, or None when the queue is empty"""
+        now = self._clock()
+        while self._cameras:
+            location_id, frames = self._cameras.popitem(last=False)
+            while frames and self._max_age_secs and now - frames[0].timestamp > self._max_age_secs:
+                self._drop(frames.pop(0), DROP_STALE)
+            if not frames:
+                continue
+            frame = frames.pop() if self._policy != POLICY_FIFO else frames.pop(0)
+            self._paths.discard(frame.path)
+            if frames:
+                self._cameras[location_id] = frames
+            return frame
+        return None
+
+    def drop_summary(self):
+        """Total drops per reason"""
+        summary = collections.Counter()
+        for (_, reason), count in self.drops.items():
+            summary[reason] += count
+        return dict(summary)
+
+
+class FrameSource:
+    """Reads frames for a pipeline: shared-memory frames first, then the spool through a FreshFrameQueue
+
+    Frames stay in flight from next() until done(), and rescans of the spool skip them, so a frame that is still
+    being analyzed is neither queued twice nor dropped from under its stage.
+    """
+
+    def __init__(self, frame_queue, directory, frame_ring=None, rescan_interval_secs=5, accept=None, clock=time.time):
+        self._frame_queue = frame_queue
+        self._accept = accept
+        self._directory = directory
+        self._frame_ring = frame_ring
+        self._rescan_interval_secs = rescan_interval_secs
+        self._clock = clock
+        self._rescan_at = 0
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def next(self):
+        """The next frame to analyze, or None when there is none"""
+        frame = self._frame_ring.get() if self._frame_ring is not None else None
+        if frame is not None:
+            return frame
+
+        now = self._clock()
+        if len(self._frame_queue) == 0 or now >= self._rescan_at:
+            with self._lock:
+                in_flight = set(self._in_flight)
+            self._frame_queue.scan_directory(self._directory, exclude=in_flight, accept=self._accept)
+            self._rescan_at = now + self._rescan_interval_secs
+        frame = self._frame_queue.pop()
+        if frame is not None:
+            with self._lock:
+                self._in_flight.add(frame.path)
+        return frame
+
+    def done(self, frame, failed=False):
+        """Take frame out of flight; a failed frame is not retried, so failed makes no difference here"""
+        path = getattr(frame, 'path', None)
+        if path is not None:
+            with self._lock:
+                self._in_flight.discard(path)
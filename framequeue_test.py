@@ -0,0 +1,104 @@
+import shutil
+import tempfile
+import unittest
+from framequeue import *
+
+
+class TestFreshFrameQueue(unittest.TestCase):
+
+    @staticmethod
+    def make_frame(location_id, timestamp):
+        file_name = f"1_{location_id}_{timestamp}.jpg"
+        return Frame(file_name, "/spool/" + file_name, timestamp, location_id)
+
+    def test_serves_cameras_round_robin_newest_first(self):
+        queue = FreshFrameQueue(max_frames_per_camera=10, max_age_secs=0)
+        for frame in [self.make_frame(1, 100), self.make_frame(1, 101), self.make_frame(2, 90)]:
+            queue.offer(frame)
+        order = [(f.location_id, f.timestamp) for f in iter(queue.pop, None)]
+        assert order == [(1, 101), (2, 90), (1, 100)]
+
+    def test_latest_policy_drops_oldest_over_bound(self):
+        dropped = []
+        queue = FreshFrameQueue(max_frames_per_camera=2, max_age_secs=0,
+                                on_drop=lambda frame, reason: dropped.append((frame.timestamp, reason)))
+        for timestamp in [100, 101, 102, 103]:
+            queue.offer(self.make_frame(1, timestamp))
+        assert dropped == [(100, DROP_OVERFLOW), (101, DROP_OVERFLOW)]
+        assert [f.timestamp for f in iter(queue.pop, None)] == [103, 102]
+        assert queue.drops[(1, DROP_OVERFLOW)] == 2
+
+    def test_downsample_policy_keeps_every_other_frame(self):
+        queue = FreshFrameQueue(policy=POLICY_DOWNSAMPLE, max_frames_per_camera=4, max_age_secs=0)
+        for timestamp in range(100, 105):
+            queue.offer(self.make_frame(1, timestamp))
+        assert sorted(f.timestamp for f in iter(queue.pop, None)) == [100, 102, 104]
+
+    def test_stale_frames_are_dropped_on_pop(self):
+        queue = FreshFrameQueue(policy=POLICY_FIFO, max_age_secs=60, clock=lambda: 1000)
+        queue.offer(self.make_frame(1, 900))
+        queue.offer(self.make_frame(1, 950))
+        assert queue.pop().timestamp == 950
+        assert queue.pop() is None
+        assert queue.drop_summary() == {DROP_STALE: 1}
+
+    def test_scan_directory_queues_new_files_and_drops_invalid_names(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for file_name in ["1_5_1539560991.jpg", "1_6_1539560992.jpg", ".DS_Store"]:
+                open(os.path.join(directory, file_name), 'w').close()
+            dropped = []
+            queue = FreshFrameQueue(max_age_secs=0, on_drop=lambda frame, reason: dropped.append(reason))
+            assert queue.scan_directory(directory) == 2
+            assert queue.scan_directory(directory) == 0
+            assert dropped == [DROP_INVALID, DROP_INVALID]
+            assert os.path.join(directory, "1_5_1539560991.jpg") in queue
+        finally:
+            shutil.rmtree(directory)
+
+    def test_scan_directory_leaves_frames_that_are_not_accepted(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for file_name in ["1_5_1539560991.jpg", "1_6_1539560992.jpg"]:
+                open(os.path.join(directory, file_name), 'w').close()
+            queue = FreshFrameQueue(max_age_secs=0, on_drop=lambda frame, reason: self.fail(reason))
+            assert queue.scan_directory(directory, accept=lambda frame: frame.location_id == 6) == 1
+            assert queue.pop().location_id == 6
+            assert len(os.listdir(directory)) == 2
+        finally:
+            shutil.rmtree(directory)
+
+    def test_unknown_policy_is_rejected(self):
+        with self.assertRaises(ValueError):
+            FreshFrameQueue(policy='random')
+
+
+class TestFrameSource(unittest.TestCase):
+
+    def test_rescans_skip_frames_in_flight(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for file_name in ["1_5_1539560991.jpg", "1_6_1539560992.jpg"]:
+                open(os.path.join(directory, file_name), 'w').close()
+            source = FrameSource(FreshFrameQueue(max_age_secs=0), directory, rescan_interval_secs=0)
+            first = source.next()
+            second = source.next()
+            assert {first.file_name, second.file_name} == {"1_5_1539560991.jpg", "1_6_1539560992.jpg"}
+            assert source.in_flight == 2
+            assert source.next() is None
+            source.done(first)
+            assert source.next().file_name == first.file_name
+        finally:
+            shutil.rmtree(directory)
+
+    def test_ring_frames_come_first(self):
+        class Ring:
+            frames = ['ring-frame']
+
+            def get(self):
+                return self.frames.pop() if self.frames else None
+
+        source = FrameSource(FreshFrameQueue(), '/nonexistent', frame_ring=Ring())
+        assert source.next() == 'ring-frame'
+        source.done('ring-frame')
+        assert source.in_flight == 0
@@ -0,0 +1,235 @@
+r"""Shared-memory frame ring between saveimages and analyzeimages
+
+Passing frames through the spool directories costs two file writes, a rename, a directory listing, a re-read and a
+delete per frame. This ring buffer lives in a named shared memory segment instead. The fetcher copies each JPEG
+with its (cameraId, locationId, timestamp) into the next free slot, and the analyzer decodes the slot in place
+through a read-only file object over a memoryview, then releases it.
+
+The ring has a single producer and a single consumer, which matches one async fetcher process and one analyzer
+process. The consumer may release frames out of order, as its pipeline stages finish them. When the ring is full
+or a frame does not fit in a slot, put() returns False and the producer falls back to the disk spool, which
+remains the overflow and durability path. The segment outlives both daemons, so frames
+that were not released before a restart are read again.
+
+The ring needs Python 3.8 or later for multiprocessing.shared_memory. Both daemons import this module only when a
+ring is configured, so they still run on older Pythons through the spool.
+
+Layout: a header followed by slot_count slots of SLOT_HEADER.size + slot_size bytes each.
+    header  magic, version, slot_count, slot_size, write_seq, read_seq
+    slot    seq, length, camera_id, location_id, timestamp, payload
+
+
+Example usage:
+    ring = FrameRing.open("ourcamera_frames")
+    ring.put(jpeg_bytes, camera_id, location_id, timestamp)
+
+    frame = ring.get()
+    if frame is not None:
+        image = Image.open(frame.open())
+        frame.release()
+"""
+import io
+import logging
+import os
+import struct
+import threading
+from multiprocessing import shared_memory, resource_tracker
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+MAGIC = b'OCFR'
+VERSION = 1
+HEADER = struct.Struct('<4sIII')
+SEQ = struct.Struct('<Q')
+# write_seq and read_seq sit on their own cache lines so producer and consumer do not contend
+WRITE_SEQ_OFFSET = 64
+READ_SEQ_OFFSET = 128
+SLOTS_OFFSET = 192
+SLOT_HEADER = struct.Struct('<QIqqq')
+
+DEFAULT_RING_NAME = 'ourcamera_frames'
+DEFAULT_SLOT_COUNT = 256
+DEFAULT_SLOT_SIZE = 256 * 1024
+
+
+class MemoryReader(io.RawIOBase):
+    """Read-only, seekable file object over a memoryview, so the frame is not copied out of the ring to decode it"""
+
+    def __init__(self, data) -> None:
+        super().__init__()
+
+        self._data = data
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        n = max(min(len(buffer), len(self._data) - self._position), 0)
+        buffer[:n] = self._data[self._position:self._position + n]
+        self._position += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._data)
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+
+class RingFrame:
+    """A frame read from the ring; data points into shared memory and is only valid until release()"""
+
+    def __init__(self, ring, seq, data, camera_id, location_id, timestamp) -> None:
+        super().__init__()
+
+        self.seq = seq
+        self.data = data
+        self.camera_id = camera_id
+        self.location_id = location_id
+        self.timestamp = timestamp
+        self._ring = ring
+
+    @property
+    def file_name(self):
+        return f"{self.camera_id}_{self.location_id}_{self.timestamp}.jpg"
+
+    def open(self):
+        """File object reading the frame from shared memory; only valid until release()"""
+        return MemoryReader(self.data)
+
+    def release(self):
+        if self._ring is not None:
+            self.data.release()
+            self._ring._release(self.seq)
+            self._ring = None
+
+    def __repr__(self):
+        return f"RingFrame(seq={self.seq}, {self.file_name}, {len(self.data)} bytes)"
+
+
+class FrameRing:
+
+    def __init__(self, shm) -> None:
+        super().__init__()
+
+        self._shm = shm
+        magic, version, self.slot_count, self.slot_size = HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"Shared memory segment={shm.name} is not a version {VERSION} frame ring")
+        self._slot_stride = SLOT_HEADER.size + self.slot_size
+        # The consumer may hand out several frames and release them in any order; a slot is only freed for the
+        # producer once every frame before it has been released too
+        self._next_read = self._read_seq()
+        self._released = set()
+        self._release_lock = threading.Lock()
+
+    @staticmethod
+    def create(name=DEFAULT_RING_NAME, slot_count=DEFAULT_SLOT_COUNT, slot_size=DEFAULT_SLOT_SIZE):
+        size = SLOTS_OFFSET + slot_count * (SLOT_HEADER.size + slot_size)
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, slot_count, slot_size)
+        SEQ.pack_into(shm.buf, WRITE_SEQ_OFFSET, 0)
+        SEQ.pack_into(shm.buf, READ_SEQ_OFFSET, 0)
+        FrameRing._untrack(shm)
+        log.info(f"Created frame ring={name} with {slot_count} slots of {slot_size} bytes")
+        return FrameRing(shm)
+
+    @staticmethod
+    def attach(name=DEFAULT_RING_NAME):
+        shm = shared_memory.SharedMemory(name=name)
+        FrameRing._untrack(shm)
+        return FrameRing(shm)
+
+    @staticmethod
+    def _untrack(shm):
+        # The segment must outlive either daemon so a restarted one picks up where it left off, so it is only
+        # removed by an explicit unlink() and never by the resource tracker at process exit
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+
+    @staticmethod
+    def open(name=DEFAULT_RING_NAME, slot_count=DEFAULT_SLOT_COUNT, slot_size=DEFAULT_SLOT_SIZE):
+        """Attach to the ring if either daemon already created it, otherwise create it"""
+        try:
+            return FrameRing.attach(name)
+        except FileNotFoundError:
+            try:
+                return FrameRing.create(name, slot_count, slot_size)
+            except FileExistsError:
+                return FrameRing.attach(name)
+
+    def _write_seq(self):
+        return SEQ.unpack_from(self._shm.buf, WRITE_SEQ_OFFSET)[0]
+
+    def _read_seq(self):
+        return SEQ.unpack_from(self._shm.buf, READ_SEQ_OFFSET)[0]
+
+    def _slot_offset(self, seq):
+        return SLOTS_OFFSET + (seq % self.slot_count) * self._slot_stride
+
+    def __len__(self):
+        """Frames written and not yet released"""
+        return self._write_seq() - self._read_seq()
+
+    def put(self, data, camera_id, location_id, timestamp):
+        """Copy a frame into the next free slot; return False when the ring is full or the frame is too large"""
+        length = len(data)
+        if length > self.slot_size:
+            return False
+        seq = self._write_seq()
+        if seq - self._read_seq() >= self.slot_count:
+            return False
+
+        offset = self._slot_offset(seq)
+        payload_offset = offset + SLOT_HEADER.size
+        self._shm.buf[payload_offset:payload_offset + length] = data
+        SLOT_HEADER.pack_into(self._shm.buf, offset, seq, length, int(camera_id), int(location_id), int(timestamp))
+        # Publishing the new write_seq last makes the slot visible only once it is complete
+        SEQ.pack_into(self._shm.buf, WRITE_SEQ_OFFSET, seq + 1)
+        return True
+
+    def get(self):
+        """Return the next unread frame without copying it, or None when there is none"""
+        seq = self._next_read
+        if seq >= self._write_seq():
+            return None
+
+        offset = self._slot_offset(seq)
+        slot_seq, length, camera_id, location_id, timestamp = SLOT_HEADER.unpack_from(self._shm.buf, offset)
+        if slot_seq != seq:
+            raise RuntimeError(f"Frame ring out of sync: expected seq={seq}, slot has seq={slot_seq}")
+        payload_offset = offset + SLOT_HEADER.size
+        self._next_read = seq + 1
+        data = self._shm.buf[payload_offset:payload_offset + length]
+        return RingFrame(self, seq, data, camera_id, location_id, timestamp)
+
+    def _release(self, seq):
+        with self._release_lock:
+            read_seq = self._read_seq()
+            if seq < read_seq or seq >= self._next_read or seq in self._released:
+                raise RuntimeError(f"Frame seq={seq} was not handed out or was already released")
+            self._released.add(seq)
+            while read_seq in self._released:
+                self._released.remove(read_seq)
+                read_seq += 1
+            SEQ.pack_into(self._shm.buf, READ_SEQ_OFFSET, read_seq)
+
+    def close(self):
+        self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
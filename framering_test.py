@@ -0,0 +1,80 @@
+import unittest
+import uuid
+from framering import *
+
+
+class TestFrameRing(unittest.TestCase):
+
+    def setUp(self):
+        self.name = 'test_' + uuid.uuid4().hex[:12]
+        self.ring = FrameRing.create(self.name, slot_count=2, slot_size=16)
+
+    def tearDown(self):
+        self.ring.close()
+        self.ring.unlink()
+
+    def test_put_and_get_round_trip_through_attached_ring(self):
+        consumer = FrameRing.attach(self.name)
+        try:
+            assert self.ring.put(b'jpeg', 261, 368, 1539560991)
+            frame = consumer.get()
+            assert bytes(frame.data) == b'jpeg'
+            assert (frame.camera_id, frame.location_id, frame.timestamp) == (261, 368, 1539560991)
+            assert frame.file_name == "261_368_1539560991.jpg"
+            assert consumer.get() is None
+            frame.release()
+            assert len(self.ring) == 0
+        finally:
+            consumer.close()
+
+    def test_frame_is_read_through_a_file_object_over_shared_memory(self):
+        self.ring.put(b'0123456789', 1, 1, 1)
+        frame = self.ring.get()
+        f = frame.open()
+        assert f.read(4) == b'0123'
+        f.seek(-3, io.SEEK_END)
+        assert f.read() == b'789'
+        f.seek(2)
+        assert f.tell() == 2
+        assert f.read(100) == b'23456789'
+        assert f.read() == b''
+        frame.release()
+
+    def test_put_refuses_when_full_or_too_large(self):
+        assert not self.ring.put(b'x' * 17, 1, 1, 1)
+        assert self.ring.put(b'a', 1, 1, 1)
+        assert self.ring.put(b'b', 1, 1, 2)
+        assert not self.ring.put(b'c', 1, 1, 3)
+        self.ring.get().release()
+        assert self.ring.put(b'c', 1, 1, 3)
+        assert bytes(self.ring.get().data) == b'b'
+
+    def test_out_of_order_release_frees_slots_once_earlier_frames_are_released(self):
+        self.ring.put(b'a', 1, 1, 1)
+        self.ring.put(b'b', 1, 1, 2)
+        first = self.ring.get()
+        second = self.ring.get()
+        second.release()
+        assert len(self.ring) == 2
+        assert not self.ring.put(b'c', 1, 1, 3)
+        first.release()
+        assert len(self.ring) == 0
+        assert self.ring.put(b'c', 1, 1, 3)
+
+    def test_frame_cannot_be_released_twice(self):
+        self.ring.put(b'a', 1, 1, 1)
+        self.ring.put(b'b', 1, 1, 2)
+        self.ring.get()
+        second = self.ring.get()
+        self.ring._release(second.seq)
+        with self.assertRaises(RuntimeError):
+            self.ring._release(second.seq)
+
+    def test_unreleased_frames_are_read_again_after_reattach(self):
+        self.ring.put(b'a', 1, 1, 1)
+        self.ring.get()
+        consumer = FrameRing.open(self.name)
+        try:
+            assert bytes(consumer.get().data) == b'a'
+        finally:
+            consumer.close()
@@ -0,0 +1,131 @@
+r"""Cache of inference-ready model graphs
+
+A frozen object detection graph carries training leftovers (unused nodes, CheckNumerics, unfolded batch norms and
+constant subgraphs) that every analyzer start parses and that the first session run then optimizes again. The
+optimized graph is built once per model and kept in a cache directory, so later starts load it directly.
+
+Cache entries are keyed by the SHA-256 of the model file and by the version of everything that went into the
+optimization (transforms, runtime version), so replacing a model or upgrading the runtime builds a new entry
+instead of loading a stale one. Entries are written to a temporary file and renamed, so a crash never leaves a
+truncated graph behind, and processes starting at the same time at worst build the same entry twice.
+
+When optimizing fails the original model is used, the analyzer starts either way. A cached entry that cannot be
+loaded, e.g. one corrupted on disk, is moved aside with a .corrupt suffix and the original model is loaded instead;
+the next start builds the entry again.
+
+
+Example usage:
+    graph_def = load_optimized_graph_def("faster_rcnn_resnet50_coco_2018_01_28/frozen_inference_graph.pb",
+                                         "./graph_cache", 'image_tensor', OUTPUT_NAMES)
+"""
+import hashlib
+import logging
+import os
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+DIGEST_LENGTH = 16
+PARTIAL_SUFFIX = '.part'
+CORRUPT_SUFFIX = '.corrupt'
+
+# Graph transforms for object detection API graphs; removing Identity nodes would break their control dependencies
+TF_TRANSFORMS = (
+    'strip_unused_nodes(type=uint8, shape="-1,-1,-1,3")',
+    'remove_nodes(op=CheckNumerics)',
+    'fold_constants(ignore_errors=true)',
+    'fold_batch_norms',
+    'fold_old_batch_norms',
+)
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:DIGEST_LENGTH]
+
+
+def cached_artifact(model_path, cache_dir, build, key='', suffix=''):
+    """Path of the artifact build(model_path, path) makes from the model, building it unless it is cached
+
+    key identifies the build (e.g. its options and runtime version). Returns None when the build fails.
+    """
+    name, _ = os.path.splitext(os.path.basename(model_path))
+    options = hashlib.sha256(key.encode()).hexdigest()[:8]
+    path = os.path.join(cache_dir, f"{name}-{file_digest(model_path)}-{options}{suffix}")
+    if os.path.exists(path):
+        log.info(f"Using cached graph={path} for model={model_path}")
+        return path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    partial = f"{path}.{os.getpid()}{PARTIAL_SUFFIX}"
+    try:
+        build(model_path, partial)
+        os.replace(partial, path)
+    except Exception:
+        log.exception(f"Could not build an optimized graph of model={model_path}, using the model as is")
+        if os.path.exists(partial):
+            os.remove(partial)
+        return None
+    log.info(f"Cached optimized graph={path} for model={model_path}")
+    return path
+
+
+def load_artifact(model_path, path, load):
+    """load(path) of a cached artifact, or load(model_path) when there is none or it cannot be loaded"""
+    if path is not None:
+        try:
+            return load(path)
+        except Exception:
+            log.exception(f"Could not load cached graph={path}, moving it aside and using model={model_path}")
+            try:
+                os.replace(path, path + CORRUPT_SUFFIX)
+            except OSError:
+                log.exception(f"Could not move aside cached graph={path}")
+    return load(model_path)
+
+
+def read_graph_def(path):
+    import tensorflow as tf
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, 'rb') as fid:
+        graph_def.ParseFromString(fid.read())
+    return graph_def
+
+
+def optimize_graph_def(graph_def, input_name, output_names, transforms=TF_TRANSFORMS):
+    from tensorflow.tools.graph_transforms import TransformGraph
+    return TransformGraph(graph_def, [input_name], list(output_names), list(transforms))
+
+
+def load_optimized_graph_def(model_path, cache_dir, input_name, output_names, transforms=TF_TRANSFORMS,
+                             load=read_graph_def):
+    """The GraphDef of a frozen TensorFlow model with the transforms applied, from the cache when it is there
+
+    load turns the path of a graph into what is returned, the GraphDef by default.
+    """
+    import tensorflow as tf
+
+    def build(source, destination):
+        optimized = optimize_graph_def(read_graph_def(source), input_name, output_names, transforms)
+        with open(destination, 'wb') as f:
+            f.write(optimized.SerializeToString())
+
+    key = '|'.join([tf.__version__, input_name] + list(output_names) + list(transforms))
+    path = cached_artifact(model_path, cache_dir, build, key, suffix='.pb')
+    return load_artifact(model_path, path, load)
+
+
+def optimized_onnx_model(model_path, cache_dir, runtime_version):
+    """Path of the model as optimized by ONNX Runtime, from the cache when it is there, or None"""
+    import onnxruntime
+
+    def build(source, destination):
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.optimized_model_filepath = destination
+        onnxruntime.InferenceSession(source, options, providers=['CPUExecutionProvider'])
+
+    return cached_artifact(model_path, cache_dir, build, runtime_version, suffix='.onnx')
@@ -0,0 +1,79 @@
+import shutil
+import tempfile
+import unittest
+from graphcache import *
+
+
+class TestGraphCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.model_path = os.path.join(self.directory, 'frozen_inference_graph.pb')
+        self.write_model(b'graph v1')
+        self.builds = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_model(self, content):
+        with open(self.model_path, 'wb') as f:
+            f.write(content)
+
+    def build(self, source, destination):
+        self.builds.append(source)
+        with open(source, 'rb') as f, open(destination, 'wb') as out:
+            out.write(f.read().upper())
+
+    def test_builds_once_and_reuses_the_cached_artifact(self):
+        path = cached_artifact(self.model_path, self.cache_dir, self.build, 'tf 1.15', '.pb')
+        assert cached_artifact(self.model_path, self.cache_dir, self.build, 'tf 1.15', '.pb') == path
+        assert len(self.builds) == 1
+        with open(path, 'rb') as f:
+            assert f.read() == b'GRAPH V1'
+        assert os.path.basename(path).startswith('frozen_inference_graph-')
+        assert path.endswith('.pb')
+
+    def test_rebuilds_when_the_model_or_the_key_changes(self):
+        first = cached_artifact(self.model_path, self.cache_dir, self.build, 'tf 1.15')
+        other_key = cached_artifact(self.model_path, self.cache_dir, self.build, 'tf 1.16')
+        self.write_model(b'graph v2')
+        other_model = cached_artifact(self.model_path, self.cache_dir, self.build, 'tf 1.15')
+        assert len({first, other_key, other_model}) == 3
+        assert len(self.builds) == 3
+
+    def test_failed_build_leaves_nothing_behind(self):
+        def build(source, destination):
+            with open(destination, 'wb') as f:
+                f.write(b'half')
+            raise RuntimeError("transform failed")
+
+        assert cached_artifact(self.model_path, self.cache_dir, build) is None
+        assert os.listdir(self.cache_dir) == []
+
+    def test_moves_a_cached_artifact_that_does_not_load_aside(self):
+        def load(path):
+            with open(path, 'rb') as f:
+                content = f.read()
+            if content != content.lower():
+                raise ValueError("Error parsing message")
+            return content
+
+        path = cached_artifact(self.model_path, self.cache_dir, self.build, 'tf 1.15', '.pb')
+        assert load_artifact(self.model_path, path, load) == b'graph v1'
+        assert not os.path.exists(path)
+        assert os.path.exists(path + CORRUPT_SUFFIX)
+        # The next start builds the entry again
+        assert cached_artifact(self.model_path, self.cache_dir, self.build, 'tf 1.15', '.pb') == path
+        assert len(self.builds) == 2
+
+    def test_loads_the_model_without_a_cached_artifact(self):
+        assert load_artifact(self.model_path, None, lambda path: path) == self.model_path
+
+    def test_file_digest(self):
+        assert file_digest(self.model_path) == hashlib.sha256(b'graph v1').hexdigest()[:DIGEST_LENGTH]
+        assert file_digest(self.model_path, chunk_size=3) == file_digest(self.model_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+r"""Multi-process CPU inference workers
+
+One TensorFlow session with default threading leaves most cores of a CPU analyzer host idle. Running several
+analyzer processes, each with its own session and a small intra_op thread pool, keeps every core busy without the
+processes fighting over the same threads.
+
+Frames are sharded across workers by camera, so all frames of a camera are handled by the same worker, in the
+order that worker's frame queue serves them. Each worker can be pinned to its own set of cores. The supervisor
+restarts a worker that dies.
+
+
+Example usage:
+    workers = InferenceWorkers(4, run_worker, threads_per_worker=2, pin_cores=True)
+    workers.start()
+    workers.join()
+"""
+import logging
+import multiprocessing
+import os
+import time
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+RESTART_DELAY_SECS = 5
+
+
+def shard_of(location_id, num_shards):
+    """Shard a camera location belongs to"""
+    return int(location_id) % num_shards
+
+
+class CameraShard:
+    """Frame filter accepting only the frames of the cameras of one shard"""
+
+    def __init__(self, index, count) -> None:
+        super().__init__()
+
+        self.index = index
+        self.count = count
+
+    def __call__(self, frame):
+        return shard_of(frame.location_id, self.count) == self.index
+
+    def __repr__(self):
+        return f"CameraShard({self.index}/{self.count})"
+
+
+def cores_for_worker(index, threads_per_worker, cpu_count=None):
+    """The cores worker `index` is pinned to, wrapping around when there are more threads than cores"""
+    cpu_count = cpu_count or os.cpu_count()
+    return sorted({(index * threads_per_worker + i) % cpu_count for i in range(threads_per_worker)})
+
+
+def default_threads_per_worker(num_workers, cpu_count=None):
+    return max((cpu_count or os.cpu_count()) // num_workers, 1)
+
+
+def pin_to_cores(cores):
+    try:
+        os.sched_setaffinity(0, cores)
+        log.info(f"Pinned worker pid={os.getpid()} to cores={cores}")
+    except (AttributeError, OSError):
+        log.exception(f"Could not pin worker pid={os.getpid()} to cores={cores}")
+
+
+class InferenceWorkers:
+    """Runs target(shard, threads_per_worker) in num_workers processes and restarts the ones that exit"""
+
+    def __init__(self, num_workers, target, threads_per_worker=None, pin_cores=False):
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or default_threads_per_worker(num_workers)
+        self._target = target
+        self._pin_cores = pin_cores
+        self._processes = [None] * num_workers
+        self._stopping = False
+
+    def _run(self, index):
+        if self._pin_cores:
+            pin_to_cores(cores_for_worker(index, self.threads_per_worker))
+        self._target(CameraShard(index, self.num_workers), self.threads_per_worker)
+
+    def _start_worker(self, index):
+        process = multiprocessing.Process(target=self._run, args=(index,), name=f'inference-{index}')
+        process.start()
+        self._processes[index] = process
+        log.info(f"Started inference worker={index} pid={process.pid} threads={self.threads_per_worker}")
+
+    def start(self):
+        for index in range(self.num_workers):
+            self._start_worker(index)
+
+    def join(self, poll_secs=RESTART_DELAY_SECS, until_done=False):
+        """Supervise the workers until stop() is called
+
+        With until_done, a worker that exits with code 0 has finished its work and is not restarted, and join
+        returns once every worker has finished.
+        """
+        finished = set()
+        while not self._stopping and len(finished) < self.num_workers:
+            for index, process in enumerate(self._processes):
+                if index in finished or process.is_alive() or self._stopping:
+                    continue
+                if until_done and process.exitcode == 0:
+                    log.info(f"Inference worker={index} pid={process.pid} finished")
+                    finished.add(index)
+                    continue
+                log.error(f"Inference worker={index} pid={process.pid} exited with code={process.exitcode}, "
+                          f"restarting it")
+                self._start_worker(index)
+            if len(finished) < self.num_workers:
+                time.sleep(poll_secs)
+
+    def stop(self):
+        self._stopping = True
+        for process in self._processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            if process is not None:
+                process.join()
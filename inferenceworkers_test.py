@@ -0,0 +1,65 @@
+import shutil
+import tempfile
+import unittest
+from inferenceworkers import *
+from framequeue import Frame
+
+
+def record_shard(shard, threads_per_worker, directory):
+    open(os.path.join(directory, f"{shard.index}_{shard.count}_{threads_per_worker}"), 'w').close()
+
+
+def fail_first_run(shard, threads_per_worker, directory):
+    """Exits with an error the first time each shard runs and finishes the second time"""
+    runs = os.path.join(directory, f"{shard.index}.runs")
+    with open(runs, 'a') as f:
+        f.write('run\n')
+    with open(runs) as f:
+        if len(f.readlines()) == 1:
+            os._exit(1)
+
+
+class TestInferenceWorkers(unittest.TestCase):
+
+    def test_every_camera_maps_to_exactly_one_shard(self):
+        shards = [CameraShard(index, 3) for index in range(3)]
+        for location_id in range(100):
+            frame = Frame(f"1_{location_id}_1539560991.jpg", "/spool", 1539560991, location_id)
+            assert sum(shard(frame) for shard in shards) == 1
+
+    def test_cores_for_worker(self):
+        assert cores_for_worker(0, 2, cpu_count=8) == [0, 1]
+        assert cores_for_worker(3, 2, cpu_count=8) == [6, 7]
+        assert cores_for_worker(2, 4, cpu_count=8) == [0, 1, 2, 3]
+
+    def test_default_threads_per_worker(self):
+        assert default_threads_per_worker(4, cpu_count=16) == 4
+        assert default_threads_per_worker(32, cpu_count=16) == 1
+
+    def test_workers_run_with_their_shard(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        workers = InferenceWorkers(2, lambda shard, threads: record_shard(shard, threads, directory),
+                                   threads_per_worker=3)
+        workers.start()
+        deadline = time.time() + 5
+        while len(os.listdir(directory)) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        workers.stop()
+        assert sorted(os.listdir(directory)) == ["0_2_3", "1_2_3"]
+
+    def test_join_until_done_restarts_failed_workers_and_returns_when_all_finish(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        workers = InferenceWorkers(2, lambda shard, threads: fail_first_run(shard, threads, directory),
+                                   threads_per_worker=1)
+        workers.start()
+        workers.join(poll_secs=0.01, until_done=True)
+        workers.stop()
+        for index in range(2):
+            with open(os.path.join(directory, f"{index}.runs")) as f:
+                assert len(f.readlines()) == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,319 @@
+r"""Counters, gauges and latency histograms for the daemons, served in the Prometheus text format
+
+Both daemons record into the process-wide REGISTRY and serve it on a local HTTP port:
+
+    ourcamera_stage_duration_seconds{stage}         time per item (or per batch) in each stage
+    ourcamera_stage_items_total{stage, outcome}     items each stage handled, ok or by failure
+    ourcamera_camera_frames_total{stage, location_id, outcome}
+                                                    frames of each camera per stage and outcome, for per-camera
+                                                    error rates
+    ourcamera_spool_files{directory}                frames waiting in a spool directory
+
+In the "pool" fetch mode of saveimages.py, every worker process has its own registry and serves it on a port of its
+own, after the one of the parent.
+
+Stages are fetch, write and upload in saveimages.py, and decode, inference, postprocess, dynamodb_write and
+annotation in analyzeimages.py. Other modules register gauges of their own, such as queue and spool depths.
+
+Recording is a dict lookup and an addition under a lock, so it stays off the profile of the hot paths; gauges whose
+value is expensive to read (a directory listing) are given a function that only runs when the endpoint is scraped.
+
+
+Example usage:
+    start_http_server(9109)
+    with STAGE_SECONDS.labels('decode').time():
+        image_np = decode(frame)
+    record_stage('inference', secs, items=len(batch))
+    CAMERA_FRAMES.labels('fetch', 368, 'ok').inc()
+"""
+import bisect
+import contextlib
+import http.server
+import logging
+import math
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+OUTCOME_OK = 'ok'
+OUTCOME_ERROR = 'error'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _CounterChild:
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        with self._lock:
+            return self._value
+
+    def samples(self, name):
+        return [(name + '_total' if not name.endswith('_total') else name, (), self.value())]
+
+
+class _GaugeChild:
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self._value = 0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, function):
+        """Read the value from function() whenever the metrics are rendered"""
+        self._function = function
+
+    def value(self):
+        function = self._function
+        if function is not None:
+            return function()
+        with self._lock:
+            return self._value
+
+    def samples(self, name):
+        return [(name, (), self.value())]
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets) -> None:
+        super().__init__()
+
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started)
+
+    def snapshot(self):
+        """(cumulative counts per bucket including +Inf, sum)"""
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        cumulative, running = [], 0
+        for count in counts:
+            running += count
+            cumulative.append(running)
+        return cumulative, total
+
+    def quantile(self, q):
+        """Estimate of the q-quantile, interpolated within its bucket as PromQL histogram_quantile() does, or None"""
+        cumulative, _ = self.snapshot()
+        if cumulative[-1] == 0:
+            return None
+        rank = q * cumulative[-1]
+        index = bisect.bisect_left(cumulative, rank)
+        if index >= len(self._buckets):
+            return float(self._buckets[-1])
+        lower = float(self._buckets[index - 1]) if index > 0 else 0.0
+        below = cumulative[index - 1] if index > 0 else 0
+        in_bucket = cumulative[index] - below
+        if in_bucket == 0:
+            return lower
+        return lower + (self._buckets[index] - lower) * (rank - below) / in_bucket
+
+    def samples(self, name):
+        cumulative, total = self.snapshot()
+        samples = [(name + '_bucket', (('le', _format_value(float(bound))),), count)
+                   for bound, count in zip(list(self._buckets) + [math.inf], cumulative)]
+        samples.append((name + '_sum', (), total))
+        samples.append((name + '_count', (), cumulative[-1]))
+        return samples
+
+
+class Metric:
+    """A named metric with one child per combination of label values"""
+
+    def __init__(self, kind, name, documentation, labelnames, new_child) -> None:
+        super().__init__()
+
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._new_child = new_child
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = new_child()
+
+    def labels(self, *values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"Metric={self.name} takes labels={self.labelnames}, got {values}")
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def children(self):
+        """Label values to child, for every combination recorded so far"""
+        with self._lock:
+            return dict(self._children)
+
+    def __getattr__(self, attribute):
+        # A metric without labels is used like its only child
+        if attribute.startswith('_') or self.labelnames:
+            raise AttributeError(attribute)
+        return getattr(self._children[()], attribute)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in sorted(self.children().items()):
+            try:
+                samples = child.samples(self.name)
+            except Exception:
+                log.exception(f"Could not read metric={self.name} labels={values}")
+                continue
+            for sample_name, extra, value in samples:
+                lines.append(f"{sample_name}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, kind, name, documentation, labelnames, new_child):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Metric(kind, name, documentation, labelnames, new_child)
+            elif metric.kind != kind or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric={name} is registered already as a {metric.kind} with {metric.labelnames}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create('counter', name, documentation, labelnames, _CounterChild)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create('gauge', name, documentation, labelnames, _GaugeChild)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        buckets = tuple(sorted(buckets))
+        return self._get_or_create('histogram', name, documentation, labelnames, lambda: _HistogramChild(buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return '\n'.join(line for _, metric in metrics for line in metric.render()) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram('ourcamera_stage_duration_seconds',
+                                   'Time spent per item, or per batch, in each stage', ('stage',))
+STAGE_ITEMS = REGISTRY.counter('ourcamera_stage_items_total', 'Items handled by each stage, by outcome',
+                               ('stage', 'outcome'))
+CAMERA_FRAMES = REGISTRY.counter('ourcamera_camera_frames_total', 'Frames of each camera in each stage, by outcome',
+                                 ('stage', 'location_id', 'outcome'))
+SPOOL_FILES = REGISTRY.gauge('ourcamera_spool_files', 'Files waiting in a spool directory', ('directory',))
+
+
+def record_stage(stage, secs, items=1, outcome=OUTCOME_OK):
+    STAGE_SECONDS.labels(stage).observe(secs)
+    STAGE_ITEMS.labels(stage, outcome).inc(items)
+
+
+def count_files(directory):
+    try:
+        return len(os.listdir(directory))
+    except FileNotFoundError:
+        return 0
+
+
+def watch_spool(directory):
+    """Report the number of files in directory as its spool depth, listed only when the metrics are scraped"""
+    SPOOL_FILES.labels(directory).set_function(lambda: count_files(directory))
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def start_http_server(port, host='127.0.0.1', registry=REGISTRY):
+    """Serve the registry on http://host:port/metrics from a daemon thread, return the server"""
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    log.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
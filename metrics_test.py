@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+import urllib.request
+from metrics import *
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counters_and_gauges_render_in_the_text_format(self):
+        counter = self.registry.counter('frames_total', 'Frames seen', ('location_id', 'outcome'))
+        counter.labels(368, 'ok').inc()
+        counter.labels(368, 'ok').inc(2)
+        counter.labels(932, 'error').inc()
+        gauge = self.registry.gauge('queue_depth', 'Jobs waiting')
+        gauge.set(5)
+        gauge.dec()
+
+        assert self.registry.render() == (
+            '# HELP frames_total Frames seen\n'
+            '# TYPE frames_total counter\n'
+            'frames_total{location_id="368",outcome="ok"} 3\n'
+            'frames_total{location_id="932",outcome="error"} 1\n'
+            '# HELP queue_depth Jobs waiting\n'
+            '# TYPE queue_depth gauge\n'
+            'queue_depth 4\n')
+
+    def test_gauge_function_is_read_when_rendered(self):
+        depth = [3]
+        self.registry.gauge('spool_files', 'Files', ('directory',)).labels('/tmp/x').set_function(lambda: depth[0])
+        depth[0] = 7
+        assert 'spool_files{directory="/tmp/x"} 7\n' in self.registry.render()
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency', ('stage',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.labels('decode').observe(value)
+
+        lines = self.registry.render().splitlines()
+        assert lines[2:] == [
+            'latency_seconds_bucket{stage="decode",le="0.1"} 2',
+            'latency_seconds_bucket{stage="decode",le="1"} 3',
+            'latency_seconds_bucket{stage="decode",le="+Inf"} 4',
+            'latency_seconds_sum{stage="decode"} 3.65',
+            'latency_seconds_count{stage="decode"} 4',
+        ]
+
+    def test_histogram_quantiles_are_interpolated_within_buckets(self):
+        histogram = self.registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+        assert histogram.quantile(0.5) is None
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        assert histogram.quantile(0.5) == 0.1
+        assert histogram.quantile(0.75) == 1.0
+        # Beyond the last bucket the estimate is its bound
+        assert histogram.quantile(0.99) == 1.0
+
+    def test_registering_the_same_metric_twice_returns_it(self):
+        first = self.registry.counter('items_total', 'Items', ('stage',))
+        assert self.registry.counter('items_total', 'Items', ('stage',)) is first
+        with self.assertRaises(ValueError):
+            self.registry.gauge('items_total', 'Items', ('stage',))
+        with self.assertRaises(ValueError):
+            first.labels('decode', 'extra')
+
+    def test_label_values_are_escaped(self):
+        self.registry.counter('errors_total', 'Errors', ('message',)).labels('bad "frame"\n').inc()
+        assert 'errors_total{message="bad \\"frame\\"\\n"} 1' in self.registry.render()
+
+    def test_record_stage(self):
+        before = STAGE_ITEMS.labels('inference', OUTCOME_OK).value()
+        record_stage('inference', 0.2, items=4)
+        assert STAGE_ITEMS.labels('inference', OUTCOME_OK).value() == before + 4
+        assert STAGE_SECONDS.labels('inference').snapshot()[0][-1] >= 1
+
+    def test_spool_depth_is_listed_when_rendered(self):
+        with tempfile.TemporaryDirectory() as directory:
+            watch_spool(directory)
+            assert SPOOL_FILES.labels(directory).value() == 0
+            open(os.path.join(directory, '261_368_1.jpg'), 'wb').close()
+            assert SPOOL_FILES.labels(directory).value() == 1
+        assert SPOOL_FILES.labels(directory).value() == 0
+
+    def test_serves_metrics_over_http(self):
+        self.registry.counter('frames_total', 'Frames').inc()
+        server = start_http_server(0, registry=self.registry)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+                assert response.headers['Content-Type'] == CONTENT_TYPE
+                assert 'frames_total 1' in response.read().decode()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import unittest
+from microbatch import *
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def image(height=240, width=352):
+    return np.zeros((height, width, 3), dtype=np.uint8)
+
+
+class TestMicroBatcher(unittest.TestCase):
+
+    def test_full_batch_is_released(self):
+        batcher = MicroBatcher(max_batch_size=3, max_wait_secs=10, clock=FakeClock())
+        assert batcher.add('a', image()) == []
+        assert batcher.add('b', image()) == []
+        batches = batcher.add('c', image())
+        assert len(batches) == 1
+        assert batches[0].frames == ['a', 'b', 'c']
+        assert batches[0].stacked().shape == (3, 240, 352, 3)
+        assert len(batcher) == 0
+
+    def test_frames_are_grouped_by_resolution(self):
+        batcher = MicroBatcher(max_batch_size=2, max_wait_secs=10, clock=FakeClock())
+        assert batcher.add('small', image(120, 176)) == []
+        assert batcher.add('large', image()) == []
+        batches = batcher.add('small2', image(120, 176))
+        assert [batch.frames for batch in batches] == [['small', 'small2']]
+        assert batches[0].shape == (120, 176, 3)
+        assert len(batcher) == 1
+
+    def test_partial_batch_is_released_after_max_wait(self):
+        clock = FakeClock()
+        batcher = MicroBatcher(max_batch_size=8, max_wait_secs=0.5, clock=clock)
+        batcher.add('a', image())
+        clock.now = 0.4
+        assert batcher.ready() == []
+        clock.now = 0.5
+        batches = batcher.ready()
+        assert [batch.frames for batch in batches] == [['a']]
+
+    def test_flush_releases_every_pending_batch(self):
+        batcher = MicroBatcher(max_batch_size=8, max_wait_secs=10, clock=FakeClock())
+        batcher.add('a', image())
+        batcher.add('b', image(120, 176))
+        assert sorted(len(batch) for batch in batcher.flush()) == [1, 1]
+        assert len(batcher) == 0
+        assert batcher.flush() == []
+
+
+class TestSplitDetections(unittest.TestCase):
+
+    def test_split_keeps_leading_dimension(self):
+        boxes = np.random.rand(3, 100, 4)
+        scores = np.random.rand(3, 100)
+        classes = np.ones((3, 100))
+        num = np.array([100., 100., 100.])
+        per_frame = split_detections(boxes, scores, classes, num)
+        assert len(per_frame) == 3
+        frame_boxes, frame_scores, frame_classes, frame_num = per_frame[1]
+        assert frame_boxes.shape == (1, 100, 4)
+        assert frame_scores.shape == (1, 100)
+        assert frame_classes.shape == (1, 100)
+        assert frame_num.shape == (1,)
+        np.testing.assert_array_equal(frame_boxes[0], boxes[1])
+
+
+class TestBatchStats(unittest.TestCase):
+
+    def test_summary(self):
+        clock = FakeClock()
+        stats = BatchStats(clock=clock)
+        batcher = MicroBatcher(max_batch_size=2, max_wait_secs=10, clock=clock)
+        batcher.add('a', image())
+        clock.now = 1.0
+        batch, = batcher.add('b', image())
+        clock.now = 2.0
+        stats.record(batch)
+        summary = stats.summary()
+        assert summary['images_per_sec'] == 1.0
+        assert summary['mean_batch_size'] == 2.0
+        assert 1.0 < summary['p95_latency_secs'] <= 2.0
+
+    def test_empty_summary(self):
+        summary = BatchStats(clock=FakeClock()).summary()
+        assert summary == {'images_per_sec': 0.0, 'mean_batch_size': 0.0, 'p95_latency_secs': 0.0}
+
+
+if __name__ == '__main__':
+    unittest.main()
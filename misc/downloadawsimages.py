@@ -1,62 +1,235 @@
+r"""Bulk download of raw frames from S3
 
-import boto3
-import botocore
+Raw frames are stored under raw/<year>/<month>/<day>/<hour>/<cameraId>_<locationId>_<epoch>.jpg (see
+SaveImages.get_s3_path). Instead of paging through the whole raw/ prefix, only the hour partitions that overlap the
+requested time range are listed, in parallel. Keys are then filtered by cameraLocationId and by the epoch in the file
+name, and the matching frames are downloaded concurrently through one shared client to
+<save_directory>/<locationId>/<file name>.
+
+Every finished download is appended to a manifest in the save directory, so an interrupted run picks up where it
+stopped. Frames already in the manifest and on disk are skipped.
+
+Hour partitions are named in the local time of the host that uploaded the frames. Partitions one hour beyond both
+ends of the range are listed as well, so a host in another time zone (or a DST change) does not lose frames at the
+edges; the epoch in the file name decides what is in range.
+
+
+Example usage:
+    ./downloadawsimages.py \
+        -cameras 932,1161,529,1116 \
+        -start 2018-10-01 -end 2018-10-08 \
+        -save_directory ~/Downloads/ourcamera
+"""
 import argparse
+import datetime
+import json
+import logging
+import os
+import threading
+import time
 from argparse import RawTextHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import botocore
+from botocore.config import Config
 
+logging.basicConfig(
+    format='{asctime} {levelname}: {message} {pathname}:{lineno}',
+    style='{',
+    level=os.getenv('LOGLEVEL', 'INFO')
+)
+
+log = logging.getLogger(__name__)
+log.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
 
 ACCESS_KEY = ""
 SECRET_KEY = ""
 
+BUCKET = "intersection-ourcamera"
+RAW_PREFIX = "raw"
+MANIFEST_NAME = "manifest.jsonl"
+DEFAULT_WORKERS = 16
+PARTITION_MARGIN = datetime.timedelta(hours=1)
+
+
+def parse_file_name(file_name):
+    """(cameraId, locationId, epoch) of a raw frame name, or None for any other object"""
+    parts = os.path.splitext(file_name)[0].split('_')
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        return None
+    return tuple(int(part) for part in parts)
+
+
+def partitions(start, end, prefix=RAW_PREFIX, margin=PARTITION_MARGIN):
+    """Hour partition prefixes (in local time, like SaveImages.get_s3_path) overlapping [start, end)"""
+    hour = (start - margin).replace(minute=0, second=0, microsecond=0)
+    prefixes = []
+    while hour < end + margin:
+        prefixes.append('/'.join([prefix] + [str(v) for v in [hour.year, hour.month, hour.day, hour.hour]]) + '/')
+        hour += datetime.timedelta(hours=1)
+    return prefixes
+
+
+class DownloadManifest:
+    """Append-only JSON lines of the keys downloaded so far"""
+
+    def __init__(self, path) -> None:
+        super().__init__()
+
+        self.path = path
+        self._lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short when the previous run was killed
+                        continue
+                    self.done[entry['key']] = entry['size']
+
+    def is_done(self, key, size, local_path):
+        return self.done.get(key) == size and os.path.exists(local_path) and os.path.getsize(local_path) == size
+
+    def add(self, key, size):
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'key': key, 'size': size}) + '\n')
+            self.done[key] = size
+
+
 class DownloadAwsImages:
 
-    def download_remote_file(self , bucket_name, file_key, local_path):
-        s3 = boto3.resource('s3',
-            aws_access_key_id = ACCESS_KEY,
-            aws_secret_access_key = SECRET_KEY)
+    def __init__(self, bucket=BUCKET, client=None, key=None, secret=None, num_workers=DEFAULT_WORKERS,
+                 prefix=RAW_PREFIX) -> None:
+        super().__init__()
+
+        if client is None:
+            # One client for every thread; its connection pool is sized so the workers do not queue for connections
+            client = boto3.client('s3',
+                                  aws_access_key_id=ACCESS_KEY if key is None else key,
+                                  aws_secret_access_key=SECRET_KEY if secret is None else secret,
+                                  config=Config(max_pool_connections=num_workers))
+        self.client = client
+        self.bucket = bucket
+        self.num_workers = num_workers
+        self.prefix = prefix
+
+    def download_remote_file(self, bucket_name, file_key, local_path):
+        # download_file writes to a temporary file and renames it, so an interrupted download leaves no partial frame
         try:
-            s3.Bucket(bucket_name).download_file(file_key, local_path)
+            self.client.download_file(bucket_name, file_key, local_path)
             return True
         except botocore.exceptions.ClientError as e:
             if e.response['Error']['Code'] == "404":
-                print("The object does not exist.")
+                log.warning(f"The object={file_key} does not exist")
             else:
                 raise
         return False
 
-    def get_list_of_aws_objects(self, bucket_path):
-        prefix = "raw/"
-        s3 = boto3.client("s3")
-        paginator = s3.get_paginator("list_objects")
-        page_iterator = paginator.paginate(Bucket=bucket_path, Prefix=prefix)
-        len_prefix = len(prefix)
-        bucket_object_list = []
-        for page in page_iterator:
-            if "Contents" in page:
-                for key in page["Contents"]:
-                    keyString = key["Key"]
-                    key_split_folder = keyString.split("/")
-                    file_path = key_split_folder[len(key_split_folder)-1]
-                    key_split_path = file_path.split("_")
-                    if (key_split_path[1] == "932"):
-                        bucket_object_list.append(keyString)
-                        self.download_remote_file("intersection-ourcamera",keyString,"/Users/abell/Downloads/932/"+file_path)
-                    elif (key_split_path[1] == "1161"):
-                        bucket_object_list.append(keyString)
-                        self.download_remote_file("intersection-ourcamera",keyString,"/Users/abell/Downloads/1161/"+file_path)
-                    elif (key_split_path[1] == "529"):
-                        bucket_object_list.append(keyString)
-                        self.download_remote_file("intersection-ourcamera",keyString,"/Users/abell/Downloads/529/"+file_path)
-                    elif (key_split_path[1] == "1116"):
-                        bucket_object_list.append(keyString)
-                        self.download_remote_file("intersection-ourcamera",keyString,"/Users/abell/Downloads/1116/"+file_path)
+    def list_partition(self, partition, location_ids=None, start_epoch=None, end_epoch=None):
+        """(key, size) of the frames in one hour partition of the given cameras with start <= epoch < end"""
+        objects = []
+        kwargs = {'Bucket': self.bucket, 'Prefix': partition}
+        while True:
+            response = self.client.list_objects_v2(**kwargs)
+            for entry in response.get('Contents', []):
+                parsed = parse_file_name(entry['Key'].rsplit('/', 1)[-1])
+                if parsed is None:
+                    continue
+                _, location_id, epoch = parsed
+                if location_ids is not None and location_id not in location_ids:
+                    continue
+                if (start_epoch is not None and epoch < start_epoch) or (end_epoch is not None and epoch >= end_epoch):
+                    continue
+                objects.append((entry['Key'], entry['Size']))
+            if not response.get('IsTruncated'):
+                return objects
+            kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+    def list_objects(self, start, end, location_ids=None):
+        """(key, size) of the frames of the given cameras taken in [start, end), listing the partitions in parallel"""
+        start_epoch, end_epoch = int(start.timestamp()), int(end.timestamp())
+        prefixes = partitions(start, end, self.prefix)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pages = executor.map(lambda p: self.list_partition(p, location_ids, start_epoch, end_epoch), prefixes)
+            objects = [entry for page in pages for entry in page]
+        log.info(f"Listed {len(prefixes)} partitions, {len(objects)} frames match")
+        return objects
+
+    @staticmethod
+    def local_path(save_directory, file_key):
+        file_name = file_key.rsplit('/', 1)[-1]
+        return os.path.join(save_directory, str(parse_file_name(file_name)[1]), file_name)
+
+    def download(self, save_directory, start, end, location_ids=None, manifest_path=None):
+        """Download the frames of the given cameras taken in [start, end), skipping those of a previous run
+
+        Returns counts of the frames listed, skipped, downloaded and failed and of the bytes downloaded.
+        """
+        started = time.time()
+        manifest = DownloadManifest(manifest_path or os.path.join(save_directory, MANIFEST_NAME))
+        stats = {'listed': 0, 'skipped': 0, 'downloaded': 0, 'failed': 0, 'bytes': 0}
+        lock = threading.Lock()
+
+        def fetch(entry):
+            file_key, size = entry
+            local_path = DownloadAwsImages.local_path(save_directory, file_key)
+            if manifest.is_done(file_key, size, local_path):
+                outcome = 'skipped'
+            else:
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                try:
+                    downloaded = self.download_remote_file(self.bucket, file_key, local_path)
+                except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+                    log.exception(f"Could not download {file_key}")
+                    downloaded = False
+                if downloaded:
+                    manifest.add(file_key, size)
+                outcome = 'downloaded' if downloaded else 'failed'
+            with lock:
+                stats[outcome] += 1
+                if outcome == 'downloaded':
+                    stats['bytes'] += size
+
+        objects = self.list_objects(start, end, location_ids)
+        stats['listed'] = len(objects)
+        os.makedirs(save_directory, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            list(executor.map(fetch, objects))
+        log.info(f"Done in {time.time() - started:.1f}s: {stats}")
+        return stats
+
+
+def parse_time(value):
+    """Local datetime of YYYY-MM-DD or YYYY-MM-DDTHH[:MM]"""
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H', '%Y-%m-%dT%H:%M'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(f"Expected YYYY-MM-DD or YYYY-MM-DDTHH[:MM], got {value}")
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
-        description='Save images', formatter_class=RawTextHelpFormatter)
+        description='Download raw frames of some cameras and dates from S3', formatter_class=RawTextHelpFormatter)
     parser.add_argument('-access_key', help='aws access key')
     parser.add_argument('-secret_key', help='aws secret key')
+    parser.add_argument('-bucket', default=BUCKET, help='bucket the frames were uploaded to')
+    parser.add_argument('-prefix', default=RAW_PREFIX, help='prefix of the hour partitions')
+    parser.add_argument('-cameras', help='comma separated cameraLocationIds, all cameras when left out')
+    parser.add_argument('-start', type=parse_time, required=True, help='first local time, YYYY-MM-DD[THH[:MM]]')
+    parser.add_argument('-end', type=parse_time, required=True, help='local time to stop before, YYYY-MM-DD[THH[:MM]]')
+    parser.add_argument('-save_directory', required=True, help='directory to save the frames to, one folder per camera')
+    parser.add_argument('-manifest', help=f'manifest of the downloaded frames, <save_directory>/{MANIFEST_NAME} '
+                                          f'by default')
+    parser.add_argument('-workers', type=int, default=DEFAULT_WORKERS, help='concurrent listings and downloads')
     args = parser.parse_args()
     ACCESS_KEY = args.access_key
     SECRET_KEY = args.secret_key
-    DownloadAwsImages().get_list_of_aws_objects("intersection-ourcamera")
\ No newline at end of file
+    cameras = {int(c) for c in args.cameras.split(',')} if args.cameras else None
+    downloader = DownloadAwsImages(args.bucket, num_workers=args.workers, prefix=args.prefix)
+    downloader.download(os.path.expanduser(args.save_directory), args.start, args.end, cameras, args.manifest)
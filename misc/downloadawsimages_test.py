@@ -1,7 +1,14 @@
+import shutil
+import tempfile
 import unittest
-from mock import patch
+from mock import MagicMock, patch
 from downloadawsimages import *
 
+try:
+    from moto import mock_aws
+except ImportError:
+    from moto import mock_s3 as mock_aws
+
 class TestDownloadAWSImages(unittest.TestCase):
 
     # Method that gets executed before each test is run in order to set up the test
@@ -17,3 +24,94 @@ class TestDownloadAWSImages(unittest.TestCase):
         return_boolean = DownloadAwsImages().download_remote_file("fake", "fake", "fake")
         assert return_boolean
 
+    def test_parse_file_name(self):
+        assert parse_file_name("261_368_1539560991.jpg") == (261, 368, 1539560991)
+        assert parse_file_name("index.json") is None
+        assert parse_file_name("261_368.jpg") is None
+
+    def test_partitions_cover_the_range_plus_a_margin(self):
+        start = datetime.datetime(2018, 12, 31, 22, 30)
+        end = datetime.datetime(2019, 1, 1, 0, 0)
+        assert partitions(start, end) == ['raw/2018/12/31/21/', 'raw/2018/12/31/22/', 'raw/2018/12/31/23/',
+                                          'raw/2019/1/1/0/']
+
+
+def s3_key(when, camera_id, location_id):
+    epoch = int(when.timestamp())
+    return '/'.join(['raw'] + [str(v) for v in [when.year, when.month, when.day, when.hour]] +
+                    [f"{camera_id}_{location_id}_{epoch}.jpg"])
+
+
+class TestBulkDownload(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.mock = mock_aws()
+        self.mock.start()
+        self.client = boto3.client('s3', region_name='us-east-1', aws_access_key_id='fake',
+                                   aws_secret_access_key='fake')
+        self.client.create_bucket(Bucket=BUCKET)
+        self.directory = tempfile.mkdtemp()
+        self.start = datetime.datetime(2018, 10, 1, 8)
+        self.end = datetime.datetime(2018, 10, 1, 10)
+        self.keys = {}
+        for when in [self.start - datetime.timedelta(hours=3), self.start, self.start + datetime.timedelta(minutes=90),
+                     self.end, self.end + datetime.timedelta(days=1)]:
+            for camera_id, location_id in [(261, 368), (300, 932)]:
+                key = s3_key(when, camera_id, location_id)
+                self.client.put_object(Bucket=BUCKET, Key=key, Body=key.encode())
+                self.keys[key] = (when, location_id)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        self.mock.stop()
+
+    def expected(self, location_id):
+        return sorted(key for key, (when, location) in self.keys.items()
+                      if location == location_id and self.start <= when < self.end)
+
+    def test_lists_only_the_partitions_of_the_range(self):
+        client = MagicMock(wraps=self.client)
+        downloader = DownloadAwsImages(client=client, num_workers=4)
+        objects = downloader.list_objects(self.start, self.end, {368})
+
+        assert sorted(key for key, _ in objects) == self.expected(368)
+        listed = sorted(c[1]['Prefix'] for c in client.list_objects_v2.call_args_list)
+        assert listed == sorted(partitions(self.start, self.end))
+        assert len(listed) == 4
+
+    def test_downloads_matching_frames_into_camera_folders(self):
+        downloader = DownloadAwsImages(client=self.client, num_workers=4)
+        stats = downloader.download(self.directory, self.start, self.end, {368, 932})
+
+        assert stats['listed'] == 4
+        assert stats['downloaded'] == 4
+        for location_id in (368, 932):
+            for key in self.expected(location_id):
+                path = os.path.join(self.directory, str(location_id), key.rsplit('/', 1)[-1])
+                with open(path, 'rb') as f:
+                    assert f.read() == key.encode()
+
+    def test_resumes_from_the_manifest(self):
+        downloader = DownloadAwsImages(client=self.client, num_workers=4)
+        downloader.download(self.directory, self.start, self.end, {368})
+        removed = DownloadAwsImages.local_path(self.directory, self.expected(368)[0])
+        os.remove(removed)
+
+        client = MagicMock(wraps=self.client)
+        stats = DownloadAwsImages(client=client, num_workers=4).download(self.directory, self.start, self.end, {368})
+
+        assert stats['skipped'] == 1
+        assert stats['downloaded'] == 1
+        assert client.download_file.call_args[0][1] == self.expected(368)[0]
+        assert os.path.exists(removed)
+
+    def test_pages_through_large_partitions(self):
+        for i in range(5):
+            self.client.put_object(Bucket=BUCKET, Key=s3_key(self.start + datetime.timedelta(seconds=i + 1), 1, 5),
+                                   Body=b'x')
+        client = MagicMock(wraps=self.client)
+        original = self.client.list_objects_v2
+        client.list_objects_v2.side_effect = lambda **kwargs: original(MaxKeys=2, **kwargs)
+        objects = DownloadAwsImages(client=client, num_workers=1).list_objects(self.start, self.end, {5})
+        assert len(objects) == 5
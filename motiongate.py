@@ -0,0 +1,116 @@
+r"""Motion gate in front of inference
+
+At night and in low traffic most consecutive frames of a camera barely change, yet each one costs a full detector
+pass. The gate compares a small grayscale thumbnail of each frame with the last frame of the same camera that went
+through the detector. When the share of thumbnail pixels that changed is below the threshold, the frame skips
+inference and the counts of that reference frame are carried forward, marked as inferred by reuse.
+
+A camera's reference is only reused for max_reuse_secs, so a slow drift (dusk, a parked car appearing pixel by
+pixel) is still picked up. Until the detections of the reference frame are in, frames of that camera are not
+gated.
+
+The change score of every frame is kept for the reporting window, so the report shows the skip rate the current
+threshold gives as well as the rates that other thresholds would have given.
+
+
+Example usage:
+    gate = MotionGate(threshold=0.02)
+    reference = gate.check(location_id, image_np, timestamp)
+    if reference is None:
+        result = run_inference(image_np)
+        gate.record(location_id, timestamp, result)
+"""
+import logging
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+THUMBNAIL_SIZE = (64, 48)
+REPORT_THRESHOLDS = (0.005, 0.01, 0.02, 0.05, 0.1)
+
+
+def thumbnail(image_np, size=THUMBNAIL_SIZE):
+    """Grayscale int16 thumbnail, area averaged so sensor noise and JPEG artifacts mostly cancel out"""
+    image = Image.fromarray(image_np).convert('L').resize(size, Image.BOX)
+    return np.asarray(image, dtype=np.int16)
+
+
+def change_score(previous, current, pixel_threshold):
+    """Share of thumbnail pixels whose brightness changed by more than pixel_threshold"""
+    return float(np.mean(np.abs(current - previous) > pixel_threshold))
+
+
+class CameraReference:
+
+    def __init__(self, thumbnail, timestamp) -> None:
+        super().__init__()
+
+        self.thumbnail = thumbnail
+        self.timestamp = timestamp
+        self.result = None
+
+
+class MotionGate:
+
+    def __init__(self, threshold=0.02, pixel_threshold=12, max_reuse_secs=300, size=THUMBNAIL_SIZE) -> None:
+        super().__init__()
+
+        self.threshold = threshold
+        self._pixel_threshold = pixel_threshold
+        self._max_reuse_secs = max_reuse_secs
+        self._size = size
+        self._references = {}
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.reused = 0
+        self.scores = []
+
+    def check(self, location_id, image_np, timestamp):
+        """The result to reuse for this frame, or None when it has to go through the detector
+
+        A frame that goes through the detector becomes the new reference of its camera.
+        """
+        current = thumbnail(image_np, self._size)
+        with self._lock:
+            self.checked += 1
+            reference = self._references.get(location_id)
+            if reference is not None and reference.thumbnail.shape == current.shape:
+                score = change_score(reference.thumbnail, current, self._pixel_threshold)
+                self.scores.append(score)
+                if (score < self.threshold and reference.result is not None
+                        and 0 <= timestamp - reference.timestamp <= self._max_reuse_secs):
+                    self.reused += 1
+                    return reference.result
+            self._references[location_id] = CameraReference(current, timestamp)
+            return None
+
+    def record(self, location_id, timestamp, result):
+        """Attach the result of the detector to the reference frame it was computed for"""
+        with self._lock:
+            reference = self._references.get(location_id)
+            if reference is not None and reference.timestamp == timestamp:
+                reference.result = result
+
+    def report(self, reset=True):
+        """Skip rate at the current threshold and at the REPORT_THRESHOLDS, over the frames checked since the last
+        report"""
+        with self._lock:
+            scores = np.asarray(self.scores)
+            report = {
+                'checked': self.checked,
+                'reused': self.reused,
+                'skip_rate': round(self.reused / self.checked, 3) if self.checked else 0.0,
+                # Upper bounds: a frame whose reference result was not in yet could not have been skipped
+                'skip_rate_at': {t: round(float(np.sum(scores < t)) / self.checked, 3) if self.checked else 0.0
+                                 for t in REPORT_THRESHOLDS},
+            }
+            if reset:
+                self.checked = 0
+                self.reused = 0
+                self.scores = []
+        return report
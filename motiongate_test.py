@@ -0,0 +1,55 @@
+import unittest
+from motiongate import *
+
+
+def frame(value=100, height=240, width=352):
+    return np.full((height, width, 3), value, dtype=np.uint8)
+
+
+class TestMotionGate(unittest.TestCase):
+
+    def test_unchanged_frame_reuses_reference_result(self):
+        gate = MotionGate(threshold=0.02)
+        assert gate.check(368, frame(), 1000) is None
+        gate.record(368, 1000, 'result-1000')
+        assert gate.check(368, frame(), 1015) == 'result-1000'
+        assert gate.report() == {'checked': 2, 'reused': 1, 'skip_rate': 0.5,
+                                 'skip_rate_at': {t: 0.5 for t in REPORT_THRESHOLDS}}
+
+    def test_changed_frame_becomes_new_reference(self):
+        gate = MotionGate(threshold=0.02)
+        gate.check(368, frame(), 1000)
+        gate.record(368, 1000, 'result-1000')
+        moved = frame()
+        moved[100:200, 100:200] = 250
+        assert gate.check(368, moved, 1015) is None
+        gate.record(368, 1015, 'result-1015')
+        assert gate.check(368, moved, 1030) == 'result-1015'
+
+    def test_no_reuse_before_reference_result_is_recorded(self):
+        gate = MotionGate(threshold=0.02)
+        gate.check(368, frame(), 1000)
+        assert gate.check(368, frame(), 1015) is None
+        # The late result of the older reference is not attached to the newer one
+        gate.record(368, 1000, 'result-1000')
+        assert gate.check(368, frame(), 1030) is None
+
+    def test_reference_expires_after_max_reuse_secs(self):
+        gate = MotionGate(threshold=0.02, max_reuse_secs=60)
+        gate.check(368, frame(), 1000)
+        gate.record(368, 1000, 'result-1000')
+        assert gate.check(368, frame(), 1061) is None
+
+    def test_cameras_are_gated_independently(self):
+        gate = MotionGate(threshold=0.02)
+        gate.check(368, frame(), 1000)
+        gate.record(368, 1000, 'result-1000')
+        assert gate.check(261, frame(), 1015) is None
+
+    def test_small_noise_does_not_count_as_change(self):
+        noisy = frame().astype(np.int16) + np.random.RandomState(0).randint(-5, 6, size=(240, 352, 3))
+        assert change_score(thumbnail(frame()), thumbnail(noisy.astype(np.uint8)), 12) == 0.0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+r"""Staged pipeline with bounded queues
+
+Running read, decode, inference and result sinks in series for each frame leaves the model idle while a frame is
+decoded and the CPU idle while a result is written to the network. A Pipeline runs each stage on its own worker
+threads instead. The stages are connected by bounded queues, so a slow stage blocks the stages before it rather
+than letting frames pile up in memory. Frames wait in the frame queue upstream instead, where the freshness policy
+still applies.
+
+Each stage reports its queue depth, the items it handled and its utilisation, which is the fraction of worker time
+spent working rather than waiting for input or for room downstream. The bottleneck stage runs close to 100% while
+the stages ahead of it run with full queues.
+
+
+Example usage:
+    pipeline = Pipeline(frame_source.next, [
+        Stage('decode', decode, num_workers=4),
+        Stage('inference', infer, flush=flush_batches),
+        Stage('sink', write_result, num_workers=4),
+    ])
+    pipeline.start()
+    ...
+    log.info(pipeline.report())
+    pipeline.stop()
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+_STOP = object()
+
+
+class StageStats:
+
+    def __init__(self, clock=time.monotonic) -> None:
+        super().__init__()
+
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = self._clock()
+            self.items = 0
+            self.busy_secs = 0.0
+
+    def record(self, busy_secs, items=1):
+        with self._lock:
+            self.items += items
+            self.busy_secs += busy_secs
+
+    def utilisation(self, num_workers=1):
+        elapsed = self._clock() - self.started_at
+        return min(self.busy_secs / (elapsed * num_workers), 1.0) if elapsed > 0 else 0.0
+
+
+class Stage:
+    """Worker threads taking items from a bounded queue
+
+    work(item) returns a list of items for the next stage, or None. flush(), when given, is called whenever the
+    queue has been empty for idle_secs and once more when the stage stops, so a stage that holds items back (such
+    as a batcher) can release them. on_error(item), when given, is called with every item work() raised on, so
+    whatever the item holds on to can be released; the item is dropped either way.
+    """
+
+    def __init__(self, name, work, num_workers=1, max_queue_size=None, flush=None, idle_secs=0.1,
+                 clock=time.monotonic, on_error=None):
+        self.name = name
+        self.num_workers = num_workers
+        self.queue = queue.Queue(maxsize=max_queue_size or 2 * num_workers)
+        self.stats = StageStats(clock)
+        self._work = work
+        self._flush = flush
+        self._on_error = on_error
+        self._idle_secs = idle_secs
+        self._clock = clock
+        self._downstream = None
+        self._threads = []
+
+    def start(self, downstream=None):
+        self._downstream = downstream
+        self._threads = [threading.Thread(target=self._run, name=f'{self.name}-{i}', daemon=True)
+                         for i in range(self.num_workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def put(self, item, timeout=None):
+        """Queue an item, blocking while the stage is full; raises queue.Full after timeout"""
+        self.queue.put(item, timeout=timeout)
+
+    def stop(self):
+        """Let the workers finish every queued item, then stop them"""
+        for _ in self._threads:
+            self.queue.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self._idle_secs if self._flush is not None else None)
+            except queue.Empty:
+                self._call(self._flush)
+                continue
+            if item is _STOP:
+                if self._flush is not None:
+                    self._call(self._flush)
+                return
+            self._call(self._work, item)
+
+    def _call(self, function, *args):
+        start = self._clock()
+        try:
+            outputs = function(*args)
+        except Exception:
+            log.exception(f"Stage={self.name} failed on {args}")
+            outputs = None
+            if args and self._on_error is not None:
+                try:
+                    self._on_error(*args)
+                except Exception:
+                    log.exception(f"Stage={self.name} could not release {args}")
+        # Time spent blocked on a full downstream queue is backpressure, not work
+        self.stats.record(self._clock() - start, len(args))
+        if outputs and self._downstream is not None:
+            for output in outputs:
+                self._downstream.put(output)
+
+    def report(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_size': self.queue.maxsize,
+            'items': self.stats.items,
+            'utilisation': round(self.stats.utilisation(self.num_workers), 3),
+        }
+
+
+class Pipeline:
+    """Feeds items from source() through the stages in order
+
+    source() is called on a reader thread and returns the next item, or None when there is nothing to read yet.
+    """
+
+    def __init__(self, source, stages, idle_secs=0.5, clock=time.monotonic):
+        self.stages = stages
+        self._source = source
+        self._idle_secs = idle_secs
+        self._clock = clock
+        self._stopping = threading.Event()
+        self._reader = None
+        self.source_stats = StageStats(clock)
+
+    def start(self):
+        for stage, downstream in zip(self.stages, self.stages[1:] + [None]):
+            stage.start(downstream)
+        self._reader = threading.Thread(target=self._read, name='reader', daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        first = self.stages[0]
+        while not self._stopping.is_set():
+            start = self._clock()
+            try:
+                item = self._source()
+            except Exception:
+                log.exception("Pipeline source failed")
+                item = None
+            if item is None:
+                self._stopping.wait(self._idle_secs)
+                continue
+            self.source_stats.record(self._clock() - start)
+            while True:
+                try:
+                    first.put(item, timeout=self._idle_secs)
+                    break
+                except queue.Full:
+                    if self._stopping.is_set():
+                        return
+
+    def stop(self):
+        """Stop reading, then drain the stages in order"""
+        self._stopping.set()
+        if self._reader is not None:
+            self._reader.join()
+        for stage in self.stages:
+            stage.stop()
+
+    def report(self, reset=True):
+        """Queue depth, items and utilisation per stage since the last report"""
+        report = {'source': {'items': self.source_stats.items,
+                             'utilisation': round(self.source_stats.utilisation(), 3)}}
+        report.update((stage.name, stage.report()) for stage in self.stages)
+        if reset:
+            self.source_stats.reset()
+            for stage in self.stages:
+                stage.stats.reset()
+        return report
@@ -0,0 +1,108 @@
+import unittest
+from pipeline import *
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_items_flow_through_every_stage(self):
+        items = list(range(20))
+        results = []
+        done = threading.Event()
+
+        def sink(item):
+            results.append(item)
+            if len(results) == 20:
+                done.set()
+
+        pipeline = Pipeline(lambda: items.pop(0) if items else None, [
+            Stage('double', lambda item: [item * 2], num_workers=3),
+            Stage('sink', sink),
+        ], idle_secs=0.01)
+        pipeline.start()
+        try:
+            assert done.wait(5)
+        finally:
+            pipeline.stop()
+        assert sorted(results) == [i * 2 for i in range(20)]
+        report = pipeline.report()
+        assert report['double']['items'] == 20
+        assert report['sink']['items'] == 20
+        assert report['source']['items'] == 20
+
+    def test_slow_stage_applies_backpressure(self):
+        release = threading.Event()
+        read = []
+
+        def source():
+            read.append(len(read))
+            return read[-1]
+
+        pipeline = Pipeline(source, [Stage('slow', lambda item: release.wait(), max_queue_size=2)], idle_secs=0.01)
+        pipeline.start()
+        time.sleep(0.2)
+        # One item in the worker, two queued and one blocked in the reader
+        assert len(read) <= 4
+        assert pipeline.stages[0].report()['queue_depth'] == 2
+        release.set()
+        pipeline.stop()
+
+    def test_flush_runs_when_idle_and_on_stop(self):
+        held = []
+        flushed = []
+
+        def flush():
+            flushed.extend(held)
+            held.clear()
+
+        stage = Stage('batch', held.append, flush=flush, idle_secs=0.01)
+        stage.start()
+        stage.put('a')
+        time.sleep(0.1)
+        assert flushed == ['a']
+        stage.put('b')
+        stage.stop()
+        assert flushed == ['a', 'b']
+
+    def test_failing_item_does_not_stop_the_stage(self):
+        results = []
+
+        def work(item):
+            if item == 'bad':
+                raise ValueError(item)
+            results.append(item)
+
+        stage = Stage('sink', work)
+        stage.start()
+        stage.put('bad')
+        stage.put('good')
+        stage.stop()
+        assert results == ['good']
+
+    def test_failing_item_is_handed_to_on_error(self):
+        failed = []
+
+        def work(item):
+            if item == 'bad':
+                raise ValueError(item)
+
+        def flush():
+            raise ValueError('flush')
+
+        stage = Stage('decode', work, flush=flush, on_error=failed.append)
+        stage.start()
+        stage.put('good')
+        stage.put('bad')
+        stage.stop()
+        assert failed == ['bad']
+
+    def test_utilisation(self):
+        clock = [0.0]
+        stats = StageStats(clock=lambda: clock[0])
+        clock[0] = 10.0
+        stats.record(5.0)
+        assert stats.utilisation() == 0.5
+        assert stats.utilisation(num_workers=2) == 0.25
+
+
+if __name__ == '__main__':
+    unittest.main()
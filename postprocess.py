@@ -0,0 +1,97 @@
+r"""Vectorized counting of detections per class
+
+Counts the detections of a frame, or of a whole batch of frames, for every class of the category index in one pass.
+A detection counts when its score is above the threshold of its class. Classes can have their own thresholds, and
+classes sharing a name in the label map (data/car_label_map.pbtxt has two 'pedestrian' and two 'bicycle' IDs) are
+counted together.
+
+
+Example usage:
+    counter = DetectionCounter(category_index, thresholds=parse_thresholds("car=0.5,Blocking Bike Lane=0.3"))
+    counts = counter.count(scores, classes, num)
+    counter.as_dict(counts[0])  # {'pedestrian': 2, 'bicycle': 0, 'car': 5, ...}
+"""
+import re
+
+import numpy as np
+
+DEFAULT_THRESHOLD = .4
+
+_LABEL_MAP_ITEM = re.compile(r'item\s*\{(.*?)\}', re.S)
+_LABEL_MAP_FIELD = re.compile(r'(\w+)\s*:\s*(?:\'([^\']*)\'|"([^"]*)"|(\S+))')
+
+
+def load_category_index(path):
+    """Category index of a label map .pbtxt, like label_map_util.create_category_index with display names, for
+    tools that run without the object detection API"""
+    with open(path) as f:
+        text = f.read()
+    category_index = {}
+    for item in _LABEL_MAP_ITEM.findall(text):
+        fields = {key: quoted or double_quoted or bare for key, quoted, double_quoted, bare
+                  in _LABEL_MAP_FIELD.findall(item)}
+        class_id = int(fields['id'])
+        category_index[class_id] = {'id': class_id, 'name': fields.get('display_name', fields.get('name'))}
+    return category_index
+
+
+def parse_thresholds(spec):
+    """Class name to score threshold from "name=threshold,name=threshold" """
+    thresholds = {}
+    for part in filter(None, (p.strip() for p in (spec or '').split(','))):
+        name, _, threshold = part.rpartition('=')
+        if not name:
+            raise ValueError(f"Expected <class name>=<threshold>, got {part}")
+        thresholds[name.strip()] = float(threshold)
+    return thresholds
+
+
+class DetectionCounter:
+
+    def __init__(self, category_index, default_threshold=DEFAULT_THRESHOLD, thresholds=None) -> None:
+        super().__init__()
+
+        thresholds = thresholds or {}
+        unknown = set(thresholds) - {category['name'] for category in category_index.values()}
+        if unknown:
+            raise ValueError(f"Thresholds given for classes={sorted(unknown)} that are not in the label map")
+
+        # Class names in label map ID order, each name once
+        self.class_names = list(dict.fromkeys(category_index[class_id]['name'] for class_id in sorted(category_index)))
+        self.max_class_id = max(category_index) if category_index else 0
+        # Lookup tables indexed by class ID; IDs missing from the label map have no column
+        self._columns = np.full(self.max_class_id + 1, -1, dtype=np.int64)
+        self._thresholds = np.full(self.max_class_id + 1, np.inf, dtype=np.float32)
+        for class_id, category in category_index.items():
+            self._columns[class_id] = self.class_names.index(category['name'])
+            self._thresholds[class_id] = thresholds.get(category['name'], default_threshold)
+
+    def count(self, scores, classes, num=None, where=None):
+        """[N, len(class_names)] detection counts for [N, K] (or [K] for one frame) scores and classes
+
+        where is an optional boolean mask of the same shape selecting the detections to count.
+        """
+        scores = np.atleast_2d(np.asarray(scores))
+        classes = np.atleast_2d(np.asarray(classes))
+        frames, max_detections = scores.shape
+        mask = np.ones(scores.shape, dtype=bool)
+        if num is not None:
+            mask &= np.arange(max_detections) < np.asarray(num, dtype=np.int64).reshape(-1, 1)
+        if where is not None:
+            mask &= np.atleast_2d(where)
+        rows, detections = np.nonzero(mask)
+        return self.count_flat(rows, scores[rows, detections], classes[rows, detections], frames)
+
+    def count_flat(self, frame_index, scores, classes, frames):
+        """[frames, len(class_names)] detection counts for flat detection arrays, frame_index giving the frame (row)
+        each detection belongs to"""
+        classes = np.asarray(classes).astype(np.int64)
+        in_label_map = (classes >= 0) & (classes <= self.max_class_id)
+        class_ids = np.where(in_label_map, classes, 0)
+        mask = in_label_map & (scores > self._thresholds[class_ids]) & (self._columns[class_ids] >= 0)
+        cells = np.asarray(frame_index)[mask] * len(self.class_names) + self._columns[class_ids[mask]]
+        return np.bincount(cells, minlength=frames * len(self.class_names)).reshape(frames, len(self.class_names))
+
+    def as_dict(self, counts):
+        """Class name to count for the counts of one frame"""
+        return {name: int(count) for name, count in zip(self.class_names, counts)}
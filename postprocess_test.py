@@ -0,0 +1,69 @@
+import unittest
+from postprocess import *
+
+CATEGORY_INDEX = {
+    1: {'id': 1, 'name': 'pedestrian'},
+    2: {'id': 2, 'name': 'bicycle'},
+    3: {'id': 3, 'name': 'car'},
+    5: {'id': 5, 'name': 'pedestrian'},
+    8: {'id': 8, 'name': 'Blocking Bike Lane'},
+}
+
+
+def loop_count(scores, classes, category_index, threshold):
+    """The counting loop the analyzer used before, extended to every class"""
+    counts = {}
+    for score, class_id in zip(scores, classes.astype(np.int32)):
+        if score > threshold and class_id in category_index:
+            name = category_index[class_id]['name']
+            counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+class TestDetectionCounter(unittest.TestCase):
+
+    def test_counts_every_class_and_merges_shared_names(self):
+        counter = DetectionCounter(CATEGORY_INDEX)
+        assert counter.class_names == ['pedestrian', 'bicycle', 'car', 'Blocking Bike Lane']
+        scores = np.array([[0.9, 0.8, 0.7, 0.6, 0.5, 0.3]])
+        classes = np.array([[1., 5., 3., 3., 8., 3.]])
+        counts = counter.count(scores, classes)
+        assert counter.as_dict(counts[0]) == {'pedestrian': 2, 'bicycle': 0, 'car': 2, 'Blocking Bike Lane': 1}
+
+    def test_per_class_thresholds(self):
+        counter = DetectionCounter(CATEGORY_INDEX, thresholds={'car': 0.65, 'Blocking Bike Lane': 0.2})
+        counts = counter.count(np.array([0.7, 0.6, 0.3]), np.array([3., 3., 8.]))
+        assert counter.as_dict(counts[0])['car'] == 1
+        assert counter.as_dict(counts[0])['Blocking Bike Lane'] == 1
+
+    def test_unknown_classes_and_padding_are_ignored(self):
+        counter = DetectionCounter(CATEGORY_INDEX)
+        scores = np.array([[0.9, 0.9, 0.9, 0.9]])
+        classes = np.array([[4., 90., 3., 3.]])
+        counts = counter.count(scores, classes, num=np.array([3.]))
+        assert counter.as_dict(counts[0])['car'] == 1
+        assert counts.sum() == 1
+
+    def test_batch_matches_the_per_box_loop(self):
+        counter = DetectionCounter(CATEGORY_INDEX)
+        rng = np.random.RandomState(0)
+        scores = rng.rand(4, 100)
+        classes = rng.randint(0, 10, size=(4, 100)).astype(np.float32)
+        counts = counter.count(scores, classes)
+        for i in range(4):
+            expected = loop_count(scores[i], classes[i], CATEGORY_INDEX, DEFAULT_THRESHOLD)
+            assert {k: v for k, v in counter.as_dict(counts[i]).items() if v} == expected
+
+    def test_thresholds_for_unknown_classes_are_rejected(self):
+        with self.assertRaises(ValueError):
+            DetectionCounter(CATEGORY_INDEX, thresholds={'truck': 0.5})
+
+    def test_parse_thresholds(self):
+        assert parse_thresholds("car=0.5, Blocking Bike Lane=0.3") == {'car': 0.5, 'Blocking Bike Lane': 0.3}
+        assert parse_thresholds(None) == {}
+        with self.assertRaises(ValueError):
+            parse_thresholds("0.5")
+
+
+if __name__ == '__main__':
+    unittest.main()
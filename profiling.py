@@ -0,0 +1,253 @@
+r"""On-demand step traces and Python profiles of a running analyzer
+
+When the analyzer slows down, two captures show where the time goes without restarting it:
+
+    trace    the next N session runs of the tf backend are run with a full trace. Each is saved as a Chrome trace
+             (open in chrome://tracing or Perfetto) and summarized in the log by top-level graph scope, which
+             separates preprocessing, the region proposal network (FirstStage*) and the box classifier
+             (SecondStage*).
+    profile  every thread of the process is sampled for a number of seconds. The stacks are saved in the collapsed
+             format of flamegraph.pl and speedscope, and the functions seen most are logged.
+
+A capture is requested with a signal, SIGUSR1 for a trace and SIGUSR2 for a profile, or by writing a control file
+holding "trace [steps]" or "profile [secs]", one per line; the file is removed once read. Nothing runs while no
+capture is requested: a detector checks one attribute per batch, and the control file is checked once a second
+only when one is given.
+
+
+Example usage:
+    control = ProfilingControl('./profiles', control_path='/tmp/analyzer.profile')
+    control.install_signal_handlers()
+    control.start()
+    detector.tracer = control.tracer
+    ...
+    $ echo "trace 5" > /tmp/analyzer.profile    or    kill -USR2 <pid>
+"""
+import collections
+import itertools
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+DEFAULT_TRACE_STEPS = 5
+DEFAULT_PROFILE_SECS = 30
+SAMPLE_INTERVAL_SECS = 0.005
+CONTROL_POLL_SECS = 1.0
+TOP_FUNCTIONS = 15
+SIGNAL_TRACE = getattr(signal, 'SIGUSR1', None)
+SIGNAL_PROFILE = getattr(signal, 'SIGUSR2', None)
+
+_captures = itertools.count(1)
+
+
+def write_atomically(path, text):
+    partial = path + '.part'
+    with open(partial, 'w') as f:
+        f.write(text)
+    os.replace(partial, path)
+
+
+def capture_path(directory, kind, suffix):
+    return os.path.join(directory, f"{kind}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}-{next(_captures)}{suffix}")
+
+
+def scope_times(step_stats):
+    """Microseconds spent per top-level name scope of the graph, over all devices of a traced step, longest first"""
+    totals = collections.Counter()
+    for device in step_stats.dev_stats:
+        for node in device.node_stats:
+            totals[node.node_name.split('/')[0].split(':')[0]] += node.all_end_rel_micros
+    return totals.most_common()
+
+
+class StepTracer:
+    """Counts down the session runs left to trace and saves their RunMetadata"""
+
+    def __init__(self, directory) -> None:
+        super().__init__()
+
+        self.directory = directory
+        # Set without the lock: request() is called from signal handlers, which must not wait on it
+        self.remaining = 0
+        self._lock = threading.Lock()
+
+    def request(self, steps=DEFAULT_TRACE_STEPS):
+        self.remaining = steps
+        log.info(f"Tracing the next {steps} session runs to directory={self.directory}")
+
+    def take(self):
+        """Whether the session run about to start is to be traced"""
+        if self.remaining <= 0:
+            return False
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+    def save(self, run_metadata, batch_size):
+        """Save a traced run as a Chrome trace and log its time per scope; a failure only costs the trace"""
+        try:
+            from tensorflow.python.client import timeline
+            os.makedirs(self.directory, exist_ok=True)
+            path = capture_path(self.directory, 'trace', '.json')
+            write_atomically(path, timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+        except Exception:
+            log.exception(f"Could not save a trace to directory={self.directory}")
+            return None
+        scopes = ', '.join(f"{scope}={micros / 1000:.1f}ms" for scope, micros in scope_times(run_metadata.step_stats))
+        log.info(f"Saved trace={path} of a batch of {batch_size}: {scopes}")
+        return path
+
+
+class SamplingProfiler:
+    """Samples the stacks of every other thread at a fixed interval"""
+
+    def __init__(self, interval_secs=SAMPLE_INTERVAL_SECS, clock=time.monotonic) -> None:
+        super().__init__()
+
+        self._interval_secs = interval_secs
+        self._clock = clock
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    @staticmethod
+    def frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(SamplingProfiler.frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            self.stacks[';'.join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self, secs):
+        deadline = self._clock() + secs
+        while self._clock() < deadline:
+            self.sample()
+            time.sleep(self._interval_secs)
+        return self
+
+    def collapsed(self):
+        """One "thread;outer;...;inner count" line per distinct stack"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top(self, n=TOP_FUNCTIONS):
+        """(function, samples) of the functions on top of the stacks most often"""
+        leaves = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(n)
+
+
+class ProfilingControl:
+    """Starts traces and profiles when a signal arrives or a control file appears"""
+
+    def __init__(self, directory, control_path=None, trace_steps=DEFAULT_TRACE_STEPS,
+                 profile_secs=DEFAULT_PROFILE_SECS, poll_secs=CONTROL_POLL_SECS) -> None:
+        super().__init__()
+
+        self.directory = directory
+        self.tracer = StepTracer(directory)
+        self._control_path = control_path
+        self._trace_steps = trace_steps
+        self._profile_secs = profile_secs
+        self._poll_secs = poll_secs
+        self._profiling = threading.Event()
+        self._stop = threading.Event()
+        self._watcher = None
+
+    def install_signal_handlers(self):
+        """SIGUSR1 traces, SIGUSR2 profiles; only possible from the main thread"""
+        if SIGNAL_TRACE is None:
+            log.warning("Signals are not available on this platform, use a control file")
+            return
+        signal.signal(SIGNAL_TRACE, lambda signum, frame: self.trace())
+        signal.signal(SIGNAL_PROFILE, lambda signum, frame: self.profile())
+
+    def start(self):
+        if self._control_path:
+            self._watcher = threading.Thread(target=self._watch, name='profiling-control', daemon=True)
+            self._watcher.start()
+            log.info(f"Watching for profiling requests in control file={self._control_path}")
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+
+    def trace(self, steps=None):
+        self.tracer.request(steps or self._trace_steps)
+
+    def profile(self, secs=None):
+        """Profile from a background thread for secs, unless a profile is being taken already"""
+        if self._profiling.is_set():
+            log.warning("A profile is being taken already, ignoring the request")
+            return
+        self._profiling.set()
+        threading.Thread(target=self._profile, args=(secs or self._profile_secs,), name='profiler',
+                         daemon=True).start()
+
+    def _profile(self, secs):
+        try:
+            log.info(f"Profiling for {secs}s")
+            profiler = SamplingProfiler().run(secs)
+            os.makedirs(self.directory, exist_ok=True)
+            path = capture_path(self.directory, 'profile', '.folded')
+            write_atomically(path, profiler.collapsed())
+            top = ', '.join(f"{name}={count / max(profiler.samples, 1):.0%}" for name, count in profiler.top())
+            log.info(f"Saved profile={path} of {profiler.samples} samples; on top of the stacks: {top}")
+        except Exception:
+            log.exception("Could not take a profile")
+        finally:
+            self._profiling.clear()
+
+    def _watch(self):
+        while not self._stop.wait(self._poll_secs):
+            if os.path.exists(self._control_path):
+                self.handle_control_file()
+
+    def handle_control_file(self):
+        try:
+            with open(self._control_path) as f:
+                lines = f.read().splitlines()
+            os.remove(self._control_path)
+        except FileNotFoundError:
+            return
+        except IOError:
+            log.exception(f"Could not read control file={self._control_path}")
+            return
+        for line in filter(None, (line.strip() for line in lines)):
+            command, _, value = line.partition(' ')
+            try:
+                if command == 'trace':
+                    self.trace(int(value) if value else None)
+                elif command == 'profile':
+                    self.profile(float(value) if value else None)
+                else:
+                    log.warning(f"Unknown profiling command={line}, expected trace [steps] or profile [secs]")
+            except ValueError:
+                log.warning(f"Malformed profiling command={line}")
+
+
+def ignore_signals():
+    """Keep the profiling signals from terminating a process that does not handle them, e.g. the worker parent"""
+    if SIGNAL_TRACE is not None:
+        signal.signal(SIGNAL_TRACE, signal.SIG_IGN)
+        signal.signal(SIGNAL_PROFILE, signal.SIG_IGN)
@@ -0,0 +1,85 @@
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+from profiling import *
+
+
+def node(name, micros):
+    return SimpleNamespace(node_name=name, all_end_rel_micros=micros)
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_scope_times_sums_nodes_per_top_level_scope(self):
+        step_stats = SimpleNamespace(dev_stats=[
+            SimpleNamespace(node_stats=[node('Preprocessor/map/while/ResizeImage', 300),
+                                        node('FirstStageFeatureExtractor/resnet_v1_50/conv1', 5000)]),
+            SimpleNamespace(node_stats=[node('FirstStageFeatureExtractor/resnet_v1_50/block1', 2000),
+                                        node('SecondStageBoxPredictor/Reshape:Reshape', 700),
+                                        node('_SOURCE', 1)]),
+        ])
+        assert scope_times(step_stats) == [('FirstStageFeatureExtractor', 7000), ('SecondStageBoxPredictor', 700),
+                                           ('Preprocessor', 300), ('_SOURCE', 1)]
+
+    def test_tracer_counts_down_the_requested_steps(self):
+        tracer = StepTracer(self.directory)
+        assert not tracer.take()
+        tracer.request(2)
+        assert [tracer.take() for _ in range(3)] == [True, True, False]
+
+    def test_profiler_samples_other_threads(self):
+        stop = threading.Event()
+
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(1000))
+
+        thread = threading.Thread(target=busy_loop, name='busy')
+        thread.start()
+        try:
+            profiler = SamplingProfiler(interval_secs=0.001).run(0.2)
+        finally:
+            stop.set()
+            thread.join()
+        assert profiler.samples > 0
+        busy = [stack for stack in profiler.stacks if stack.startswith('busy;')]
+        assert busy and all('busy_loop (profiling_test.py:' in stack for stack in busy)
+        assert 'busy_loop (profiling_test.py:' in profiler.collapsed()
+        assert not any('SamplingProfiler' in stack for stack in profiler.stacks)
+
+    def test_control_file_requests_traces_and_profiles(self):
+        control_path = os.path.join(self.directory, 'control')
+        control = ProfilingControl(self.directory, control_path, trace_steps=5)
+        with open(control_path, 'w') as f:
+            f.write("trace 3\nprofile 0.05\nbogus\n")
+        control.handle_control_file()
+        assert not os.path.exists(control_path)
+        assert control.tracer.remaining == 3
+        deadline = time.monotonic() + 5
+        while not any(name.endswith('.folded') for name in os.listdir(self.directory)):
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+    @unittest.skipIf(SIGNAL_TRACE is None, "no SIGUSR1 on this platform")
+    def test_signal_requests_a_trace(self):
+        control = ProfilingControl(self.directory, trace_steps=4)
+        previous = signal.getsignal(SIGNAL_TRACE), signal.getsignal(SIGNAL_PROFILE)
+        control.install_signal_handlers()
+        try:
+            os.kill(os.getpid(), SIGNAL_TRACE)
+            time.sleep(0.01)
+            assert control.tracer.remaining == 4
+        finally:
+            signal.signal(SIGNAL_TRACE, previous[0])
+            signal.signal(SIGNAL_PROFILE, previous[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
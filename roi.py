@@ -0,0 +1,122 @@
+r"""Per-camera regions of interest
+
+The analyzer exists to measure how often bike lanes and bus stops are blocked, and most of each frame is neither.
+A region config lists, per cameraLocationId, the polygons that matter in frame pixel coordinates:
+
+    {
+        "368": {
+            "margin": 16,
+            "regions": [
+                {"name": "bike_lane", "polygon": [[40, 239], [120, 120], [150, 120], [90, 239]]},
+                {"name": "bus_stop", "polygon": [[200, 239], [230, 140], [300, 140], [351, 239]]}
+            ]
+        }
+    }
+
+For a camera with regions, only the bounding box of its polygons (plus a margin, so vehicles partly outside a
+region are still seen whole) goes through the detector. Detections are mapped back into frame coordinates, and a
+detection occupies a region when the bottom center of its box, where it meets the road, lies inside the polygon.
+Cameras without regions are analyzed on the full frame.
+
+
+Example usage:
+    regions = RegionConfig.load("data/regions.json")
+    camera = regions.get(368)
+    crop = camera.crop(image_np)
+    occupancy = camera.occupancy(boxes, scores, classes, num, crop.shape, counter)
+"""
+import json
+import logging
+import os
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+DEFAULT_MARGIN = 16
+
+
+class Region:
+
+    def __init__(self, name, polygon) -> None:
+        super().__init__()
+
+        self.name = name
+        self.polygon = np.asarray(polygon, dtype=np.float64)
+        if self.polygon.ndim != 2 or self.polygon.shape[1] != 2 or len(self.polygon) < 3:
+            raise ValueError(f"Region={name} needs a polygon of at least three [x, y] points")
+
+    def contains(self, x, y):
+        """Boolean mask of the points (x, y), arrays of any matching shape, inside the polygon (even-odd rule)"""
+        inside = np.zeros(np.shape(x), dtype=bool)
+        x0, y0 = self.polygon[-1]
+        for x1, y1 in self.polygon:
+            crosses = (y1 > y) != (y0 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = (x0 - x1) * (y - y1) / (y0 - y1) + x1
+            inside ^= crosses & (x < x_cross)
+            x0, y0 = x1, y1
+        return inside
+
+
+class CameraRegions:
+
+    def __init__(self, regions, margin=DEFAULT_MARGIN) -> None:
+        super().__init__()
+
+        if not regions:
+            raise ValueError("A camera needs at least one region")
+        self.regions = regions
+        points = np.concatenate([region.polygon for region in regions])
+        self.left = max(int(np.floor(points[:, 0].min())) - margin, 0)
+        self.top = max(int(np.floor(points[:, 1].min())) - margin, 0)
+        self.right = int(np.ceil(points[:, 0].max())) + margin + 1
+        self.bottom = int(np.ceil(points[:, 1].max())) + margin + 1
+
+    def crop(self, image_np):
+        """The part of the frame covering every region; a view, no pixels are copied"""
+        return image_np[self.top:self.bottom, self.left:self.right]
+
+    def anchors(self, boxes, crop_shape):
+        """Frame pixel (x, y) of the bottom center of normalized (ymin, xmin, ymax, xmax) boxes inside the crop"""
+        boxes = np.asarray(boxes)
+        height, width = crop_shape[:2]
+        x = (boxes[..., 1] + boxes[..., 3]) / 2 * width + self.left
+        y = boxes[..., 2] * height + self.top
+        return x, y
+
+    def occupancy(self, boxes, scores, classes, num, crop_shape, counter):
+        """Region name to {class name: count} of the detections of one frame standing in each region"""
+        x, y = self.anchors(boxes, crop_shape)
+        return {region.name: counter.as_dict(counter.count(scores, classes, num, where=region.contains(x, y))[0])
+                for region in self.regions}
+
+
+class RegionConfig:
+
+    def __init__(self, cameras) -> None:
+        super().__init__()
+
+        self.cameras = cameras
+
+    def __len__(self):
+        return len(self.cameras)
+
+    def get(self, location_id):
+        return self.cameras.get(int(location_id))
+
+    @staticmethod
+    def from_json(config):
+        cameras = {}
+        for location_id, camera in config.items():
+            regions = [Region(region['name'], region['polygon']) for region in camera['regions']]
+            cameras[int(location_id)] = CameraRegions(regions, camera.get('margin', DEFAULT_MARGIN))
+        return RegionConfig(cameras)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            config = RegionConfig.from_json(json.load(f))
+        log.info(f"Loaded regions of interest for {len(config)} cameras from {path}")
+        return config
@@ -0,0 +1,59 @@
+import unittest
+from roi import *
+from postprocess import DetectionCounter
+
+CATEGORY_INDEX = {1: {'id': 1, 'name': 'pedestrian'}, 3: {'id': 3, 'name': 'car'}}
+
+CONFIG = {
+    "368": {
+        "margin": 10,
+        "regions": [
+            {"name": "bike_lane", "polygon": [[100, 100], [200, 100], [200, 200], [100, 200]]},
+            {"name": "bus_stop", "polygon": [[200, 100], [300, 100], [250, 200]]},
+        ]
+    }
+}
+
+
+class TestRegions(unittest.TestCase):
+
+    def test_contains(self):
+        region = Region('triangle', [[0, 0], [10, 0], [0, 10]])
+        x = np.array([1, 6, 20, 4])
+        y = np.array([1, 6, 1, 4])
+        np.testing.assert_array_equal(region.contains(x, y), [True, False, False, True])
+
+    def test_polygon_needs_three_points(self):
+        with self.assertRaises(ValueError):
+            Region('line', [[0, 0], [10, 10]])
+
+    def test_crop_covers_regions_with_margin_and_is_a_view(self):
+        camera = RegionConfig.from_json(CONFIG).get(368)
+        image = np.zeros((240, 352, 3), dtype=np.uint8)
+        crop = camera.crop(image)
+        assert crop.shape == (121, 221, 3)
+        assert np.shares_memory(crop, image)
+
+    def test_cameras_without_regions(self):
+        config = RegionConfig.from_json(CONFIG)
+        assert config.get(1) is None
+        assert len(config) == 1
+
+    def test_occupancy_maps_crop_detections_back_to_frame_regions(self):
+        camera = RegionConfig.from_json(CONFIG).get(368)
+        crop_shape = (121, 221, 3)
+        # Bottom centers in frame pixels: (150, 150) in the bike lane, (250, 150) at the bus stop, (90, 215) in none
+        boxes = np.array([[
+            [(140 - 90) / 121, (140 - 90) / 221, (150 - 90) / 121, (160 - 90) / 221],
+            [(140 - 90) / 121, (240 - 90) / 221, (150 - 90) / 121, (260 - 90) / 221],
+            [(200 - 90) / 121, (90 - 90) / 221, (210 - 90) / 121, (90 - 90) / 221],
+        ]])
+        scores = np.array([[0.9, 0.9, 0.9]])
+        classes = np.array([[3., 1., 3.]])
+        occupancy = camera.occupancy(boxes, scores, classes, np.array([3.]), crop_shape,
+                                     DetectionCounter(CATEGORY_INDEX))
+        assert occupancy == {'bike_lane': {'pedestrian': 0, 'car': 1}, 'bus_stop': {'pedestrian': 1, 'car': 0}}
+
+
+if __name__ == '__main__':
+    unittest.main()
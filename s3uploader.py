@@ -0,0 +1,220 @@
+r"""Shared, concurrent S3 uploader
+
+One long-lived S3 client with a connection pool sized to the number of upload threads is shared by every upload of
+a process. Uploads are queued on a bounded queue and performed by worker threads, so callers never wait on S3. Each
+upload is retried with exponential backoff. Completion is signalled explicitly: submit() returns a Future, and the
+optional on_success/on_failure callbacks run once the upload has finished or has finally failed.
+
+
+Example usage:
+    uploader = S3Uploader("intersection-ourcamera")
+    future = uploader.submit_file("/tmp/rawimages/1_2_3.jpg", "raw/2018/1/2/3/1_2_3.jpg",
+                                  on_success=lambda: os.remove("/tmp/rawimages/1_2_3.jpg"))
+    future.result()
+"""
+import io
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import boto3
+import botocore.config
+import botocore.exceptions
+from boto3.s3.transfer import TransferConfig
+
+from metrics import OUTCOME_ERROR, OUTCOME_OK, REGISTRY, STAGE_ITEMS, record_stage
+
+log = logging.getLogger(__name__)
+log.setLevel(str(os.getenv('LOG_LEVEL', 'INFO')))
+
+STAGE_UPLOAD = 'upload'
+UPLOAD_QUEUE_DEPTH = REGISTRY.gauge('ourcamera_upload_queue_depth', 'Uploads waiting for an S3 upload thread')
+
+_uploaders = {}
+_uploaders_lock = threading.Lock()
+
+
+def get_uploader(bucket, key=None, secret=None, **kwargs):
+    """Return the uploader of this process for the bucket, creating it on first use
+
+    Uploaders are keyed by process ID as well, so worker processes forked from a parent never share its threads.
+    """
+    with _uploaders_lock:
+        uploader_key = (os.getpid(), bucket)
+        if uploader_key not in _uploaders:
+            _uploaders[uploader_key] = S3Uploader(bucket, key, secret, **kwargs)
+        return _uploaders[uploader_key]
+
+
+def close_uploaders():
+    """Finish the queued uploads of every uploader of this process and stop their threads, e.g. before it exits"""
+    with _uploaders_lock:
+        uploaders = [_uploaders.pop(k) for k in list(_uploaders) if k[0] == os.getpid()]
+    for uploader in uploaders:
+        uploader.close()
+
+
+class UploadStats:
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.uploaded = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.bytes = 0
+
+    def __repr__(self):
+        return (f"uploaded={self.uploaded} failed={self.failed} retried={self.retried} rejected={self.rejected} "
+                f"bytes={self.bytes}")
+
+
+class UploadJob:
+
+    def __init__(self, s3_key, local_path=None, data=None, on_success=None, on_failure=None, extra_args=None) -> None:
+        super().__init__()
+
+        self.s3_key = s3_key
+        self.local_path = local_path
+        self.data = data
+        self.extra_args = extra_args
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.future = Future()
+        self.started_at = None
+
+    def __repr__(self):
+        return f"UploadJob({self.local_path or f'<{len(self.data)} bytes>'} -> {self.s3_key})"
+
+
+class S3Uploader:
+
+    def __init__(self, bucket, key=None, secret=None, num_workers=8, max_queue_size=2000, max_attempts=4,
+                 backoff_base_secs=0.5, client=None):
+        self._bucket = bucket
+        self._max_attempts = max_attempts
+        self._backoff_base_secs = backoff_base_secs
+        if client is None:
+            client = boto3.session.Session().client(
+                's3', aws_access_key_id=key, aws_secret_access_key=secret,
+                config=botocore.config.Config(max_pool_connections=num_workers))
+        self._client = client
+        # Frames are small, so each upload runs on its worker thread instead of spawning transfer threads
+        self._transfer_config = TransferConfig(use_threads=False)
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._closed = False
+        self.stats = UploadStats()
+        self._stats_lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._work, name=f's3-upload-{i}', daemon=True)
+                         for i in range(num_workers)]
+        for worker in self._workers:
+            worker.start()
+        UPLOAD_QUEUE_DEPTH.set_function(lambda: self.queue_depth)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit_file(self, local_path, s3_key, on_success=None, on_failure=None, extra_args=None):
+        return self._submit(UploadJob(s3_key, local_path=local_path, on_success=on_success, on_failure=on_failure,
+                                      extra_args=extra_args))
+
+    def submit_bytes(self, data, s3_key, on_success=None, on_failure=None, extra_args=None):
+        return self._submit(UploadJob(s3_key, data=data, on_success=on_success, on_failure=on_failure,
+                                      extra_args=extra_args))
+
+    def _submit(self, job):
+        """Queue a job without blocking; a full queue fails the job immediately"""
+        if self._closed:
+            raise RuntimeError("S3Uploader is closed")
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._stats_lock:
+                self.stats.rejected += 1
+            STAGE_ITEMS.labels(STAGE_UPLOAD, 'rejected').inc()
+            log.error(f"Upload queue full, rejecting {job}")
+            self._finish(job, queue.Full(f"Upload queue full, rejected {job}"))
+        return job.future
+
+    def join(self):
+        """Block until every queued upload has finished"""
+        self._queue.join()
+
+    def close(self):
+        """Finish queued uploads and stop the worker threads"""
+        self._closed = True
+        self._queue.join()
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                self._upload(job)
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, job):
+        job.started_at = time.monotonic()
+        for attempt in range(1, self._max_attempts + 1):
+            try:
+                if job.data is not None:
+                    self._client.upload_fileobj(io.BytesIO(job.data), self._bucket, job.s3_key,
+                                                ExtraArgs=job.extra_args, Config=self._transfer_config)
+                    size = len(job.data)
+                else:
+                    size = os.path.getsize(job.local_path)
+                    self._client.upload_file(job.local_path, self._bucket, job.s3_key, ExtraArgs=job.extra_args,
+                                             Config=self._transfer_config)
+            except FileNotFoundError as e:
+                log.error(f"Cannot upload missing file for {job}")
+                self._finish(job, e)
+                return
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, IOError) as e:
+                if attempt == self._max_attempts:
+                    log.exception(f"Giving up on {job} after {attempt} attempts")
+                    self._finish(job, e)
+                    return
+                with self._stats_lock:
+                    self.stats.retried += 1
+                delay = self._backoff_base_secs * 2 ** (attempt - 1)
+                log.warning(f"Upload attempt {attempt} of {job} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+            else:
+                with self._stats_lock:
+                    self.stats.uploaded += 1
+                    self.stats.bytes += size
+                log.debug(f"Wrote {job.s3_key} to s3://{self._bucket}")
+                self._finish(job)
+                return
+
+    def _finish(self, job, error=None):
+        if error is not None and not isinstance(error, queue.Full):
+            with self._stats_lock:
+                self.stats.failed += 1
+        if job.started_at is not None:
+            record_stage(STAGE_UPLOAD, time.monotonic() - job.started_at,
+                         outcome=OUTCOME_OK if error is None else OUTCOME_ERROR)
+        callback = job.on_success if error is None else job.on_failure
+        try:
+            if callback is not None:
+                callback()
+        except Exception:
+            log.exception(f"Completion callback failed for {job}")
+        finally:
+            # Release the payload as soon as the job is done, the future may be held for a long time
+            job.data = None
+            if error is None:
+                job.future.set_result(job.s3_key)
+            else:
+                job.future.set_exception(error)
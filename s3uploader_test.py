@@ -0,0 +1,92 @@
+import shutil
+import tempfile
+import unittest
+from mock import MagicMock
+from s3uploader import *
+
+try:
+    from moto import mock_aws
+except ImportError:
+    from moto import mock_s3 as mock_aws
+
+BUCKET = "test-bucket"
+
+
+class TestS3Uploader(unittest.TestCase):
+
+    def setUp(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        self.mock = mock_aws()
+        self.mock.start()
+        self.client = boto3.client('s3', region_name='us-east-1', aws_access_key_id='fake',
+                                   aws_secret_access_key='fake')
+        self.client.create_bucket(Bucket=BUCKET)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        self.mock.stop()
+
+    def make_file(self, name, content=b'jpeg'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_uploads_files_and_bytes_then_signals_completion(self):
+        uploader = S3Uploader(BUCKET, 'fake', 'fake', num_workers=4)
+        path = self.make_file('1_2_3.jpg')
+        on_success = MagicMock()
+        futures = [uploader.submit_file(path, 'raw/1_2_3.jpg', on_success=on_success),
+                   uploader.submit_bytes(b'shard', 'shards/a.tar')]
+        assert [f.result(timeout=10) for f in futures] == ['raw/1_2_3.jpg', 'shards/a.tar']
+        uploader.close()
+
+        assert on_success.call_count == 1
+        assert self.client.get_object(Bucket=BUCKET, Key='raw/1_2_3.jpg')['Body'].read() == b'jpeg'
+        assert self.client.get_object(Bucket=BUCKET, Key='shards/a.tar')['Body'].read() == b'shard'
+        assert uploader.stats.uploaded == 2
+        assert uploader.stats.bytes == 9
+
+    def test_retries_with_backoff_then_fails(self):
+        client = MagicMock()
+        client.upload_fileobj.side_effect = botocore.exceptions.EndpointConnectionError(endpoint_url='http://s3')
+        uploader = S3Uploader(BUCKET, client=client, num_workers=1, max_attempts=3, backoff_base_secs=0.01)
+        on_failure = MagicMock()
+        future = uploader.submit_bytes(b'x', 'raw/x.jpg', on_failure=on_failure)
+        with self.assertRaises(botocore.exceptions.EndpointConnectionError):
+            future.result(timeout=10)
+        uploader.close()
+
+        assert client.upload_fileobj.call_count == 3
+        assert uploader.stats.retried == 2
+        assert uploader.stats.failed == 1
+        assert on_failure.call_count == 1
+
+    def test_full_queue_rejects_without_blocking(self):
+        release = threading.Event()
+        client = MagicMock()
+        client.upload_fileobj.side_effect = lambda *args, **kwargs: release.wait(10)
+        uploader = S3Uploader(BUCKET, client=client, num_workers=1, max_queue_size=1)
+        first = uploader.submit_bytes(b'1', 'a')
+        time.sleep(0.1)
+        uploader.submit_bytes(b'2', 'b')
+        rejected = uploader.submit_bytes(b'3', 'c')
+        with self.assertRaises(queue.Full):
+            rejected.result(timeout=1)
+        release.set()
+        assert first.result(timeout=10) == 'a'
+        uploader.close()
+        assert uploader.stats.rejected == 1
+
+    def test_get_uploader_is_shared_per_process(self):
+        assert get_uploader(BUCKET, 'fake', 'fake', num_workers=1) is get_uploader(BUCKET)
+
+    def test_close_uploaders_finishes_queued_uploads(self):
+        uploader = get_uploader(BUCKET, 'fake', 'fake', num_workers=1)
+        futures = [uploader.submit_bytes(b'x', f'raw/{i}.jpg') for i in range(3)]
+        close_uploaders()
+        assert all(f.done() for f in futures)
+        assert uploader.stats.uploaded == 3
+        assert get_uploader(BUCKET, 'fake', 'fake', num_workers=1) is not uploader
+        close_uploaders()
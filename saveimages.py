@@ -14,15 +14,21 @@ import errno
 import json
 import logging
 import os
-import threading
+import sys
 import time
 import argparse
+import multiprocessing
 from multiprocessing import Pool
+from multiprocessing.util import Finalize
 
 import boto3
 import requests
 import urllib3
 
+import s3uploader
+from framededup import FrameDeduplicator, new_digest
+from metrics import CAMERA_FRAMES, OUTCOME_ERROR, OUTCOME_OK, record_stage
+
 from attr import dataclass
 from argparse import RawTextHelpFormatter
 
@@ -30,6 +36,8 @@ DOT_CAMERA_LIST_URL = "https://webcams.nyctmc.org/new-data.php?query="
 # DOT_CAMERA_LIST_URL = "https://dotsignals.org/new-data.php?query="
 DOT_CAMERA_ID_URL = "https://webcams.nyctmc.org/google_popup.php?cid="
 # DOT_CAMERA_ID_URL = "https://dotsignals.org/google_popup.php?cid="
+DOT_CAMERA_IMAGE_URL = "http://207.251.86.238/cctv"
+DOT_CAMERA_IMAGE_URL_SUFFIX = ".jpg?math=0.011125243364920934"
 saveDirectory = "/tmp/rawimages"
 outDirectory = "/tmp/preprocessed"
 BUCKET = "intersection-ourcamera"
@@ -37,6 +45,10 @@ BUCKET = "intersection-ourcamera"
 save_to_aws = True
 ACCESS_KEY = ""
 SECRET_KEY = ""
+# archiveshards.ShardArchiver packing raw frames into per-camera shards instead of one S3 object per frame
+raw_archiver = None
+# framededup.FrameDeduplicator of a pool worker process, set up by init_fetch_worker
+frame_dedup = None
 
 
 @dataclass(frozen=True)
@@ -46,6 +58,27 @@ class SaveImagesConfig:
     MULTIPROCESS_SLEEP_SECS = 11
     SINGLEPROCESS_SLEEP_SECS = 1
     DEFAULT_NUM_WORKERS = 20
+    DEFAULT_FETCH_MODE = "pool"
+    ASYNC_MAX_CONNECTIONS = 200
+    ASYNC_MAX_CONNECTIONS_PER_HOST = 50
+    ASYNC_REQUEST_TIMEOUT_SECS = 10
+    ASYNC_CHUNK_SIZE = 16 * 1024
+    SCHEDULER_INTERVAL_SECS = 15
+    SCHEDULER_MAX_FETCHES_PER_SEC = 100
+    SCHEDULER_BACKOFF_BASE_SECS = 30
+    SCHEDULER_BACKOFF_MAX_SECS = 15 * 60
+    SCHEDULER_JITTER = 0.2
+    SCHEDULER_REPORT_INTERVAL_SECS = 60
+    UPLOAD_WORKERS = 16
+    UPLOAD_QUEUE_SIZE = 2000
+    UPLOAD_MAX_ATTEMPTS = 4
+    SHARD_DIRECTORY = "/tmp/shards"
+    SHARD_WINDOW_SECS = 60 * 60
+    CAMERA_ID_TIMEOUT_SECS = 10
+    REGISTRY_PATH = "/tmp/camera_registry.json"
+    REGISTRY_NUM_WORKERS = 32
+    REGISTRY_MAX_AGE_SECS = 7 * 24 * 60 * 60
+    METRICS_PORT = 9108
 
 
 # noinspection PyArgumentList
@@ -65,6 +98,9 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 VERIFY_SSL_CERT = False
 VALID_IMG_CONTENT_SIZE = 11000
 
+STAGE_FETCH = 'fetch'
+STAGE_WRITE = 'write'
+
 
 class CameraObject:
 
@@ -83,89 +119,131 @@ class CameraObject:
 
 def save_file(camera_object):
     assert isinstance(camera_object, CameraObject)
-    camera_id = camera_object.cameraId
-    url = "http://207.251.86.238/cctv"
-    append = ".jpg?math=0.011125243364920934"
     file_name = SaveImages.get_string_format(camera_object)
     file_path = os.path.join(saveDirectory, file_name)
-    url_to_save = url + str(camera_id) + append
+    url_to_save = SaveImages.get_camera_image_url(camera_object)
     log.info("trying to download" + url_to_save)
 
+    start_time = time.monotonic()
+    headers = frame_dedup.request_headers(camera_object) if frame_dedup is not None else None
     try:
-        img_content = requests.get(url_to_save)
+        img_content = requests.get(url_to_save, headers=headers)
         img_content.raise_for_status()
-    except requests.exceptions.HTTPError:
+    except requests.exceptions.RequestException:
         log.exception(f"Could not make GET request to image with url={url_to_save}")
+        record_fetch(camera_object, start_time, OUTCOME_ERROR)
         raise
     else:
-        if len(img_content.content) > VALID_IMG_CONTENT_SIZE:
+        if frame_dedup is not None and img_content.status_code == 304:
+            frame_dedup.record_not_modified(camera_object)
+            record_fetch(camera_object, start_time, 'unchanged')
+        elif len(img_content.content) > VALID_IMG_CONTENT_SIZE:
+            digest = new_digest()
+            digest.update(img_content.content)
+            digest = digest.digest()
+            size = len(img_content.content)
+            if frame_dedup is not None and frame_dedup.is_duplicate(camera_object, digest, size, img_content.headers):
+                log.debug(f"Dropped unchanged frame of camera={camera_object.cameraId}")
+                record_fetch(camera_object, start_time, 'unchanged')
+                return
+            record_fetch(camera_object, start_time, OUTCOME_OK)
+            write_started = time.monotonic()
             try:
                 with open(file_path, 'wb') as f:
                     f.write(img_content.content)
                     log.info(f'Wrote {len(img_content.content)} bytes to {file_path}')
             except IOError:
                 logging.exception(f"Could not write image content to file={file_path}")
+                record_stage(STAGE_WRITE, time.monotonic() - write_started, outcome=OUTCOME_ERROR)
                 raise
             else:
-                rename_on_success = os.path.join(outDirectory, file_name)
-                SaveImages.save_file_to_s3(file_path, file_name, "raw", rename_on_success, ACCESS_KEY, SECRET_KEY)
-
+                if frame_dedup is not None:
+                    frame_dedup.commit(camera_object, digest, size, img_content.headers)
+                SaveImages.upload_raw_file(file_path, file_name)
+                record_stage(STAGE_WRITE, time.monotonic() - write_started)
+        else:
+            record_fetch(camera_object, start_time, 'too_small')
 
-class RenameAfterUpload(object):
-    def __init__(self, current_file_path, next_file_path):
-        self._current_file_path = current_file_path
-        self._next_file_path = next_file_path
-        self._size = float(os.path.getsize(current_file_path))
-        self._seen_so_far = 0
-        self._lock = threading.Lock()
 
-    def __call__(self, bytes_amount):
-        with self._lock:
-            self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            if percentage == 100.0:
-                log.info(f'File @{self._current_file_path} {"exists" if os.path.exists(self._current_file_path) else "does not exist"}')
-                os.rename(self._current_file_path, self._next_file_path)
+def record_fetch(camera_object, start_time, outcome):
+    record_stage(STAGE_FETCH, time.monotonic() - start_time, outcome=outcome)
+    CAMERA_FRAMES.labels(STAGE_FETCH, camera_object.locationId, outcome).inc()
 
-    def __str__(self):
-        return f'{self.__class__.__name__}({self._current_file_path}, {self._next_file_path})'
 
+def init_fetch_worker(dedup_states, metrics_port=0, workers_started=None):
+    """Pool initializer deduplicating frames against the camera states shared by all fetch workers
 
-class DeleteAfterUpload(object):
-    def __init__(self, current_file_path):
-        self._current_file_path = current_file_path
-        self._size = float(os.path.getsize(current_file_path))
-        self._seen_so_far = 0
-        self._lock = threading.Lock()
+    Pool workers exit without running atexit handlers and their upload threads are daemons, so the queued uploads of
+    a worker are finished by a finalizer when it exits on pool.close() and pool.join().
+    """
+    global frame_dedup
+    frame_dedup = FrameDeduplicator(dedup_states)
+    Finalize(None, s3uploader.close_uploaders, exitpriority=10)
+    if metrics_port:
+        serve_worker_metrics(metrics_port, workers_started)
 
-    def __call__(self, bytes_amount):
-        with self._lock:
-            self._seen_so_far += bytes_amount
-            percentage = (self._seen_so_far / self._size) * 100
-            if percentage == 100.0:
-                os.remove(self._current_file_path)
 
-    def __str__(self):
-        return f'{self.__class__.__name__}({self._current_file_path})'
+def serve_worker_metrics(base_port, workers_started):
+    """Pool initializer serving the metrics of a fetch worker process on base_port plus its number"""
+    from metrics import start_http_server
+    with workers_started.get_lock():
+        workers_started.value += 1
+        port = base_port + workers_started.value
+    try:
+        start_http_server(port)
+    except OSError:
+        log.exception(f"Could not serve worker metrics on port={port}")
 
 
 class SaveImages:
     @staticmethod
     def save_file_to_s3(fpath, file_name, s3_base_directory, rename_on_success, key, secret):
+        """Queue a file for upload to S3 without waiting for it and return the upload Future
+
+        Once the upload is done the file is deleted when rename_on_success is False, moved to rename_on_success when
+        it is a path, and left in place when it is empty. The hand-off also happens when the upload finally fails,
+        so a frame is still analyzed when S3 is unavailable.
+        """
         if not save_to_aws:
-            return
+            return None
 
-        s3 = boto3.client('s3', aws_access_key_id=key, aws_secret_access_key=secret)
         s3path = '/'.join([s3_base_directory, SaveImages.get_s3_path(file_name)])
 
-        callback = None
-        if rename_on_success is False:
-            callback = DeleteAfterUpload(fpath)
-        elif len(rename_on_success) > 0:
-            callback = RenameAfterUpload(fpath, rename_on_success)
+        def hand_off():
+            if rename_on_success is False:
+                os.remove(fpath)
+            elif len(rename_on_success) > 0:
+                os.rename(fpath, rename_on_success)
+
+        return SaveImages.get_uploader(key, secret).submit_file(fpath, s3path, on_success=hand_off,
+                                                                 on_failure=hand_off)
 
-        s3.upload_file(fpath, BUCKET, s3path, Callback=callback)
-        log.info(f"Wrote {file_name} to s3://{BUCKET}/{s3path}; callback={callback}")
+    @staticmethod
+    def get_uploader(key=None, secret=None):
+        return s3uploader.get_uploader(BUCKET,
+                                       ACCESS_KEY if key is None else key,
+                                       SECRET_KEY if secret is None else secret,
+                                       num_workers=SaveImagesConfig.UPLOAD_WORKERS,
+                                       max_queue_size=SaveImagesConfig.UPLOAD_QUEUE_SIZE,
+                                       max_attempts=SaveImagesConfig.UPLOAD_MAX_ATTEMPTS)
+
+    @staticmethod
+    def upload_raw_file(file_path, file_name):
+        rename_on_success = os.path.join(outDirectory, file_name)
+        if raw_archiver is not None:
+            with open(file_path, 'rb') as f:
+                raw_archiver.add_frame(f.read(), file_name)
+            os.rename(file_path, rename_on_success)
+            return None
+        return SaveImages.save_file_to_s3(file_path, file_name, "raw", rename_on_success, ACCESS_KEY, SECRET_KEY)
+
+    @staticmethod
+    def upload_raw_bytes(data, file_name):
+        if raw_archiver is not None:
+            raw_archiver.add_frame(data, file_name)
+            return None
+        s3path = '/'.join(["raw", SaveImages.get_s3_path(file_name)])
+        return SaveImages.get_uploader().submit_bytes(data, s3path)
 
     @staticmethod
     def get_s3_path(file_name):
@@ -177,10 +255,17 @@ class SaveImages:
         epoch = datetime.datetime.now().strftime("%s")
         return str(camera_object.cameraId) + "_" + str(camera_object.locationId) + "_" + str(epoch) + ".jpg"
 
+    @staticmethod
+    def get_camera_image_url(camera_object):
+        return DOT_CAMERA_IMAGE_URL + str(camera_object.cameraId) + DOT_CAMERA_IMAGE_URL_SUFFIX
+
     @staticmethod
     def download_dot_files(task_pool, camera_objects):
+        """Fetch one image per camera using either a multiprocessing Pool or an asyncfetch.AsyncCameraFetcher"""
         log.info("download_dot_files")
         try:
+            if hasattr(task_pool, 'fetch_all'):
+                return task_pool.fetch_all(camera_objects)
             task_pool.map(save_file, camera_objects)
         except:
             log.exception("Failed running save_file() worker processes")
@@ -202,8 +287,10 @@ class SaveImages:
             return resp.json()
 
     @staticmethod
-    def get_dot_camera_id_for_location_id(location_id):
-        page = requests.get(DOT_CAMERA_ID_URL + str(location_id), verify=VERIFY_SSL_CERT).text
+    def get_dot_camera_id_for_location_id(location_id, session=None):
+        http = session if session is not None else requests
+        page = http.get(DOT_CAMERA_ID_URL + str(location_id), verify=VERIFY_SSL_CERT,
+                        timeout=SaveImagesConfig.CAMERA_ID_TIMEOUT_SECS).text
         camera_id = page.find(".jpg")
         log.info(f'CameraId={camera_id}')
         for i in range(0, 5):
@@ -265,7 +352,7 @@ class SaveImages:
     def save_objects_to_file(file_path, objects_to_save):
         with open(file_path, 'w') as outfile:
             json.dump([ob.__dict__ for ob in objects_to_save], outfile)
-        SaveImages.save_file_to_s3(file_path, "cameraobjects", "map", "", ACCESS_KEY, SECRET_KEY)
+        return SaveImages.save_file_to_s3(file_path, "cameraobjects", "map", "", ACCESS_KEY, SECRET_KEY)
 
     @staticmethod
     def make_sure_directories_exist():
@@ -284,6 +371,10 @@ class SaveImages:
 
 
 if __name__ == '__main__':
+    # The helper modules import this one as "saveimages"; make that the running module rather than a second copy
+    # so they see the settings made below
+    sys.modules['saveimages'] = sys.modules[__name__]
+
     parser = argparse.ArgumentParser(
         description=
         'Save images module. The following envvars are supported:\n\n' +
@@ -293,7 +384,23 @@ if __name__ == '__main__':
                 'AWS_SECRET_ACCESS_KEY': 'AWS secret access key to connect to DynamoDB',
                 'CAMERA_ID (optional)': 'CameraID to start gathering data for',
                 f'NUM_WORKERS (optional, default {SaveImagesConfig.DEFAULT_NUM_WORKERS})':
-                    'Num of concurrent processes to get camera data'
+                    'Num of concurrent processes to get camera data',
+                f'CAMERA_REGISTRY_PATH (optional, default {SaveImagesConfig.REGISTRY_PATH})':
+                    'File caching resolved camera IDs between restarts',
+                f'FETCH_MODE (optional, default {SaveImagesConfig.DEFAULT_FETCH_MODE})':
+                    '"pool" for worker processes, "async" for a single-process asyncio fetcher, '
+                    '"scheduled" to fetch each camera on its own schedule with backoff. All of them drop '
+                    'unchanged frames',
+                f'MAX_FETCHES_PER_SEC (optional, default {SaveImagesConfig.SCHEDULER_MAX_FETCHES_PER_SEC})':
+                    'Global fetch rate cap in "scheduled" mode',
+                'FRAME_RING (optional)':
+                    'Shared memory ring name to hand frames to analyzeimages in "async"/"scheduled" mode, '
+                    'needs Python 3.8+',
+                'ARCHIVE_MODE (optional, default "objects")':
+                    '"shards" to archive raw frames in per-camera hourly shards in "async"/"scheduled" mode',
+                f'METRICS_PORT (optional, default {SaveImagesConfig.METRICS_PORT})':
+                    'Port to serve Prometheus metrics on at /metrics, 0 to not serve them. In "pool" mode the '
+                    'fetch, write and upload metrics of the N worker processes are served on the next N ports'
             }.items()),
         formatter_class=RawTextHelpFormatter
     )
@@ -307,7 +414,9 @@ if __name__ == '__main__':
     camera_ids = os.getenv('CAM_IDS_LOCATION_IDS', None)
     if camera_ids is None:
         log.info("Loading all camera objects")
-        cameraObjects = SaveImages.fill_camera_objects_with_camera_id(SaveImages.get_camera_objects_without_camera_id())
+        from cameraregistry import CameraRegistry
+        registry = CameraRegistry(os.getenv('CAMERA_REGISTRY_PATH', SaveImagesConfig.REGISTRY_PATH))
+        cameraObjects = registry.refresh(SaveImages.get_camera_objects_without_camera_id())
         SaveImages.save_objects_to_file("/tmp/objects.json", cameraObjects)
         for_seconds = SaveImagesConfig.MULTIPROCESS_SLEEP_SECS
         num_processes = os.getenv('NUM_WORKERS', SaveImagesConfig.DEFAULT_NUM_WORKERS)
@@ -339,19 +448,56 @@ if __name__ == '__main__':
         for_seconds = SaveImagesConfig.SINGLEPROCESS_SLEEP_SECS
         num_processes = len(cameraObjects)
 
-    # TODO: Substitute multiprocessing with async / greenlets programming
-    pool = Pool(processes=num_processes)
+    metrics_port = int(os.getenv('METRICS_PORT', SaveImagesConfig.METRICS_PORT))
+    fetch_mode = os.getenv('FETCH_MODE', SaveImagesConfig.DEFAULT_FETCH_MODE)
+    dedup_manager = None
+    if fetch_mode in ('async', 'scheduled'):
+        from asyncfetch import AsyncCameraFetcher
+        frame_ring = None
+        if os.getenv('FRAME_RING'):
+            from framering import FrameRing
+            frame_ring = FrameRing.open(os.getenv('FRAME_RING'))
+        if os.getenv('ARCHIVE_MODE') == 'shards' and save_to_aws:
+            from archiveshards import ShardArchiver
+            raw_archiver = ShardArchiver(SaveImages.get_uploader(), SaveImagesConfig.SHARD_DIRECTORY,
+                                         window_secs=SaveImagesConfig.SHARD_WINDOW_SECS)
+        pool = AsyncCameraFetcher(frame_ring=frame_ring)
+    else:
+        # Any worker may fetch a camera, so the last frame of each one is kept in a dict shared by all of them.
+        # Each worker process records metrics into its own registry and serves it on a port of its own.
+        dedup_manager = multiprocessing.Manager()
+        pool = Pool(processes=int(num_processes), initializer=init_fetch_worker,
+                    initargs=(dedup_manager.dict(), metrics_port, multiprocessing.Value('i', 0)))
+    # Started once the workers are forked, so they inherit neither the spool gauges nor the listening socket
+    if metrics_port:
+        from metrics import start_http_server, watch_spool
+        watch_spool(saveDirectory)
+        watch_spool(outDirectory)
+        start_http_server(metrics_port)
     try:
-        SaveImages.download_dot_files(pool, cameraObjects)
-        while True:
-            if SaveImages.return_true_to_download_more_images(SaveImagesConfig.MAX_FILES_TO_DOWNLOAD):
-                SaveImages.download_dot_files(pool, cameraObjects)
-                log.info(f'Downloaded data from {len(cameraObjects)} cameras')
-
-            log.info("sleeping")
-            time.sleep(for_seconds)
+        if fetch_mode == 'scheduled':
+            from camerascheduler import CameraScheduler
+            scheduler = CameraScheduler(
+                cameraObjects,
+                max_fetches_per_sec=float(os.getenv('MAX_FETCHES_PER_SEC',
+                                                    SaveImagesConfig.SCHEDULER_MAX_FETCHES_PER_SEC)))
+            pool.run_scheduled(scheduler, should_fetch=lambda: SaveImages.return_true_to_download_more_images(
+                SaveImagesConfig.MAX_FILES_TO_DOWNLOAD))
+        else:
+            SaveImages.download_dot_files(pool, cameraObjects)
+            while True:
+                if SaveImages.return_true_to_download_more_images(SaveImagesConfig.MAX_FILES_TO_DOWNLOAD):
+                    SaveImages.download_dot_files(pool, cameraObjects)
+                    log.info(f'Downloaded data from {len(cameraObjects)} cameras')
+
+                log.info("sleeping")
+                time.sleep(for_seconds)
     except:
         log.exception("An error occurred while downloading files. Exiting.")
     finally:
         pool.close()
+        if raw_archiver is not None:
+            raw_archiver.close()
         pool.join()
+        if dedup_manager is not None:
+            dedup_manager.shutdown()
@@ -1,7 +1,21 @@
 import unittest
 from mock import patch
 from saveimages import *
+from fakedot import FakeDotServer
 import copy
+import saveimages
+import shutil
+import tempfile
+
+
+def queue_raw_upload(file_path, file_name):
+    SaveImages.upload_raw_file(file_path, file_name)
+
+
+def slow_upload(uploader, job):
+    time.sleep(0.5)
+    uploader._finish(job)
+
 
 class TestSaveImages(unittest.TestCase):
 
@@ -27,7 +41,7 @@ class TestSaveImages(unittest.TestCase):
         mockObject2 = copy.deepcopy(mockObject)
         mockObject2.cameraId = 126
         mockObjects2 = [mockObject2]
-        mockJsonString2 = '{"latitude": 123.123, "locationId": 123, "cameraId": 126, "longitude": 123.123}'
+        mockJsonString2 = '{"cameraId": 126, "locationId": 123, "latitude": 123.123, "longitude": 123.123, "name": null}'
 
 
     class MockDOTLocationMapAsJson:
@@ -47,42 +61,28 @@ class TestSaveImages(unittest.TestCase):
                 "content": "1 Ave @ 110 St"
             }]}
 
-    class MockDOTResponseJson:
-        def read(self):
-            return """
-            {"markers": [{
-                "id": "368",
-                "latitude": "40.79142677512476",
-                "longitude": "-73.93807411193848",
-                "title": "images\/camera1.png",
-                "icon": "images\/camera1.png",
-                "content": "1 Ave @ 110 St"
-            }]}
-                    """
-
-    class MockDOTResponseString:
-        def read(self):
-            return """
-            var currentImage = imageID;document.getElementById(currentImage).src = '
-            http://207.251.86.238/cctv261.jpg'+'?math=';
-                    """
-
+    def fake_dot_server(self, images=(b'small', b'large' * 3000)):
+        server = FakeDotServer(list(images), num_cameras=2, frame_interval_secs=0).start()
+        self.addCleanup(server.close)
+        patcher = patch.multiple(saveimages, **server.urls())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return server
 
     def test_get_dot_location_map_as_json(self):
-        with patch("urllib.urlretrieve", return_value=self.MockDOTResponseJson()) as mock_urlopen:
-            result = SaveImages.get_dot_location_map_as_json()
-            assert 'markers' in result
-            assert isinstance(result["markers"], list)
-            assert result["markers"][0]["id"] == "368"
+        self.fake_dot_server()
+        result = SaveImages.get_dot_location_map_as_json()
+        assert 'markers' in result
+        assert isinstance(result["markers"], list)
+        assert result["markers"][0]["id"] == "1000"
 
     def test_get_dot_camera_id_for_location_id(self):
-        with patch("urllib.urlopen", return_value=self.MockDOTResponseString()) as mock_urlopen:
-            result = SaveImages.get_dot_camera_id_for_location_id(368)
-            print("Result is " + str(result))
-            assert result == 261
+        self.fake_dot_server()
+        result = SaveImages.get_dot_camera_id_for_location_id(1001)
+        assert result == 101
 
     def test_get_array_of_camera_objects_without_camera_id(self):
-        with patch.object(SaveImages, 'getDOTLocationMapAsJson', return_value=self.MockDOTLocationMapAsJson.mocks) as mock_method:
+        with patch.object(SaveImages, 'get_dot_location_map_as_json', return_value=self.MockDOTLocationMapAsJson.mocks) as mock_method:
             cameraObjects = SaveImages.get_camera_objects_without_camera_id()
             assert isinstance(cameraObjects[0],CameraObject)
             assert cameraObjects[0].cameraId == None
@@ -94,29 +94,94 @@ class TestSaveImages(unittest.TestCase):
             assert cameraObjects[1].latitude == "40.123"
 
     def test_add_camera_ids_to_camera_objects(self):
-        with patch.object(SaveImages,'getDOTCameraIdForLocationId',return_value= 261) as mock_id:
+        with patch.object(SaveImages,'get_dot_camera_id_for_location_id',return_value= 261) as mock_id:
             mockObjects = self.MockCameraObjectsWithoutCameraId.mockObjects
             assert isinstance(mockObjects[0], CameraObject)
             assert mockObjects[0].cameraId == None
             SaveImages.fill_camera_objects_with_camera_id(mockObjects)
             assert mockObjects[0].cameraId == 261
 
-    @patch('saveimages.boto3')
-    def test_save_images(self,boto3):
-        with patch("urllib.urlretrieve") as mock_urlretrieve, \
-                patch("os.path.getsize",return_value=5) as mock_getsize, patch("os.remove") as mock_remove:
-            save_file(self.MockCameraObjectsWithoutCameraId.mockObject2)
-            assert mock_urlretrieve.call_count ==1
-            assert mock_getsize.call_count ==1
-            assert mock_remove.call_count ==1
-
-        with patch("urllib.urlretrieve") as mock_urlretrieve2, \
-                patch("os.path.getsize",return_value=50000) as mock_getsize2, patch("os.remove") as mock_remove2,\
-                patch("os.rename") as mock_rename2:
-            save_file(self.MockCameraObjectsWithoutCameraId.mockObject2)
-            assert mock_urlretrieve2.call_count ==1
-            assert mock_getsize2.call_count ==1
-            assert mock_remove2.call_count ==0
+    def test_save_images(self):
+        # Camera 100 serves a frame too small to be a camera image, camera 101 a valid one
+        self.fake_dot_server()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        camera = self.MockCameraObjectsWithoutCameraId.mockObject2
+        with patch.object(saveimages, 'saveDirectory', directory), \
+                patch.object(SaveImages, 'upload_raw_file') as mock_upload, patch.object(camera, 'cameraId', 100):
+            save_file(camera)
+            assert mock_upload.call_count == 0
+            assert os.listdir(directory) == []
+
+        with patch.object(saveimages, 'saveDirectory', directory), \
+                patch.object(SaveImages, 'upload_raw_file') as mock_upload2, patch.object(camera, 'cameraId', 101):
+            save_file(camera)
+            assert mock_upload2.call_count == 1
+            file_path, file_name = mock_upload2.call_args[0]
+            assert file_name.startswith("101_123_")
+            with open(file_path, 'rb') as f:
+                assert f.read() == b'large' * 3000
+
+    def test_save_file_records_fetch_and_write_metrics(self):
+        from metrics import CAMERA_FRAMES, STAGE_ITEMS
+        self.fake_dot_server()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        camera = self.MockCameraObjectsWithoutCameraId.mockObject2
+        fetched = STAGE_ITEMS.labels(STAGE_FETCH, 'ok').value()
+        too_small = CAMERA_FRAMES.labels(STAGE_FETCH, camera.locationId, 'too_small').value()
+        written = STAGE_ITEMS.labels(STAGE_WRITE, 'ok').value()
+        with patch.object(saveimages, 'saveDirectory', directory), patch.object(SaveImages, 'upload_raw_file'):
+            with patch.object(camera, 'cameraId', 100):
+                save_file(camera)
+            with patch.object(camera, 'cameraId', 101):
+                save_file(camera)
+        assert STAGE_ITEMS.labels(STAGE_FETCH, 'ok').value() == fetched + 1
+        assert CAMERA_FRAMES.labels(STAGE_FETCH, camera.locationId, 'too_small').value() == too_small + 1
+        assert STAGE_ITEMS.labels(STAGE_WRITE, 'ok').value() == written + 1
+
+    def test_pool_workers_drop_frames_another_worker_already_spooled(self):
+        self.fake_dot_server()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        camera = self.MockCameraObjectsWithoutCameraId.mockObject2
+        dedup_states = {}
+        with patch.object(saveimages, 'saveDirectory', directory), patch.object(saveimages, 'frame_dedup', None), \
+                patch.object(SaveImages, 'upload_raw_file') as mock_upload, patch.object(camera, 'cameraId', 101):
+            init_fetch_worker(dedup_states)
+            save_file(camera)
+            first_worker = saveimages.frame_dedup
+            init_fetch_worker(dedup_states)
+            save_file(camera)
+            assert saveimages.frame_dedup is not first_worker
+            assert saveimages.frame_dedup.totals().not_modified == 1
+        assert mock_upload.call_count == 1
+
+    def test_pool_workers_finish_their_uploads_before_exiting(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        raw_path = os.path.join(directory, "1_2_3.jpg")
+        out_directory = os.path.join(directory, "out")
+        os.mkdir(out_directory)
+        with open(raw_path, 'wb') as f:
+            f.write(b'jpeg')
+        with patch.object(saveimages, 'outDirectory', out_directory), \
+                patch.object(s3uploader.S3Uploader, '_upload', slow_upload):
+            pool = multiprocessing.get_context('fork').Pool(1, initializer=init_fetch_worker, initargs=({},))
+            pool.apply(queue_raw_upload, (raw_path, "1_2_3.jpg"))
+            pool.close()
+            pool.join()
+        # The upload finished and handed the frame off, instead of dying with the worker
+        assert os.listdir(out_directory) == ["1_2_3.jpg"]
+        assert not os.path.exists(raw_path)
+
+    def test_pool_workers_serve_metrics_on_ports_of_their_own(self):
+        import multiprocessing
+        workers_started = multiprocessing.Value('i', 0)
+        with patch('metrics.start_http_server') as start:
+            serve_worker_metrics(9108, workers_started)
+            serve_worker_metrics(9108, workers_started)
+        assert [call[0][0] for call in start.call_args_list] == [9109, 9110]
 
     def test_get_JSON_String_Object_from_Class(self):
         assert self.MockCameraObjectsWithoutCameraId.mockJsonString2 == SaveImages.get_json_string_from_object(self.MockCameraObjectsWithoutCameraId.mockObject2)
@@ -126,6 +191,32 @@ class TestSaveImages(unittest.TestCase):
             assert SaveImages.return_true_to_download_more_images(4)
             assert SaveImages.return_true_to_download_more_images(1) == False
 
+    def test_save_file_to_s3_hands_off_file_after_upload(self):
+        try:
+            from moto import mock_aws
+        except ImportError:
+            from moto import mock_s3 as mock_aws
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with mock_aws():
+            client = boto3.client('s3', region_name='us-east-1')
+            client.create_bucket(Bucket=BUCKET)
+            uploader = s3uploader.S3Uploader(BUCKET, client=client, num_workers=1)
+            raw_path = os.path.join(directory, "1_2_3.jpg")
+            done_path = os.path.join(directory, "done.jpg")
+            with open(raw_path, 'wb') as f:
+                f.write(b'jpeg')
+            with patch.object(SaveImages, 'get_uploader', return_value=uploader):
+                future = SaveImages.save_file_to_s3(raw_path, "1_2_3.jpg", "raw", done_path, "", "")
+                s3path = future.result(timeout=10)
+                annotated = SaveImages.save_file_to_s3(done_path, "1_2_3.jpg", "annotated", False, "", "")
+                annotated.result(timeout=10)
+            uploader.close()
+            assert s3path.startswith("raw/") and s3path.endswith("/1_2_3.jpg")
+            assert client.get_object(Bucket=BUCKET, Key=s3path)['Body'].read() == b'jpeg'
+            assert not os.path.exists(raw_path)
+            assert not os.path.exists(done_path)
+
     def test_get_timestamp_and_location_id(self):
         timestamp,locationId = SaveImages.get_timestamp_and_location_id("ignore_1_1539560991.jpg")
         assert timestamp == 1539560991
@@ -0,0 +1,46 @@
+r"""Startup phase timing
+
+After a deploy or a restart the analyzer spends seconds importing, loading and warming up the model before the
+first result is out. StartupTimer records how long each phase took, from the start of the process to the first
+result, so time-to-first-result can be tracked from one release to the next.
+
+
+Example usage:
+    timer = StartupTimer(PROCESS_STARTED_AT)
+    timer.mark('imports')
+    detector = create_detector()
+    timer.mark('load_model')
+    ...
+    if timer.mark('first_result'):
+        log.info(f"Startup: {timer.report()}")
+"""
+import threading
+import time
+
+
+class StartupTimer:
+
+    def __init__(self, started_at=None, clock=time.time) -> None:
+        super().__init__()
+
+        self._clock = clock
+        self.started_at = clock() if started_at is None else started_at
+        self._last = self.started_at
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def mark(self, phase):
+        """Record that phase ended now, after the phase before it; returns False when phase was already recorded"""
+        now = self._clock()
+        with self._lock:
+            if phase in self.phases:
+                return False
+            self.phases[phase] = now - self._last
+            self._last = now
+            return True
+
+    def report(self):
+        with self._lock:
+            report = {phase: round(secs, 3) for phase, secs in self.phases.items()}
+            report['total'] = round(self._last - self.started_at, 3)
+        return report
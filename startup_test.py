@@ -0,0 +1,40 @@
+import unittest
+from startup import *
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestStartupTimer(unittest.TestCase):
+
+    def test_phases_run_back_to_back_from_the_process_start(self):
+        clock = FakeClock()
+        timer = StartupTimer(started_at=98.0, clock=clock)
+        assert timer.mark('imports')
+        clock.now = 103.5
+        assert timer.mark('load_model')
+        clock.now = 104.0
+        assert timer.mark('warm_up')
+        clock.now = 104.25
+        assert timer.mark('first_result')
+        clock.now = 110
+        assert not timer.mark('first_result')
+        assert timer.report() == {'imports': 2.0, 'load_model': 3.5, 'warm_up': 0.5, 'first_result': 0.25,
+                                  'total': 6.25}
+
+    def test_starts_now_by_default(self):
+        clock = FakeClock()
+        timer = StartupTimer(clock=clock)
+        clock.now = 101
+        timer.mark('imports')
+        assert timer.report() == {'imports': 1.0, 'total': 1.0}
+
+
+if __name__ == '__main__':
+    unittest.main()